@@ -0,0 +1,36 @@
+"""Add Matrix state tables
+
+Revision ID: c4bf0ab6fd19
+Revises: 501dad2868bc
+Create Date: 2018-03-10 14:21:07.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'c4bf0ab6fd19'
+down_revision = '501dad2868bc'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('mx_room_state',
+                    sa.Column('room_id', sa.String(), nullable=False),
+                    sa.Column('power_levels', sa.Text(), nullable=True),
+                    sa.PrimaryKeyConstraint('room_id'))
+    op.create_table('mx_room_membership',
+                    sa.Column('room_id', sa.String(), nullable=False),
+                    sa.Column('user_id', sa.String(), nullable=False),
+                    sa.Column('membership', sa.String(), nullable=False),
+                    sa.PrimaryKeyConstraint('room_id', 'user_id'))
+    op.create_table('mx_user_registration',
+                    sa.Column('user_id', sa.String(), nullable=False),
+                    sa.PrimaryKeyConstraint('user_id'))
+
+
+def downgrade():
+    op.drop_table('mx_user_registration')
+    op.drop_table('mx_room_membership')
+    op.drop_table('mx_room_state')
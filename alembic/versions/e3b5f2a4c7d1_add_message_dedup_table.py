@@ -0,0 +1,34 @@
+"""Add message deduplication table
+
+Revision ID: e3b5f2a4c7d1
+Revises: c4bf0ab6fd19
+Create Date: 2018-03-18 16:02:41.731805
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'e3b5f2a4c7d1'
+down_revision = 'c4bf0ab6fd19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('message_dedup',
+                    sa.Column('tgid', sa.Integer(), nullable=False),
+                    sa.Column('tg_receiver', sa.Integer(), nullable=False),
+                    sa.Column('digest', sa.BigInteger(), nullable=False),
+                    sa.Column('action', sa.Boolean(), nullable=False),
+                    sa.Column('mxid', sa.String(), nullable=True),
+                    sa.Column('tg_space', sa.Integer(), nullable=True),
+                    sa.Column('timestamp', sa.BigInteger(), nullable=True),
+                    sa.PrimaryKeyConstraint('tgid', 'tg_receiver', 'digest', 'action'))
+    op.create_index(op.f('ix_message_dedup_timestamp'), 'message_dedup', ['timestamp'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_message_dedup_timestamp'), table_name='message_dedup')
+    op.drop_table('message_dedup')
@@ -0,0 +1,101 @@
+# -*- coding: future_fstrings -*-
+# matrix-appservice-python - A Matrix Application Service framework written in Python.
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Measure decoding and encoding appservice transaction payloads with each JSON library and
+with the codec module.
+
+Run with ``python -m benchmarks.codec`` from the repository root.
+"""
+import json
+import timeit
+
+from mautrix_appservice import codec
+
+EVENTS = 50
+
+
+def message_event(index):
+    return {
+        "type": "m.room.message",
+        "room_id": f"!room{index % 7}:example.com",
+        "sender": f"@user{index}:example.com",
+        "event_id": f"$15{index:011d}abcdef:example.com",
+        "origin_server_ts": 1520000000000 + index,
+        "unsigned": {"age": 1234, "transaction_id": f"m15200000{index}.0"},
+        "content": {
+            "msgtype": "m.text",
+            "body": f"Message number {index} with some ünïcödé text and a link https://t.me/x",
+            "format": "org.matrix.custom.html",
+            "formatted_body": f"Message number <b>{index}</b> with some ünïcödé text",
+        },
+    }
+
+
+def member_event(index):
+    return {
+        "type": "m.room.member",
+        "room_id": f"!room{index % 7}:example.com",
+        "sender": f"@user{index}:example.com",
+        "state_key": f"@user{index}:example.com",
+        "event_id": f"$15{index:011d}ghijkl:example.com",
+        "origin_server_ts": 1520000000000 + index,
+        "content": {"membership": "join", "displayname": f"User {index}",
+                    "avatar_url": "mxc://example.com/abcdefghijklmnop"},
+    }
+
+
+def transaction(events=EVENTS):
+    return {"events": [message_event(index) if index % 4 else member_event(index)
+                       for index in range(events)]}
+
+
+def get_backends():
+    backends = [("json", json.loads, json.dumps)]
+    try:
+        import ujson
+        backends.append(("ujson", ujson.loads,
+                         lambda data: ujson.dumps(data, ensure_ascii=False,
+                                                  escape_forward_slashes=False)))
+    except ImportError:
+        pass
+    try:
+        import orjson
+        backends.append(("orjson", orjson.loads, lambda data: orjson.dumps(data).decode("utf-8")))
+    except ImportError:
+        pass
+    backends.append((f"codec ({codec.backend})", codec.loads, codec.dumps))
+    return backends
+
+
+def bench(func, arg, number):
+    duration = min(timeit.repeat(lambda: func(arg), number=number, repeat=5))
+    return f"{duration / number * 1e6:8.1f} us"
+
+
+def main():
+    payload = transaction()
+    text = json.dumps(payload, ensure_ascii=False)
+    data = text.encode("utf-8")
+    print(f"Transaction with {EVENTS} events, {len(data)} bytes")
+    print(f"{'':16}{'loads(bytes)':>12}{'loads(str)':>12}{'dumps':>12}")
+    for label, loads, dumps in get_backends():
+        assert loads(data) == payload
+        print(f"{label:16}{bench(loads, data, 1000):>12}{bench(loads, text, 1000):>12}"
+              f"{bench(dumps, payload, 1000):>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Measure how many message mappings per second can be saved with a commit per message and
+with the CommitBatcher, on an SQLite database file or the database given by URL.
+
+Run with ``python -m benchmarks.commit_batcher [database URL]`` from the repository root. The
+tables are dropped and recreated in the given database, so don't point it at a bridge's database.
+"""
+from time import perf_counter
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+
+from sqlalchemy import orm
+import sqlalchemy as sql
+
+from mautrix_telegram.base import Base
+from mautrix_telegram.db import Message
+from mautrix_telegram.util import CommitBatcher, enable_savepoints
+import mautrix_telegram.db as db_models
+
+MESSAGES = 2000
+
+
+def create_session(url):
+    engine = sql.create_engine(url)
+    enable_savepoints(engine)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    db = orm.scoping.scoped_session(orm.sessionmaker(bind=engine))
+    db_models.init(db)
+    return engine, db
+
+
+def add_message(db, tgid):
+    db.add(Message(mxid=f"$event{tgid}:example.com", mx_room="!room:example.com", tgid=tgid,
+                   tg_space=1))
+
+
+async def commit_each(loop, db):
+    for tgid in range(MESSAGES):
+        add_message(db, tgid)
+        db.commit()
+        await asyncio.sleep(0, loop=loop)
+
+
+async def batched(loop, db, delay, max_pending):
+    batcher = CommitBatcher(db, loop, logging.getLogger("benchmark"), delay, max_pending)
+    for tgid in range(MESSAGES):
+        batcher.add(f"message {tgid}", add_message, db, tgid)
+        await asyncio.sleep(0, loop=loop)
+    batcher.flush()
+
+
+def main():
+    database_url = sys.argv[1] if len(sys.argv) > 1 else None
+    loop = asyncio.get_event_loop()
+    runs = (
+        ("Commit per message", commit_each),
+        ("CommitBatcher, no delay", lambda loop, db: batched(loop, db, 0, 100)),
+        ("CommitBatcher, 10 ms / 100 changes", lambda loop, db: batched(loop, db, 0.01, 100)),
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        for index, (label, func) in enumerate(runs):
+            path = os.path.join(directory, f"{index}.db")
+            url = database_url or f"sqlite:///{path}"
+            engine, db = create_session(url)
+            start = perf_counter()
+            loop.run_until_complete(func(loop, db))
+            duration = perf_counter() - start
+            assert Message.query.count() == MESSAGES
+            db.remove()
+            engine.dispose()
+            print(f"{label:36} {MESSAGES / duration:8.0f} messages/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# -*- coding: future_fstrings -*-
+# matrix-appservice-python - A Matrix Application Service framework written in Python.
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Measure event send throughput through the connectors built by AppService._create_connector
+with different connection pool settings.
+
+Run with ``python -m benchmarks.connection_pool`` from the repository root.
+"""
+from time import perf_counter
+import asyncio
+import logging
+import os
+import tempfile
+
+from mautrix_appservice import AppService, StateStore
+
+from benchmarks.stub_homeserver import StubHomeserverProcess, create_api
+
+ROOMS = 200
+EVENTS_PER_ROOM = 5
+LATENCY = 0.05
+CONFIGS = (
+    ("TCP, limit 10", {"connection_limit": 10}),
+    ("TCP, limit 100", {"connection_limit": 100}),
+    ("TCP, unlimited", {"connection_limit": 0}),
+    ("TCP, limit 100, no keep-alive", {"connection_limit": 100, "keepalive_timeout": 0}),
+    ("Unix socket, limit 100", {"connection_limit": 100, "unix_socket": True}),
+)
+
+
+def create_state_store(api_rooms):
+    state_store = StateStore()
+    for room in api_rooms:
+        state_store.joined(room, "@bot:example.com")
+        state_store.set_power_levels(room, {"users": {"@bot:example.com": 100}})
+    return state_store
+
+
+async def send_events(loop, intent, rooms):
+    async def send_to(room):
+        for index in range(EVENTS_PER_ROOM):
+            await intent.send_event(room, "m.room.message", {"msgtype": "m.text",
+                                                             "body": f"Message {index}"})
+
+    await asyncio.gather(*(send_to(room) for room in rooms), loop=loop)
+
+
+async def bench(loop, homeserver, label, settings, socket_path):
+    rooms = [f"!room{index}:example.com" for index in range(ROOMS)]
+    state_store = create_state_store(rooms)
+    if settings.pop("unix_socket", False):
+        settings["unix_socket"] = socket_path
+    appservice = AppService(homeserver.url, "example.com", "as_token", "hs_token", "bot",
+                            loop=loop, state_store=state_store, log=logging.getLogger("bench"),
+                            **settings)
+    api = create_api(loop, homeserver, appservice._create_connector(), state_store)
+    intent = api.bot_intent()
+    try:
+        # Warm up the pool, so that opening connections isn't the only thing measured.
+        await send_events(loop, intent, rooms[:10])
+        sent = homeserver.requests["send"]
+        start = perf_counter()
+        await send_events(loop, intent, rooms)
+        duration = perf_counter() - start
+        assert homeserver.requests["send"] - sent == ROOMS * EVENTS_PER_ROOM
+    finally:
+        await api.session.close()
+    print(f"{label:32} {ROOMS * EVENTS_PER_ROOM / duration:8.0f} events/s")
+
+
+def main():
+    # AppService writes mx-transactions.txt to the working directory.
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory)
+        socket_path = os.path.join(directory, "homeserver.sock")
+        homeserver = StubHomeserverProcess(latency=LATENCY, unix_socket=socket_path)
+        homeserver.start()
+        print(f"{ROOMS} rooms sending {EVENTS_PER_ROOM} events each, "
+              f"{LATENCY * 1000:.0f} ms homeserver latency")
+        try:
+            loop = asyncio.get_event_loop()
+            for label, settings in CONFIGS:
+                loop.run_until_complete(bench(loop, homeserver, label, dict(settings),
+                                              socket_path))
+        finally:
+            homeserver.stop()
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
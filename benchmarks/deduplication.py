@@ -0,0 +1,120 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Deduplicate the messages of a group that every message reaches once through each logged-in
+bridge user, with the portal's DedupCache and with the 20-entry deque it replaced.
+
+Each user's copy of a message arrives up to ``spread`` messages late, so the copies of busy
+groups are interleaved with many other messages. The benchmark counts the duplicates that leak
+through and measures the cost of each check.
+
+Run with ``python -m benchmarks.deduplication`` from the repository root.
+"""
+from collections import deque
+from datetime import datetime, timedelta
+from time import perf_counter
+import hashlib
+import random
+
+from telethon_aio.tl.types import Message, PeerChat
+
+from mautrix_telegram.portal import Portal
+from mautrix_telegram.util import DedupCache
+
+MESSAGES = 2000
+USERS = (2, 10, 50)
+SPREADS = (5, 50, 150)
+
+
+class DequeDedup:
+    """The deduplication that the portal used before DedupCache."""
+
+    def __init__(self, max_size=20):
+        self.max_size = max_size
+        self._dedup = deque()
+        self._dedup_mxid = {}
+
+    @staticmethod
+    def hash_event(event):
+        hash_content = [event.date.timestamp(), event.message]
+        return hashlib.md5("-".join(str(a) for a in hash_content).encode("utf-8")).hexdigest()
+
+    def is_duplicate(self, event, mxid=None):
+        hash = self.hash_event(event)
+        if hash in self._dedup:
+            return self._dedup_mxid[hash]
+
+        self._dedup_mxid[hash] = mxid
+        self._dedup.append(hash)
+
+        if len(self._dedup) > self.max_size:
+            del self._dedup_mxid[self._dedup.popleft()]
+        return None
+
+
+class CacheDedup:
+    """Portal.is_duplicate without the persistence."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._dedup = DedupCache(max_size)
+
+    def is_duplicate(self, event, mxid=None):
+        return self._dedup.check(Portal._hash_event(event), mxid)
+
+
+def arrivals(users, spread):
+    rand = random.Random(0)
+    start = datetime(2018, 6, 1)
+    messages = [Message(id=index, to_id=PeerChat(1), date=start + timedelta(seconds=index // 5),
+                        message=f"Message {index % 50}", from_id=index % 7)
+                for index in range(MESSAGES)]
+    copies = []
+    for user in range(users):
+        for index, message in enumerate(messages):
+            # Every user sees the message with its own ID, as in normal Telegram groups.
+            copy = Message(id=index + user * MESSAGES, to_id=message.to_id, date=message.date,
+                           message=message.message, from_id=message.from_id)
+            copies.append((index + rand.uniform(0, spread), copy))
+    copies.sort(key=lambda copy: copy[0])
+    return [copy for _, copy in copies]
+
+
+def run(dedup, events):
+    start = perf_counter()
+    bridged = 0
+    for event in events:
+        if dedup.is_duplicate(event, "$event:example.com") is None:
+            bridged += 1
+    return bridged - MESSAGES, (perf_counter() - start) / len(events)
+
+
+def main():
+    print(f"{MESSAGES} messages, each arriving once through every user")
+    print(f"{'users':>5} {'spread':>6}  {'leaked duplicates, time per check':>44}")
+    for users in USERS:
+        for spread in SPREADS:
+            events = arrivals(users, spread)
+            results = []
+            for dedup in (DequeDedup(20), DequeDedup(200), CacheDedup(200)):
+                leaked, cost = run(dedup, events)
+                results.append(f"{type(dedup).__name__}({dedup.max_size}): "
+                               f"{leaked:5} {cost * 1e6:5.1f} us")
+            print(f"{users:5} {spread:6}  " + "   ".join(results))
+
+
+if __name__ == "__main__":
+    main()
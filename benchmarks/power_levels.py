@@ -0,0 +1,115 @@
+# -*- coding: future_fstrings -*-
+# matrix-appservice-python - A Matrix Application Service framework written in Python.
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Measure the power level check that runs before every send, and how long it takes to raise
+puppet power levels in many rooms at once.
+
+Run with ``python -m benchmarks.power_levels`` from the repository root.
+"""
+from time import perf_counter
+import asyncio
+import timeit
+
+from benchmarks.stub_homeserver import StubHomeserver, create_api
+
+USERS = 100
+ROOMS = 50
+SENDS = 20000
+LATENCY = 0.02
+
+
+def levels_content(users=USERS):
+    content = {
+        "users": {f"@user{index}:example.com": 0 for index in range(users)},
+        "events": {"m.room.name": 50, "m.room.power_levels": 100},
+        "events_default": 0,
+        "state_default": 50,
+    }
+    content["users"]["@bot:example.com"] = 100
+    return content
+
+
+def bench_check(api):
+    store = api.state_store
+    store.set_power_levels("!room:example.com", levels_content())
+    number = 100000
+    args = ("!room:example.com", "@user50:example.com", "m.room.message")
+    duration = min(timeit.repeat(lambda: store.has_power_level(*args), number=number))
+    print(f"has_power_level: {duration / number * 1e9:8.0f} ns")
+
+
+async def bench_send_path(loop, api):
+    intent = api.intent("@user50:example.com")
+    store = api.state_store
+    store.registered(intent.mxid)
+    store.joined("!room:example.com", intent.mxid)
+    start = perf_counter()
+    for _ in range(SENDS):
+        await intent._ensure_has_power_level_for("!room:example.com", "m.room.message")
+    duration = perf_counter() - start
+    print(f"_ensure_has_power_level_for, level already sufficient: "
+          f"{duration / SENDS * 1e9:8.0f} ns")
+
+
+async def bench_raise(loop, homeserver, api, label, global_lock=None):
+    store = api.state_store
+    rooms = [f"!room{index}:example.com" for index in range(ROOMS)]
+    intents = []
+    for room in rooms:
+        content = levels_content(users=0)
+        content["events_default"] = 50
+        store.set_power_levels(room, content)
+        homeserver.state[(room, "m.room.power_levels")] = content
+        store.joined(room, api.bot_mxid)
+        intent = api.intent("@puppet:example.com")
+        store.registered(intent.mxid)
+        store.joined(room, intent.mxid)
+        if global_lock:
+            intent._get_power_level_lock = lambda room_id: global_lock
+        intents.append(intent)
+    start = perf_counter()
+    await asyncio.gather(*(intent._ensure_has_power_level_for(room, "m.room.message")
+                           for intent, room in zip(intents, rooms)), loop=loop)
+    duration = perf_counter() - start
+    assert all(store.has_power_level(room, "@puppet:example.com", "m.room.message")
+               for room in rooms)
+    print(f"Raising levels in {ROOMS} rooms ({LATENCY * 1000:.0f} ms per request), {label}: "
+          f"{duration * 1000:6.0f} ms")
+
+
+async def run(loop):
+    homeserver = StubHomeserver(loop, latency=LATENCY)
+    await homeserver.start()
+    apis = [create_api(loop, homeserver) for _ in range(3)]
+    try:
+        bench_check(apis[0])
+        await bench_send_path(loop, apis[0])
+        await bench_raise(loop, homeserver, apis[1], "one lock for all rooms",
+                          asyncio.Lock(loop=loop))
+        await bench_raise(loop, homeserver, apis[2], "lock per room")
+    finally:
+        for api in apis:
+            await api.session.close()
+        await homeserver.close()
+
+
+def main():
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(loop))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# -*- coding: future_fstrings -*-
+# matrix-appservice-python - A Matrix Application Service framework written in Python.
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Measure the memory used for room memberships by the StateStore and by the dict of dicts of
+strings it used before, and how fast membership checks are in both.
+
+Run with ``python -m benchmarks.state_store_memory [rooms] [members]`` from the repository root.
+The default is 10000 rooms with 1000 members each, which takes a few minutes.
+"""
+from time import perf_counter
+import itertools
+import random
+import sys
+import tracemalloc
+
+from mautrix_appservice.state_store import StateStore
+
+USERS = 100000
+MEMBERSHIPS = ("join", "join", "join", "invite", "leave")
+
+
+def generate(users, rooms, members):
+    """Generate (room, user, membership) tuples. Users are drawn from a shared pool, like
+    puppets and bridge users that are in many rooms."""
+    rand = random.Random(0)
+    for room in range(rooms):
+        room_id = f"!{room:018d}:example.com"
+        for user in rand.sample(users, members):
+            yield room_id, user, rand.choice(MEMBERSHIPS)
+
+
+class DictStateStore:
+    """The membership storage of the StateStore as it was before."""
+
+    def __init__(self):
+        self.memberships = {}
+
+    def get_membership(self, room, user):
+        return self.memberships.get(room, {}).get(user, "left")
+
+    def is_joined(self, room, user):
+        return self.get_membership(room, user) == "join"
+
+
+def fill_dicts(memberships):
+    store = DictStateStore()
+    for room, user, membership in memberships:
+        store.memberships.setdefault(room, {})[user] = membership
+    return store
+
+
+def fill_store(memberships):
+    store = StateStore()
+    for room, user, membership in memberships:
+        store._set_membership(room, user, membership)
+    return store
+
+
+def measure(label, fill, users, rooms, members):
+    tracemalloc.start()
+    start = perf_counter()
+    store = fill(generate(users, rooms, members))
+    duration = perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:16} {size / 1024 / 1024:8.1f} MiB, filled in {duration:5.1f} s "
+          f"(slowed down by tracemalloc)")
+    return store
+
+
+def main():
+    rooms = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    members = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    print(f"{rooms} rooms with {members} members each, drawn from {USERS} users")
+    print("(the user ID strings are shared, and not counted for either)")
+
+    users = [f"@telegram_{100000000 + index}:example.com" for index in range(USERS)]
+    sample = list(itertools.islice(generate(users, rooms, members), 0, None,
+                                   max(1, rooms * members // 100000)))
+
+    joined = [(room, user) for room, user, membership in sample if membership == "join"]
+    results = []
+    for label, fill in (("dict of dicts", fill_dicts), ("StateStore", fill_store)):
+        store = measure(label, fill, users, rooms, members)
+        start = perf_counter()
+        for room, user, _ in sample:
+            store.is_joined(room, user)
+        results.append((perf_counter() - start) / len(sample) * 1e9)
+        # Like the check before every send, which is repeated for users that are in the room.
+        start = perf_counter()
+        for room, user in joined:
+            store.is_joined(room, user)
+        results.append((perf_counter() - start) / len(joined) * 1e9)
+        del store
+
+    print(f"is_joined, first check:    {results[0]:6.0f} ns with dicts, "
+          f"{results[2]:6.0f} ns with the StateStore")
+    print(f"is_joined, joined again:   {results[1]:6.0f} ns with dicts, "
+          f"{results[3]:6.0f} ns with the StateStore")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# -*- coding: future_fstrings -*-
+# matrix-appservice-python - A Matrix Application Service framework written in Python.
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Measure what a single membership change costs to persist as the StateStore grows, with the
+change log and with a full rewrite of the state file per change.
+
+Run with ``python -m benchmarks.state_store_writes`` from the repository root.
+"""
+from time import perf_counter
+import asyncio
+import os
+import tempfile
+
+from mautrix_appservice.state_store import StateStore
+
+MEMBERS = 100
+SIZES = (100, 1000, 5000)
+CHANGES = 1000
+
+
+def create_store(loop, path, rooms):
+    store = StateStore(autosave_file=path, loop=loop)
+    for room in range(rooms):
+        for member in range(MEMBERS):
+            store._set_membership(f"!room{room}:example.com", f"@user{member}:example.com",
+                                  "join")
+    store.save(path)
+    return store
+
+
+def bench(loop, directory, rooms):
+    path = os.path.join(directory, f"mx-state-{rooms}.json")
+    store = create_store(loop, path, rooms)
+    size = os.path.getsize(path)
+
+    start = perf_counter()
+    for change in range(CHANGES):
+        store.set_membership(f"!room{change % rooms}:example.com",
+                             f"@new{change}:example.com", "join")
+    logged = (perf_counter() - start) / CHANGES
+
+    start = perf_counter()
+    store.flush()
+    snapshot = perf_counter() - start
+
+    # The old autosave rewrote the whole file on every change.
+    rewrites = 5
+    start = perf_counter()
+    for _ in range(rewrites):
+        store.save(path)
+    rewritten = (perf_counter() - start) / rewrites
+
+    print(f"{rooms:6} rooms, {size / 1024 / 1024:6.1f} MiB: "
+          f"{logged * 1e6:8.1f} us per change with the log, "
+          f"{rewritten * 1e6:10.0f} us per change with full rewrites, "
+          f"{snapshot * 1000:7.1f} ms per snapshot")
+
+
+def main():
+    loop = asyncio.new_event_loop()
+    print(f"{MEMBERS} members per room, {CHANGES} membership changes")
+    with tempfile.TemporaryDirectory() as directory:
+        for rooms in SIZES:
+            bench(loop, directory, rooms)
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
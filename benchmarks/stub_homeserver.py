@@ -0,0 +1,151 @@
+# -*- coding: future_fstrings -*-
+# matrix-appservice-python - A Matrix Application Service framework written in Python.
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from collections import Counter
+import asyncio
+import logging
+import multiprocessing
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+import aiohttp
+
+from mautrix_appservice.intent_api import HTTPAPI
+from mautrix_appservice.state_store import StateStore
+
+
+class StubHomeserver:
+    """A minimal client-server API that answers every request after a fixed delay.
+
+    State events that are sent are stored, and can be read back or set directly in ``state``.
+    """
+
+    def __init__(self, loop, latency=0.0):
+        self.loop = loop
+        self.latency = latency
+        self.requests = Counter()
+        self.state = {}
+
+        app = web.Application()
+        api = "/_matrix/client/r0"
+        app.router.add_post(f"{api}/register", self.register)
+        app.router.add_post(f"{api}/join/{{room}}", self.join)
+        app.router.add_put(f"{api}/rooms/{{room}}/send/{{type}}/{{txn}}", self.send)
+        app.router.add_get(f"{api}/rooms/{{room}}/state/{{type}}", self.get_state)
+        app.router.add_put(f"{api}/rooms/{{room}}/state/{{type}}", self.send_state)
+        self.server = TestServer(app, loop=loop)
+        self.unix_runner = web.AppRunner(app)
+
+    @property
+    def url(self):
+        return str(self.server.make_url("")).rstrip("/")
+
+    async def start(self):
+        await self.server.start_server(loop=self.loop)
+
+    async def start_unix(self, path):
+        """Also listen on a Unix socket."""
+        await self.unix_runner.setup()
+        await web.UnixSite(self.unix_runner, path).start()
+
+    async def close(self):
+        await self.unix_runner.cleanup()
+        await self.server.close()
+
+    async def _respond(self, name, content):
+        self.requests[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency, loop=self.loop)
+        return web.json_response(content)
+
+    def register(self, request):
+        return self._respond("register", {})
+
+    def join(self, request):
+        return self._respond("join", {"room_id": request.match_info["room"]})
+
+    def send(self, request):
+        return self._respond("send", {"event_id": "$event:example.com"})
+
+    async def get_state(self, request):
+        key = (request.match_info["room"], request.match_info["type"])
+        if key not in self.state:
+            self.requests["get_state"] += 1
+            return web.json_response({"errcode": "M_NOT_FOUND", "error": "Event not found"},
+                                     status=404)
+        return await self._respond("get_state", self.state[key])
+
+    async def send_state(self, request):
+        self.state[(request.match_info["room"], request.match_info["type"])] = (
+            await request.json())
+        return await self._respond("send", {"event_id": "$event:example.com"})
+
+
+def _serve(connection, latency, unix_socket):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    homeserver = StubHomeserver(loop, latency)
+    loop.run_until_complete(homeserver.start())
+    if unix_socket:
+        loop.run_until_complete(homeserver.start_unix(unix_socket))
+
+    def handle_command():
+        if connection.recv() == "stop":
+            loop.stop()
+        else:
+            connection.send(dict(homeserver.requests))
+
+    loop.add_reader(connection.fileno(), handle_command)
+    connection.send(homeserver.url)
+    loop.run_forever()
+    loop.run_until_complete(homeserver.close())
+    loop.close()
+
+
+class StubHomeserverProcess:
+    """A :class:`StubHomeserver` running in a child process, so that it doesn't compete with the
+    code being measured for the event loop."""
+
+    def __init__(self, latency=0.0, unix_socket=None):
+        self.latency = latency
+        self.unix_socket = unix_socket
+        self.url = None
+        self._connection, child_connection = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_serve, daemon=True,
+                                                args=(child_connection, latency, unix_socket))
+
+    def start(self):
+        self._process.start()
+        self.url = self._connection.recv()
+
+    @property
+    def requests(self):
+        self._connection.send("requests")
+        return Counter(self._connection.recv())
+
+    def stop(self):
+        self._connection.send("stop")
+        self._process.join()
+
+
+def create_api(loop, homeserver, connector=None, state_store=None):
+    """Create a bot HTTPAPI for the stub homeserver with a registered bot."""
+    session = aiohttp.ClientSession(connector=connector, loop=loop)
+    state_store = state_store or StateStore()
+    state_store.registered("@bot:example.com")
+    return HTTPAPI(base_url=homeserver.url, domain="example.com", bot_mxid="@bot:example.com",
+                   token="as_token", log=logging.getLogger("benchmark"),
+                   state_store=state_store, client_session=session)
@@ -0,0 +1,84 @@
+# -*- coding: future_fstrings -*-
+# matrix-appservice-python - A Matrix Application Service framework written in Python.
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Measure the duplicate check and bookkeeping done for every appservice transaction, as the
+number of handled transactions grows.
+
+Run with ``python -m benchmarks.transaction_store [transactions]`` from the repository root.
+"""
+from time import perf_counter
+import os
+import sys
+import tempfile
+
+from mautrix_appservice.transaction_store import TransactionStore
+
+MAX_SIZE = 10000
+WINDOWS = 10
+# The list gets slower with every transaction, so it's only run for a few.
+LIST_TRANSACTIONS = 60000
+
+
+def handle(transactions, transaction_id):
+    if transaction_id in transactions:
+        return
+    transactions.add(transaction_id)
+
+
+def handle_list(transactions, transaction_id):
+    # The unbounded list that was used before the TransactionStore.
+    if transaction_id in transactions:
+        return
+    transactions.append(transaction_id)
+
+
+def bench(label, transactions, handler, count):
+    window_size = count // WINDOWS
+    costs = []
+    for window in range(WINDOWS):
+        start = perf_counter()
+        for index in range(window * window_size, (window + 1) * window_size):
+            handler(transactions, f"m{index}.{index}")
+        costs.append((perf_counter() - start) / window_size * 1e6)
+    print(f"{label}, {count} transactions:")
+    print("    " + " ".join(f"{cost:6.1f}" for cost in costs) + " us per transaction")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    print(f"Cost per transaction in {WINDOWS} consecutive windows")
+    bench("list, no persistence", [], handle_list, min(count, LIST_TRANSACTIONS))
+    bench(f"TransactionStore({MAX_SIZE}), no persistence", TransactionStore(MAX_SIZE), handle,
+          count)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "mx-transactions.txt")
+        store = TransactionStore(MAX_SIZE, autosave_file=path)
+        bench(f"TransactionStore({MAX_SIZE}), autosaved", store, handle, count)
+        store.close()
+        with open(path) as file:
+            lines = sum(1 for _ in file)
+        print(f"Autosave file after {count} transactions: {lines} lines")
+
+        start = perf_counter()
+        loaded = TransactionStore(MAX_SIZE, autosave_file=path)
+        loaded.load(path)
+        print(f"Loading it: {(perf_counter() - start) * 1000:.1f} ms, {len(loaded)} IDs")
+        assert list(loaded._transactions) == list(store._transactions)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,8 @@
 from .appservice import AppService
 from .errors import MatrixError, MatrixRequestError, IntentError
+from .state_store import StateStore
+from .send_queue import RoomSendQueue
+from .dispatcher import OrderedDispatcher
 
 __version__ = "0.1.0"
 __author__ = "Tulir Asokan <tulir@maunium.net>"
@@ -22,30 +22,59 @@ import aiohttp
 import asyncio
 import logging
 
+from . import codec
+from .dispatcher import OrderedDispatcher
 from .intent_api import HTTPAPI
+from .journal import TransactionJournal
+from .metrics import Metrics
+from .rate_limit import RateLimiter
 from .state_store import StateStore
+from .transaction_store import TransactionStore
 
 
 class AppService:
     def __init__(self, server, domain, as_token, hs_token, bot_localpart, loop=None, log=None,
-                 query_user=None, query_alias=None):
+                 query_user=None, query_alias=None, max_transactions=10000,
+                 max_concurrent_events=32, max_room_queue_size=1000, max_queued_events=10000,
+                 event_retry_after_ms=1000, journal_file=None, state_store=None,
+                 member_list_max_age=None, request_rate=None, request_burst=20,
+                 global_request_rate=None, global_request_burst=200, connection_limit=100,
+                 connection_limit_per_host=0, keepalive_timeout=15, dns_cache_ttl=10,
+                 unix_socket=None, send_retry_count=5, send_retry_delay=1,
+                 send_retry_max_delay=60, max_retrying_sends_per_room=1, metrics_path=None):
         self.server = server
         self.domain = domain
         self.as_token = as_token
         self.hs_token = hs_token
         self.bot_mxid = f"@{bot_localpart}:{domain}"
-        self.state_store = StateStore(autosave_file="mx-state.json")
-        self.state_store.load("mx-state.json")
-
-        self.transactions = []
-
-        self._http_session = None
-        self._intent = None
 
         self.loop = loop or asyncio.get_event_loop()
         self.log = (logging.getLogger(log) if isinstance(log, str)
                     else log or logging.getLogger("mautrix_appservice"))
 
+        if state_store:
+            self.state_store = state_store
+        else:
+            self.state_store = StateStore(autosave_file="mx-state.json", loop=self.loop,
+                                          member_list_max_age=member_list_max_age)
+            self.state_store.load("mx-state.json")
+
+        self.transactions = TransactionStore(max_size=max_transactions,
+                                             autosave_file="mx-transactions.txt")
+        self.transactions.load("mx-transactions.txt")
+
+        self._http_session = None
+        self._intent = None
+        self.connection_limit = connection_limit
+        self.connection_limit_per_host = connection_limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.unix_socket = unix_socket
+        self.send_retry_count = send_retry_count
+        self.send_retry_delay = send_retry_delay
+        self.send_retry_max_delay = send_retry_max_delay
+        self.max_retrying_sends_per_room = max_retrying_sends_per_room
+
         async def default_query_handler(_):
             return None
 
@@ -53,14 +82,43 @@ class AppService:
         self.query_alias = query_alias or default_query_handler
 
         self.event_handlers = []
+        self._event_handlers_by_type = {}
+        self.event_dispatcher = OrderedDispatcher(self.loop, self.log,
+                                                  max_concurrency=max_concurrent_events,
+                                                  max_queue_size=max_room_queue_size,
+                                                  max_total=max_queued_events)
+        self.event_retry_after_ms = event_retry_after_ms
+        self.journal = (TransactionJournal(journal_file, self.loop, self.log.getChild("journal"))
+                        if journal_file else None)
+        self._journal_remaining = {}
+
+        self.metrics = Metrics()
+        self.metrics.gauge("appservice_queued_events",
+                           "Matrix events that are queued or being handled",
+                           func=lambda: self.event_dispatcher.total)
+        self.metrics.gauge("appservice_queued_events_limit",
+                           "Maximum number of queued Matrix events",
+                           func=lambda: self.event_dispatcher.max_total)
+        self._transaction_counter = self.metrics.counter(
+            "appservice_transactions_total", "Transactions received from the homeserver",
+            ("result",))
+        self._event_counter = self.metrics.counter(
+            "appservice_events_total", "Matrix events received from the homeserver", ("result",))
+
+        self.rate_limiter = RateLimiter(self.loop, request_rate, request_burst,
+                                        global_request_rate, global_request_burst,
+                                        metrics=self.metrics)
 
         self.app = web.Application(loop=self.loop)
         self.app.router.add_route("PUT", "/transactions/{transaction_id}",
                                   self._http_handle_transaction)
         self.app.router.add_route("GET", "/rooms/{alias}", self._http_query_alias)
         self.app.router.add_route("GET", "/users/{user_id}", self._http_query_user)
+        if metrics_path:
+            self.app.router.add_route("GET", metrics_path, self._http_metrics)
 
-        self.matrix_event_handler(self.update_state_store)
+        self.matrix_event_handler(self.update_state_store,
+                                  event_types=("m.room.power_levels", "m.room.member"))
 
     @property
     def http_session(self):
@@ -78,18 +136,60 @@ class AppService:
         else:
             return self._intent
 
+    def _create_connector(self):
+        if self.unix_socket:
+            return aiohttp.UnixConnector(self.unix_socket, limit=self.connection_limit,
+                                         limit_per_host=self.connection_limit_per_host,
+                                         keepalive_timeout=self.keepalive_timeout,
+                                         loop=self.loop)
+        return aiohttp.TCPConnector(limit=self.connection_limit,
+                                    limit_per_host=self.connection_limit_per_host,
+                                    keepalive_timeout=self.keepalive_timeout,
+                                    use_dns_cache=True, ttl_dns_cache=self.dns_cache_ttl,
+                                    loop=self.loop)
+
     @contextmanager
     def run(self, host="127.0.0.1", port=8080):
-        self._http_session = aiohttp.ClientSession(loop=self.loop)
+        self._http_session = aiohttp.ClientSession(connector=self._create_connector(),
+                                                   loop=self.loop)
         self._intent = HTTPAPI(base_url=self.server, domain=self.domain, bot_mxid=self.bot_mxid,
                                token=self.as_token, log=self.log, state_store=self.state_store,
-                               client_session=self._http_session).bot_intent()
+                               client_session=self._http_session,
+                               rate_limiter=self.rate_limiter,
+                               metrics=self.metrics, send_retry_count=self.send_retry_count,
+                               send_retry_delay=self.send_retry_delay,
+                               send_retry_max_delay=self.send_retry_max_delay,
+                               max_retrying_sends_per_room=self.max_retrying_sends_per_room
+                               ).bot_intent()
 
-        yield self.loop.create_server(self.app.make_handler(), host, port)
-
-        self._intent = None
-        self._http_session.close()
-        self._http_session = None
+        try:
+            yield self._start(host, port)
+        finally:
+            # The bridge exits with sys.exit() inside the with block, so this has to run when
+            # an exception is thrown in here too.
+            self._intent = None
+            self._http_session.close()
+            self._http_session = None
+            self.transactions.close()
+            self.state_store.flush()
+            if self.journal:
+                self.journal.close()
+
+    async def _start(self, host, port):
+        if self.journal:
+            unhandled = self.journal.load()
+            self.journal.open()
+            if unhandled:
+                self.log.info(f"Replaying {len(unhandled)} unhandled transactions from journal")
+            for transaction_id, events in unhandled:
+                self.transactions.add(transaction_id)
+                routed_events = self._route_matrix_events(events)
+                if routed_events:
+                    self._handle_transaction_events(transaction_id, routed_events)
+                else:
+                    # The handlers that wanted these events are gone.
+                    self.journal.mark_done(transaction_id)
+        return await self.loop.create_server(self.app.make_handler(), host, port)
 
     def _check_token(self, request):
         try:
@@ -102,11 +202,14 @@ class AppService:
 
         return True
 
+    async def _http_metrics(self, _):
+        return web.Response(text=self.metrics.render(), content_type="text/plain")
+
     async def _http_query_user(self, request):
         if not self._check_token(request):
             return web.Response(status=401)
 
-        user_id = request.match_info["userId"]
+        user_id = request.match_info["user_id"]
 
         try:
             response = await self.query_user(user_id)
@@ -116,7 +219,7 @@ class AppService:
 
         if not response:
             return web.Response(status=404)
-        return web.json_response(response)
+        return web.json_response(response, dumps=codec.dumps)
 
     async def _http_query_alias(self, request):
         if not self._check_token(request):
@@ -132,7 +235,7 @@ class AppService:
 
         if not response:
             return web.Response(status=404)
-        return web.json_response(response)
+        return web.json_response(response, dumps=codec.dumps)
 
     async def _http_handle_transaction(self, request):
         if not self._check_token(request):
@@ -140,19 +243,44 @@ class AppService:
 
         transaction_id = request.match_info["transaction_id"]
         if transaction_id in self.transactions:
+            self._transaction_counter.inc(result="duplicate")
             return web.Response(status=200)
 
-        json = await request.json()
+        json = await request.json(loads=codec.loads)
 
         try:
             events = json["events"]
         except KeyError:
             return web.Response(status=400)
 
-        for event in events:
-            self.handle_matrix_event(event)
+        routed_events = self._route_matrix_events(events)
+        reservation = self.event_dispatcher.reserve(event.get("room_id")
+                                                    for event, _ in routed_events)
+        if reservation is None:
+            self.log.warning(f"Event queue full, asking homeserver to retry {transaction_id}")
+            self._transaction_counter.inc(result="rejected")
+            self._event_counter.inc(len(routed_events), result="rejected")
+            return web.json_response({
+                "errcode": "M_LIMIT_EXCEEDED",
+                "error": "Too many events queued",
+                "retry_after_ms": self.event_retry_after_ms,
+            }, status=429, dumps=codec.dumps, headers={
+                "Retry-After": str(max(1, self.event_retry_after_ms // 1000)),
+            })
 
-        self.transactions.append(transaction_id)
+        try:
+            if self.journal and routed_events:
+                await self.journal.append(transaction_id, [event for event, _ in routed_events])
+        finally:
+            # Other transactions can arrive while the journal is written, so the room for these
+            # events is kept reserved until they're submitted.
+            self.event_dispatcher.release(reservation)
+        self._handle_transaction_events(transaction_id, routed_events)
+
+        self.transactions.add(transaction_id)
+        self._transaction_counter.inc(result="accepted")
+        self._event_counter.inc(len(routed_events), result="accepted")
+        self._event_counter.inc(len(events) - len(routed_events), result="ignored")
 
         return web.json_response({})
 
@@ -164,16 +292,80 @@ class AppService:
             self.state_store.set_membership(event["room_id"], event["state_key"],
                                             event["content"]["membership"])
 
-    def handle_matrix_event(self, event):
-        async def try_handle(handler):
+    async def _try_handle_matrix_event(self, event, handlers):
+        for handler in handlers:
             try:
                 await handler(event)
             except Exception:
                 self.log.exception("Exception in Matrix event handler")
 
-        for handler in self.event_handlers:
-            asyncio.ensure_future(try_handle(handler), loop=self.loop)
+    async def _try_handle_journaled_event(self, event, handlers, transaction_id):
+        try:
+            await self._try_handle_matrix_event(event, handlers)
+        finally:
+            self._journal_remaining[transaction_id] -= 1
+            if self._journal_remaining[transaction_id] == 0:
+                del self._journal_remaining[transaction_id]
+                self.journal.mark_done(transaction_id)
+
+    def _handle_transaction_events(self, transaction_id, routed_events):
+        if not self.journal:
+            for event, handlers in routed_events:
+                self.event_dispatcher.submit(event.get("room_id"), self._try_handle_matrix_event,
+                                             event, handlers)
+            return
+        elif not routed_events:
+            # Transactions with nothing to handle aren't journaled.
+            return
+
+        self._journal_remaining[transaction_id] = len(routed_events)
+        for event, handlers in routed_events:
+            self.event_dispatcher.submit(event.get("room_id"), self._try_handle_journaled_event,
+                                         event, handlers, transaction_id)
+
+    def _get_matrix_event_handlers(self, event_type):
+        try:
+            return self._event_handlers_by_type[event_type]
+        except KeyError:
+            handlers = [(func, event_filter)
+                        for func, event_types, event_filter in self.event_handlers
+                        if event_types is None or event_type in event_types]
+            self._event_handlers_by_type[event_type] = handlers
+            return handlers
+
+    def _route_matrix_event(self, event):
+        return [func for func, event_filter in self._get_matrix_event_handlers(event.get("type"))
+                if not event_filter or not event_filter(event)]
+
+    def _route_matrix_events(self, events):
+        routed_events = []
+        for event in events:
+            handlers = self._route_matrix_event(event)
+            if handlers:
+                routed_events.append((event, handlers))
+        return routed_events
+
+    def handle_matrix_event(self, event):
+        # Events are handled in order within each room, and handlers for the same event run one
+        # after another, so e.g. the state store is always updated before the bridge sees it.
+        handlers = self._route_matrix_event(event)
+        if not handlers:
+            return False
+        self.event_dispatcher.submit(event.get("room_id"), self._try_handle_matrix_event, event,
+                                     handlers)
+        return True
 
-    def matrix_event_handler(self, func):
-        self.event_handlers.append(func)
+    def matrix_event_handler(self, func=None, *, event_types=None, event_filter=None):
+        """Register a Matrix event handler. Can also be used as a decorator.
+
+        If ``event_types`` is given, the handler is only called for events of those types. If
+        ``event_filter`` is given, it is called with the event before dispatching, and the handler
+        is skipped if it returns True. Events that no handler wants are never queued.
+        """
+        if func is None:
+            return lambda handler: self.matrix_event_handler(handler, event_types=event_types,
+                                                             event_filter=event_filter)
+        event_types = frozenset(event_types) if event_types is not None else None
+        self.event_handlers.append((func, event_types, event_filter))
+        self._event_handlers_by_type = {}
         return func
@@ -0,0 +1,76 @@
+# -*- coding: future_fstrings -*-
+# matrix-appservice-python - A Matrix Application Service framework written in Python.
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""JSON encoding and decoding using the fastest available library.
+
+orjson is preferred, then ujson, then the standard library json module. The optional libraries
+are stricter than the standard library (e.g. about integer sizes), so anything they refuse is
+passed to the standard library instead of failing. orjson doesn't refuse integers outside the
+64-bit range when decoding, but silently turns them into floats, so documents with 19 or more
+digits in a row are decoded with the standard library instead.
+"""
+import json
+
+try:
+    import orjson
+
+    backend = "orjson"
+
+    def dumps(data):
+        try:
+            return orjson.dumps(data).decode("utf-8")
+        except TypeError:
+            return json.dumps(data)
+
+    # Maps digits to "0" and everything else to a space, so that runs of digits can be found
+    # with a substring search, which is much faster than a regex.
+    _digit_table = bytes(ord("0") if ord("0") <= byte <= ord("9") else ord(" ")
+                         for byte in range(256))
+    _long_number = b"0" * 19
+
+    def _has_long_number(data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        return _long_number in data.translate(_digit_table)
+
+    def loads(data):
+        if not _has_long_number(data):
+            try:
+                return orjson.loads(data)
+            except ValueError:
+                pass
+        return json.loads(data)
+except ImportError:
+    try:
+        import ujson
+
+        backend = "ujson"
+
+        def dumps(data):
+            try:
+                return ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False)
+            except (TypeError, OverflowError):
+                return json.dumps(data)
+
+        def loads(data):
+            try:
+                return ujson.loads(data)
+            except ValueError:
+                return json.loads(data)
+    except ImportError:
+        backend = "json"
+        dumps = json.dumps
+        loads = json.loads
@@ -0,0 +1,89 @@
+# -*- coding: future_fstrings -*-
+# matrix-appservice-python - A Matrix Application Service framework written in Python.
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from collections import Counter, deque
+import asyncio
+
+
+class OrderedDispatcher:
+    """Runs submitted coroutine functions in FIFO order per key.
+
+    Each key with queued work gets its own worker task, so work for different keys runs in
+    parallel, but at most ``max_concurrency`` items run at the same time. ``reserve`` can be used
+    to refuse work before the queues grow past ``max_queue_size`` items per key or ``max_total``
+    items (queued or running) in total. A batch that is larger than the limits is let in once the
+    queues it would be added to are empty, so that it isn't refused forever.
+    """
+
+    def __init__(self, loop, log, max_concurrency=32, max_queue_size=1000, max_total=10000):
+        self.loop = loop
+        self.log = log
+        self.max_queue_size = max_queue_size
+        self.max_total = max_total
+
+        self.queues = {}
+        self.total = 0
+        self._reserved = Counter()
+        self._reserved_total = 0
+        self._semaphore = asyncio.Semaphore(max_concurrency, loop=loop)
+
+    def reserve(self, keys):
+        """Reserve room for items with the given keys.
+
+        Returns the reservation, or ``None`` if there's no room. The reserved room counts towards
+        the limits until it's given back with :meth:`release`, which should be done right before
+        submitting the items.
+        """
+        keys = Counter(keys)
+        for key, count in keys.items():
+            queued = len(self.queues.get(key, ())) + self._reserved[key]
+            if queued and queued + count > self.max_queue_size:
+                return None
+        total = self.total + self._reserved_total
+        if total and total + sum(keys.values()) > self.max_total:
+            return None
+        self._reserved.update(keys)
+        self._reserved_total += sum(keys.values())
+        return keys
+
+    def release(self, reservation):
+        self._reserved.subtract(reservation)
+        self._reserved_total -= sum(reservation.values())
+        for key in reservation:
+            if self._reserved[key] <= 0:
+                del self._reserved[key]
+
+    def submit(self, key, func, *args):
+        self.total += 1
+        try:
+            self.queues[key].append((func, args))
+        except KeyError:
+            queue = deque(((func, args),))
+            self.queues[key] = queue
+            asyncio.ensure_future(self._run(key, queue), loop=self.loop)
+
+    async def _run(self, key, queue):
+        while queue:
+            func, args = queue[0]
+            try:
+                async with self._semaphore:
+                    await func(*args)
+            except Exception:
+                self.log.exception(f"Exception in dispatched task for {key}")
+            finally:
+                queue.popleft()
+                self.total -= 1
+        del self.queues[key]
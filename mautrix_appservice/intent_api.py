@@ -14,21 +14,145 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
-from urllib.parse import quote
-from time import time
+from urllib.parse import quote, unquote
+from copy import deepcopy
+from time import time, monotonic
 from json.decoder import JSONDecodeError
-from aiohttp.client_exceptions import ContentTypeError
+from aiohttp.client_exceptions import ContentTypeError, ClientConnectionError
+import weakref
+import random
 import re
-import json
+import io
 import magic
+import aiohttp
 import asyncio
 
+from . import codec
 from .errors import MatrixError, MatrixRequestError, IntentError
 
 
+# How much of a file is read for detecting its MIME type.
+SNIFF_SIZE = 8 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+@aiohttp.streamer
+async def _stream_sender(writer, data, head=b"", start=None):
+    if start is not None:
+        # Seekable files are rewound, so that the request body can be sent again on retries.
+        data.seek(start)
+    else:
+        await writer.write(head)
+    if hasattr(data, "read"):
+        chunk = data.read(CHUNK_SIZE)
+        while chunk:
+            await writer.write(chunk)
+            chunk = data.read(CHUNK_SIZE)
+    else:
+        async for chunk in data:
+            await writer.write(chunk)
+
+
+class MediaDownload:
+    """An async iterator over the chunks of a media repository download.
+
+    The response is released when the iterator is exhausted. Call :meth:`close` to stop
+    reading early.
+    """
+
+    def __init__(self, response, chunk_size=CHUNK_SIZE):
+        self.response = response
+        self.chunk_size = chunk_size
+        self.content_type = response.content_type
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            chunk = await self.response.content.read(self.chunk_size)
+        except Exception:
+            self.close()
+            raise
+        if not chunk:
+            self.response.release()
+            raise StopAsyncIteration
+        return chunk
+
+    def close(self):
+        self.response.close()
+
+
+# Path segments that are followed by variable segments, and what to replace those with in
+# metric labels.
+_PATH_PARAMETERS = {
+    "rooms": ("{room}",),
+    "send": ("{type}", "{txn}"),
+    "state": ("{type}", "{key}"),
+    "redact": ("{event}", "{txn}"),
+    "event": ("{event}",),
+    "receipt": ("{type}", "{event}"),
+    "typing": ("{user}",),
+    "presence": ("{user}",),
+    "profile": ("{user}",),
+    "user": ("{user}",),
+    "join": ("{room}",),
+}
+_SIGIL_PARAMETERS = {
+    "!": "{room}",
+    "@": "{user}",
+    "#": "{alias}",
+    "$": "{event}",
+}
+
+
+def normalize_path(path):
+    """Replace the IDs in a Matrix API path with placeholders,
+    e.g. ``/rooms/!foo:example.com/send/m.room.message/123`` to
+    ``/rooms/{room}/send/{type}/{txn}``."""
+    segments = path.split("/")
+    parameters = ()
+    for index, segment in enumerate(segments):
+        if parameters:
+            segments[index], parameters = parameters[0], parameters[1:]
+            continue
+        segment = unquote(segment)
+        if segment[:1] in _SIGIL_PARAMETERS:
+            segments[index] = _SIGIL_PARAMETERS[segment[:1]]
+        else:
+            parameters = _PATH_PARAMETERS.get(segment, ())
+    return "/".join(segments)
+
+
+class RequestMetrics:
+    def __init__(self, metrics):
+        labels = ("method", "endpoint", "intent")
+        self.duration = metrics.histogram("appservice_homeserver_request_duration_seconds",
+                                          "Time taken by requests to the homeserver", labels)
+        self.requests = metrics.counter("appservice_homeserver_requests_total",
+                                        "Requests to the homeserver by response status",
+                                        labels + ("status",))
+        self.sent_bytes = metrics.counter("appservice_homeserver_request_bytes_total",
+                                          "Request body bytes sent to the homeserver", labels)
+        self.received_bytes = metrics.counter("appservice_homeserver_response_bytes_total",
+                                              "Response body bytes received from the homeserver",
+                                              labels)
+
+    def record(self, method, endpoint, intent, status, duration, sent, received):
+        labels = {"method": method, "endpoint": endpoint, "intent": intent}
+        self.duration.observe(duration, **labels)
+        self.requests.inc(status=status, **labels)
+        if sent:
+            self.sent_bytes.inc(sent, **labels)
+        if received:
+            self.received_bytes.inc(received, **labels)
+
+
 class HTTPAPI:
     def __init__(self, base_url, domain=None, bot_mxid=None, token=None, identity=None, log=None,
-                 state_store=None, client_session=None, child=False):
+                 state_store=None, client_session=None, child=False, rate_limiter=None,
+                 metrics=None, send_retry_count=5, send_retry_delay=1, send_retry_max_delay=60,
+                 max_retrying_sends_per_room=1):
         self.base_url = base_url
         self.token = token
         self.identity = identity
@@ -39,6 +163,11 @@ class HTTPAPI:
         self.bot_mxid = bot_mxid
         self._bot_intent = None
         self.state_store = state_store
+        self.rate_limiter = rate_limiter
+        self.send_retry_count = send_retry_count
+        self.send_retry_delay = send_retry_delay
+        self.send_retry_max_delay = send_retry_max_delay
+        self.max_retrying_sends_per_room = max_retrying_sends_per_room
 
         if child:
             self.log = log
@@ -47,6 +176,15 @@ class HTTPAPI:
             self.log = log.getChild("api")
             self.txn_id = 0
             self.children = {}
+            self.power_level_locks = weakref.WeakValueDictionary()
+            self.inflight_requests = {}
+            self.inflight_ensures = {}
+            self.retry_semaphores = weakref.WeakValueDictionary()
+            self.request_metrics = RequestMetrics(metrics) if metrics else None
+            self.coalesce_counter = metrics.counter(
+                "appservice_coalesced_requests_total",
+                "GET requests to the homeserver by whether they joined an identical request "
+                "that was already in flight", ("result",)) if metrics else None
 
     def user(self, user):
         try:
@@ -65,36 +203,73 @@ class HTTPAPI:
         return IntentAPI(user, self.user(user), self.bot_intent(), self.state_store,
                          self.intent_log)
 
-    async def _send(self, method, endpoint, content, query_params, headers):
+    @staticmethod
+    def _get_content_size(content, headers):
+        if isinstance(content, str):
+            return len(content.encode("utf-8"))
+        elif isinstance(content, (bytes, bytearray)):
+            return len(content)
+        return int(headers.get("Content-Length", 0))
+
+    async def _send(self, method, endpoint, content, query_params, headers, path_template=None,
+                    retry_rate_limited=True):
         while True:
+            if self.rate_limiter:
+                await self.rate_limiter.acquire(self.identity)
             query_params["access_token"] = self.token
             request = self.session.request(method, endpoint, params=query_params,
                                            data=content, headers=headers)
-            async with request as response:
-                if response.status < 200 or response.status >= 300:
+            start = monotonic()
+            status, received = "error", 0
+            try:
+                async with request as response:
+                    body = await response.read()
+                    status, received = response.status, len(body)
+                    if 200 <= response.status < 300:
+                        if self.rate_limiter:
+                            self.rate_limiter.succeeded(self.identity)
+                        return await response.json(loads=codec.loads)
+
                     errcode = message = None
+                    response_data = {}
                     try:
-                        response_data = await response.json()
+                        response_data = await response.json(loads=codec.loads)
                         errcode = response_data["errcode"]
                         message = response_data["error"]
                     except (JSONDecodeError, ContentTypeError, KeyError):
                         pass
-                    raise MatrixRequestError(code=response.status, text=await response.text(),
-                                             errcode=errcode, message=message)
-
-                if response.status == 429:
-                    await asyncio.sleep(response.json()["retry_after_ms"] / 1000)
-                else:
-                    return await response.json()
+                    if response.status != 429 or not retry_rate_limited:
+                        raise MatrixRequestError(code=response.status,
+                                                 text=await response.text(),
+                                                 errcode=errcode, message=message)
+            finally:
+                if self.request_metrics:
+                    self.request_metrics.record(method, path_template,
+                                                "puppet" if self.identity else "bot", status,
+                                                monotonic() - start,
+                                                self._get_content_size(content, headers),
+                                                received)
+
+            retry_after = response_data.get("retry_after_ms", 1000) / 1000
+            self.log.debug(f"Rate limited as {self.identity}, retrying in {retry_after} seconds")
+            if self.rate_limiter:
+                await self.rate_limiter.rate_limited(self.identity, retry_after)
+            else:
+                await asyncio.sleep(retry_after)
 
     def _log_request(self, method, path, content, query_params):
-        log_content = content if not isinstance(content, bytes) else f"<{len(content)} bytes>"
+        if isinstance(content, (bytes, bytearray)):
+            log_content = f"<{len(content)} bytes>"
+        elif not isinstance(content, str):
+            log_content = "<stream>"
+        else:
+            log_content = content
         log_content = log_content or "(No content)"
         query_identity = query_params["user_id"] if "user_id" in query_params else "No identity"
         self.log.debug("%s %s %s as user %s", method, path, log_content, query_identity)
 
     def request(self, method, path, content=None, query_params=None, headers=None,
-                api_path="/_matrix/client/r0"):
+                api_path="/_matrix/client/r0", retry_rate_limited=True):
         content = content or {}
         query_params = query_params or {}
         headers = headers or {}
@@ -106,7 +281,7 @@ class HTTPAPI:
         if "Content-Type" not in headers:
             headers["Content-Type"] = "application/json"
         if headers["Content-Type"] == "application/json":
-            content = json.dumps(content)
+            content = codec.dumps(content)
 
         if self.identity:
             query_params["user_id"] = self.identity
@@ -114,7 +289,32 @@ class HTTPAPI:
         self._log_request(method, path, content, query_params)
 
         endpoint = self.base_url + api_path + path
-        return self._send(method, endpoint, content, query_params, headers or {})
+        path_template = api_path + normalize_path(path) if self.request_metrics else None
+        if method == "GET":
+            return self._send_coalesced(endpoint, content, query_params, headers, path_template)
+        return self._send(method, endpoint, content, query_params, headers, path_template,
+                          retry_rate_limited)
+
+    async def _send_coalesced(self, endpoint, content, query_params, headers, path_template):
+        key = (endpoint, tuple(sorted(query_params.items())))
+        try:
+            request = self.inflight_requests[key]
+            request[1] += 1
+            hit = True
+        except KeyError:
+            future = asyncio.ensure_future(self._send("GET", endpoint, content, query_params,
+                                                      headers, path_template),
+                                           loop=self.session.loop)
+            future.add_done_callback(lambda _: self.inflight_requests.pop(key, None))
+            request = self.inflight_requests[key] = [future, 1]
+            hit = False
+        if self.coalesce_counter:
+            self.coalesce_counter.inc(result="hit" if hit else "miss")
+
+        future = request[0]
+        result = await asyncio.shield(future, loop=self.session.loop)
+        # Every caller gets its own copy if the response was shared, since callers may modify it.
+        return deepcopy(result) if request[1] > 1 else result
 
     def get_download_url(self, mxcurl):
         if mxcurl.startswith('mxc://'):
@@ -147,8 +347,19 @@ class HTTPAPI:
 class ChildHTTPAPI(HTTPAPI):
     def __init__(self, user, parent):
         super().__init__(parent.base_url, parent.domain, parent.bot_mxid, parent.token, user,
-                         parent.log, parent.state_store, parent.session, child=True)
+                         parent.log, parent.state_store, parent.session, child=True,
+                         rate_limiter=parent.rate_limiter,
+                         send_retry_count=parent.send_retry_count,
+                         send_retry_delay=parent.send_retry_delay,
+                         send_retry_max_delay=parent.send_retry_max_delay,
+                         max_retrying_sends_per_room=parent.max_retrying_sends_per_room)
         self.parent = parent
+        self.inflight_requests = parent.inflight_requests
+        self.inflight_ensures = parent.inflight_ensures
+        self.retry_semaphores = parent.retry_semaphores
+        self.power_level_locks = parent.power_level_locks
+        self.request_metrics = parent.request_metrics
+        self.coalesce_counter = parent.coalesce_counter
 
     @property
     def txn_id(self):
@@ -210,12 +421,61 @@ class IntentAPI:
         content = {"avatar_url": url}
         return await self.client.request("PUT", f"/profile/{self.mxid}/avatar_url", content)
 
-    async def upload_file(self, data, mime_type=None):
+    @staticmethod
+    async def _read_head(data):
+        """Read the start of a file object or async iterable.
+
+        Returns the head and the object to read the rest from, which is an iterator for
+        async iterables.
+        """
+        if hasattr(data, "read"):
+            return data.read(SNIFF_SIZE), data
+        data = data.__aiter__()
+        head = b""
+        while len(head) < SNIFF_SIZE:
+            try:
+                head += await data.__anext__()
+            except StopAsyncIteration:
+                break
+        return head, data
+
+    async def upload_file(self, data, mime_type=None, size=None):
+        """Upload a file to the media repository.
+
+        ``data`` can be bytes, a binary file object or an async iterable of bytes. Files and
+        iterables are streamed rather than read into memory. The size of iterables and
+        non-regular files can't be detected, so ``size`` should be given for them, as homeservers
+        may require a Content-Length. Those can't be sent again either, so the upload fails with
+        a :class:`MatrixRequestError` instead of being retried if the homeserver rate limits it.
+        """
         await self.ensure_registered()
-        mime_type = mime_type or magic.from_buffer(data, mime=True)
-        return await self.client.request("POST", "", content=data,
-                                         headers={"Content-Type": mime_type},
-                                         api_path="/_matrix/media/r0/upload")
+        headers = {}
+        replayable = True
+        if isinstance(data, (bytes, bytearray)):
+            mime_type = mime_type or magic.from_buffer(bytes(data[:SNIFF_SIZE]), mime=True)
+        else:
+            start = None
+            if hasattr(data, "read"):
+                try:
+                    start = data.tell()
+                    # seek() doesn't return the position for every file object (e.g.
+                    # SpooledTemporaryFile before Python 3.7), so use tell() instead.
+                    data.seek(0, io.SEEK_END)
+                    end = data.tell()
+                    data.seek(start)
+                    size = end - start if size is None else size
+                except (OSError, io.UnsupportedOperation, AttributeError):
+                    start = None
+            head, data = await self._read_head(data)
+            mime_type = mime_type or magic.from_buffer(head, mime=True)
+            replayable = start is not None
+            data = _stream_sender(data, head, start)
+            if size is not None:
+                headers["Content-Length"] = str(size)
+        headers["Content-Type"] = mime_type
+        return await self.client.request("POST", "", content=data, headers=headers,
+                                         api_path="/_matrix/media/r0/upload",
+                                         retry_rate_limited=replayable)
 
     async def download_file(self, url):
         await self.ensure_registered()
@@ -223,6 +483,29 @@ class IntentAPI:
         async with self.client.session.get(url) as response:
             return await response.read()
 
+    async def iter_download(self, url, chunk_size=CHUNK_SIZE):
+        """Start downloading a file and return a :class:`MediaDownload` iterator over its
+        chunks."""
+        await self.ensure_registered()
+        url = self.client.get_download_url(url)
+        response = await self.client.session.get(url)
+        if response.status != 200:
+            try:
+                raise MatrixRequestError(code=response.status, text=await response.text())
+            finally:
+                response.release()
+        return MediaDownload(response, chunk_size)
+
+    async def download_file_to(self, url, output, chunk_size=CHUNK_SIZE):
+        """Download a file into a binary file object in chunks and return its MIME type."""
+        download = await self.iter_download(url, chunk_size)
+        try:
+            async for chunk in download:
+                output.write(chunk)
+        finally:
+            download.close()
+        return download.content_type
+
     # endregion
     # region Room actions
 
@@ -450,6 +733,52 @@ class IntentAPI:
             raise ValueError("Transaction ID not given")
         return f"/rooms/{quote(room_id)}/send/{quote(event_type)}/{quote(txn_id)}"
 
+    @staticmethod
+    def _is_retryable(error):
+        if isinstance(error, MatrixRequestError):
+            return error.code >= 500
+        return isinstance(error, (ClientConnectionError, asyncio.TimeoutError))
+
+    def _get_retry_semaphore(self, room_id):
+        try:
+            return self.client.retry_semaphores[room_id]
+        except KeyError:
+            semaphore = asyncio.Semaphore(self.client.max_retrying_sends_per_room,
+                                          loop=self.client.session.loop)
+            self.client.retry_semaphores[room_id] = semaphore
+            return semaphore
+
+    async def _send_with_retry(self, room_id, url, content):
+        """Send a PUT request, retrying transient failures with exponential backoff.
+
+        The request must be idempotent (e.g. include a transaction ID), as a failed attempt may
+        have reached the homeserver.
+        """
+        try:
+            return await self.client.request("PUT", url, content)
+        except (MatrixRequestError, ClientConnectionError, asyncio.TimeoutError) as e:
+            if not self._is_retryable(e) or self.client.send_retry_count <= 0:
+                raise
+            error = e
+
+        # Only a limited number of sends per room may be retrying at once, so that a broken
+        # room can't tie up everything else.
+        async with self._get_retry_semaphore(room_id):
+            for attempt in range(self.client.send_retry_count):
+                delay = min(self.client.send_retry_max_delay,
+                            self.client.send_retry_delay * 2 ** attempt)
+                delay *= random.uniform(0.5, 1)
+                self.log.warning(f"Request to {url} failed ({error}), "
+                                 f"retrying in {delay:.1f} seconds")
+                await asyncio.sleep(delay, loop=self.client.session.loop)
+                try:
+                    return await self.client.request("PUT", url, content)
+                except (MatrixRequestError, ClientConnectionError, asyncio.TimeoutError) as e:
+                    if not self._is_retryable(e):
+                        raise
+                    error = e
+        raise error
+
     async def send_event(self, room_id, event_type, content, txn_id=None):
         if not room_id:
             raise ValueError("Room ID not given")
@@ -463,7 +792,7 @@ class IntentAPI:
 
         url = self._get_event_url(room_id, event_type, txn_id)
 
-        return await self.client.request("PUT", url, content)
+        return await self._send_with_retry(room_id, url, content)
 
     @staticmethod
     def _get_state_url(room_id, event_type, state_key=""):
@@ -484,7 +813,7 @@ class IntentAPI:
         await self.ensure_joined(room_id)
         await self._ensure_has_power_level_for(room_id, event_type, is_state_event=True)
         url = self._get_state_url(room_id, event_type, state_key)
-        return await self.client.request("PUT", url, content)
+        return await self._send_with_retry(room_id, url, content)
 
     async def get_state_event(self, room_id, event_type, state_key=""):
         if not room_id:
@@ -520,8 +849,14 @@ class IntentAPI:
             raise ValueError("Room ID not given")
         return self.client.request("GET", f"/rooms/{quote(room_id)}/members")
 
-    async def get_room_members(self, room_id, allowed_memberships=("join",)):
+    async def get_room_members(self, room_id, allowed_memberships=("join",), ignore_cache=False):
+        if not ignore_cache and self.state_store.has_members(room_id):
+            return self.state_store.get_members(room_id, allowed_memberships)
         memberships = await self.get_room_memberships(room_id)
+        self.state_store.set_members(room_id, {
+            membership["state_key"]: membership["content"]["membership"]
+            for membership in memberships["chunk"]
+        })
         return [membership["state_key"] for membership in memberships["chunk"] if
                 membership["content"]["membership"] in allowed_memberships]
 
@@ -534,11 +869,25 @@ class IntentAPI:
     # endregion
     # region Ensure functions
 
+    async def _single_flight(self, key, func, *args):
+        """Run ``func``, or wait for the already running call with the same key."""
+        inflight = self.client.inflight_ensures
+        try:
+            future = inflight[key]
+        except KeyError:
+            future = asyncio.ensure_future(func(*args), loop=self.client.session.loop)
+            future.add_done_callback(lambda _: inflight.pop(key, None))
+            inflight[key] = future
+        return await asyncio.shield(future, loop=self.client.session.loop)
+
     async def ensure_joined(self, room_id, ignore_cache=False):
         if not room_id:
             raise ValueError("Room ID not given")
         if not ignore_cache and self.state_store.is_joined(room_id, self.mxid):
             return
+        await self._single_flight(("join", self.mxid, room_id), self._ensure_joined, room_id)
+
+    async def _ensure_joined(self, room_id):
         await self.ensure_registered()
         try:
             await self._join_room_direct(room_id)
@@ -561,6 +910,9 @@ class IntentAPI:
     async def ensure_registered(self):
         if self.state_store.is_registered(self.mxid):
             return
+        await self._single_flight(("register", self.mxid), self._ensure_registered)
+
+    async def _ensure_registered(self):
         try:
             await self._register()
         except MatrixRequestError as e:
@@ -570,6 +922,14 @@ class IntentAPI:
                 return
         self.state_store.registered(self.mxid)
 
+    def _get_power_level_lock(self, room_id):
+        try:
+            return self.client.power_level_locks[room_id]
+        except KeyError:
+            lock = asyncio.Lock(loop=self.client.session.loop)
+            self.client.power_level_locks[room_id] = lock
+            return lock
+
     async def _ensure_has_power_level_for(self, room_id, event_type, is_state_event=False):
         if not room_id:
             raise ValueError("Room ID not given")
@@ -587,6 +947,24 @@ class IntentAPI:
             # raise IntentError(f"Power level of {self.mxid} is not enough"
             #                   f"for {event_type} in {room_id}")
             return
-        # TODO implement
+
+        async with self._get_power_level_lock(room_id):
+            # Fetch the levels from the server rather than the state store: the whole content is
+            # sent back, so a stale copy would revert changes that haven't reached us yet.
+            levels = await self.bot.get_power_levels(room_id, ignore_cache=True)
+            required = self.state_store.get_event_power_level(room_id, event_type,
+                                                              is_state_event=is_state_event)
+            if self.state_store.get_user_power_level(room_id, self.mxid) >= required:
+                return
+            elif self.state_store.get_user_power_level(room_id, self.bot.mxid) < required:
+                self.log.warning(f"Power level of {self.mxid} is not enough for {event_type} in "
+                                 f"{room_id} and the bridge bot can't raise it")
+                return
+            levels = dict(levels, users=dict(levels.get("users", {})))
+            levels["users"][self.mxid] = required
+            try:
+                await self.bot.set_power_levels(room_id, levels)
+            except MatrixRequestError:
+                self.log.exception(f"Failed to raise power level of {self.mxid} in {room_id}")
 
     # endregion
@@ -0,0 +1,133 @@
+# -*- coding: future_fstrings -*-
+# matrix-appservice-python - A Matrix Application Service framework written in Python.
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from collections import OrderedDict
+import asyncio
+import os
+
+from . import codec
+
+
+class TransactionJournal:
+    """An append-only write-ahead log of received transactions.
+
+    Transactions are written to the journal before they're acknowledged, and a completion marker
+    is written once all their events have been handled. Writes that arrive within
+    ``commit_delay`` seconds of each other share a single fsync. When the journal grows past
+    ``compact_size`` bytes, it's rewritten with only the unhandled transactions.
+    """
+
+    def __init__(self, path, loop, log, commit_delay=0.005, compact_size=16 * 1024 * 1024):
+        self.path = path
+        self.loop = loop
+        self.log = log
+        self.commit_delay = commit_delay
+        self.compact_size = compact_size
+
+        self.pending = OrderedDict()
+        self._output = None
+        self._sync_task = None
+        # Sync groups can overlap, as a new group starts when a write arrives during a sync.
+        self._running_syncs = 0
+
+    def load(self):
+        unhandled = OrderedDict()
+        try:
+            input_source = open(self.path, "r")
+        except FileNotFoundError:
+            return []
+
+        with input_source:
+            for line in input_source:
+                try:
+                    entry = codec.loads(line)
+                except ValueError:
+                    # Most likely a partial write from a crash.
+                    self.log.warning("Skipping corrupted transaction journal entry")
+                    continue
+                if "done" in entry:
+                    unhandled.pop(entry["done"], None)
+                else:
+                    unhandled[entry["txn_id"]] = entry["events"]
+        self.pending = OrderedDict(unhandled)
+        return list(unhandled.items())
+
+    def open(self):
+        if not self._output:
+            self._output = open(self.path, "a")
+
+    def close(self):
+        if self._output:
+            self._output.close()
+            self._output = None
+
+    def _write(self, entry):
+        self._output.write(codec.dumps(entry))
+        self._output.write("\n")
+
+    async def append(self, transaction_id, events):
+        self._write({
+            "txn_id": transaction_id,
+            "events": events,
+        })
+        self.pending[transaction_id] = events
+        if not self._sync_task:
+            self._sync_task = asyncio.ensure_future(self._group_sync(), loop=self.loop)
+        try:
+            await asyncio.shield(self._sync_task, loop=self.loop)
+        except Exception:
+            # The homeserver will retry the transaction, so it mustn't be replayed from here.
+            self.mark_done(transaction_id)
+            raise
+
+    async def _group_sync(self):
+        await asyncio.sleep(self.commit_delay, loop=self.loop)
+        # Anything written after this point will be synced by the next group.
+        self._sync_task = None
+        self._running_syncs += 1
+        try:
+            self._output.flush()
+            await self.loop.run_in_executor(None, os.fsync, self._output.fileno())
+        finally:
+            self._running_syncs -= 1
+
+    def _compact(self):
+        temp_file = f"{self.path}.tmp"
+        with open(temp_file, "w") as output:
+            for transaction_id, events in self.pending.items():
+                output.write(codec.dumps({
+                    "txn_id": transaction_id,
+                    "events": events,
+                }))
+                output.write("\n")
+            output.flush()
+            os.fsync(output.fileno())
+        self._output.close()
+        os.replace(temp_file, self.path)
+        self._output = open(self.path, "a")
+
+    def mark_done(self, transaction_id):
+        if not self._output:
+            return
+        self.pending.pop(transaction_id, None)
+        self._write({"done": transaction_id})
+        # The file can't be replaced while it's being synced. Entries waiting for a scheduled sync
+        # are fine, as the compacted journal is synced before it replaces the old one.
+        if not self._running_syncs and self._output.tell() > self.compact_size:
+            try:
+                self._compact()
+            except OSError:
+                self.log.exception("Failed to compact transaction journal")
@@ -0,0 +1,153 @@
+# -*- coding: future_fstrings -*-
+# matrix-appservice-python - A Matrix Application Service framework written in Python.
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from collections import OrderedDict
+from bisect import bisect_left
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, OrderedDict(zip(self.label_names, key)), value
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name, description, label_names=(), func=None):
+        super().__init__(name, description, label_names)
+        self.func = func
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.func:
+            yield self.name, {}, self.func()
+        else:
+            yield from super().samples()
+
+
+class Histogram(Metric):
+    type = "histogram"
+    default_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, description, label_names=(), buckets=None):
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(sorted(buckets or self.default_buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        try:
+            bucket_counts, total = self._values[key]
+        except KeyError:
+            # The last bucket is +Inf
+            bucket_counts, total = [0] * (len(self.buckets) + 1), 0
+        bucket_counts[bisect_left(self.buckets, value)] += 1
+        self._values[key] = (bucket_counts, total + value)
+
+    def get(self, **labels):
+        try:
+            return sum(self._values[self._key(labels)][0])
+        except KeyError:
+            return 0
+
+    def samples(self):
+        for key, (bucket_counts, total) in self._values.items():
+            labels = OrderedDict(zip(self.label_names, key))
+            count = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), bucket_counts):
+                count += bucket_count
+                yield f"{self.name}_bucket", OrderedDict(labels, le=str(bound)), count
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+
+class Metrics:
+    """A registry of metrics that can be rendered in the Prometheus text format."""
+
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+        self.metrics = OrderedDict()
+
+    def _register(self, cls, name, *args, **kwargs):
+        name = self.prefix + name
+        try:
+            return self.metrics[name]
+        except KeyError:
+            metric = cls(name, *args, **kwargs)
+            self.metrics[name] = metric
+            return metric
+
+    def counter(self, name, description, label_names=()):
+        return self._register(Counter, name, description, label_names)
+
+    def gauge(self, name, description, label_names=(), func=None):
+        return self._register(Gauge, name, description, label_names, func=func)
+
+    def histogram(self, name, description, label_names=(), buckets=None):
+        return self._register(Histogram, name, description, label_names, buckets=buckets)
+
+    @staticmethod
+    def _escape_label_value(value):
+        return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    @classmethod
+    def _format_labels(cls, labels):
+        if not labels:
+            return ""
+        values = ",".join(f'{name}="{cls._escape_label_value(value)}"'
+                          for name, value in labels.items())
+        return "{" + values + "}"
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{self._format_labels(labels)} {value}")
+        lines.append("")
+        return "\n".join(lines)
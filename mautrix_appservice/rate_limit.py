@@ -0,0 +1,125 @@
+# -*- coding: future_fstrings -*-
+# matrix-appservice-python - A Matrix Application Service framework written in Python.
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from collections import OrderedDict
+import asyncio
+import time
+
+
+class TokenBucket:
+    """A token bucket whose rate is halved when the homeserver rate limits us and slowly
+    recovers back to ``max_rate`` as requests succeed."""
+    __slots__ = ("rate", "max_rate", "min_rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = self.max_rate = rate
+        self.min_rate = rate / 16
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Take a token and return how many seconds to wait before using it."""
+        self._refill()
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def penalize(self):
+        self._refill()
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = min(self.tokens, 0)
+
+    def recover(self):
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class RateLimiter:
+    """Paces outgoing requests with a token bucket per identity and a global one.
+
+    A rate of ``None`` or 0 disables that limit. Buckets for at most ``max_buckets`` identities
+    are kept, the least recently used ones are dropped first.
+    """
+
+    def __init__(self, loop, rate=None, burst=20, global_rate=None, global_burst=200,
+                 max_buckets=10000, metrics=None):
+        self.loop = loop
+        self.rate = rate
+        self.burst = burst
+        self.max_buckets = max_buckets
+        self.global_bucket = TokenBucket(global_rate, global_burst) if global_rate else None
+        self._buckets = OrderedDict()
+
+        self._throttle_counter = None
+        self._rate_limited_counter = None
+        if metrics:
+            self._throttle_counter = metrics.counter(
+                "appservice_request_throttle_seconds_total",
+                "Time requests to the homeserver spent waiting for the rate limiter or "
+                "after a rate limit error",
+                ("limit",))
+            self._rate_limited_counter = metrics.counter(
+                "appservice_requests_rate_limited_total",
+                "Requests to the homeserver that were rejected with HTTP 429")
+
+    def _bucket(self, identity):
+        try:
+            bucket = self._buckets[identity]
+            self._buckets.move_to_end(identity)
+        except KeyError:
+            bucket = self._buckets[identity] = TokenBucket(self.rate, self.burst)
+            if len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        return bucket
+
+    async def acquire(self, identity):
+        user_delay = self._bucket(identity).reserve() if self.rate else 0
+        global_delay = self.global_bucket.reserve() if self.global_bucket else 0
+        delay = max(user_delay, global_delay)
+        if delay > 0:
+            if self._throttle_counter:
+                limit = "user" if user_delay >= global_delay else "global"
+                self._throttle_counter.inc(delay, limit=limit)
+            await asyncio.sleep(delay, loop=self.loop)
+
+    async def rate_limited(self, identity, retry_after):
+        """Wait ``retry_after`` seconds after a rate limit error and slow down further requests.
+
+        Both the identity's bucket and the global one are slowed down, as the homeserver may
+        limit more than single users, e.g. the whole appservice or everything from our IP.
+        """
+        if self._rate_limited_counter:
+            self._rate_limited_counter.inc()
+        if self.rate:
+            self._bucket(identity).penalize()
+        if self.global_bucket:
+            self.global_bucket.penalize()
+        if self._throttle_counter:
+            self._throttle_counter.inc(retry_after, limit="homeserver")
+        await asyncio.sleep(retry_after, loop=self.loop)
+
+    def succeeded(self, identity):
+        if self.global_bucket:
+            self.global_bucket.recover()
+        try:
+            self._buckets[identity].recover()
+        except KeyError:
+            pass
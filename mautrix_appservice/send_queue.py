@@ -0,0 +1,71 @@
+# -*- coding: future_fstrings -*-
+# matrix-appservice-python - A Matrix Application Service framework written in Python.
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from time import monotonic
+import asyncio
+
+
+class RoomSendQueue:
+    """Prepares events for a room concurrently and sends them in the order they were queued."""
+
+    def __init__(self, loop, max_pending=4, depth_gauge=None, latency_histogram=None,
+                 prepare_semaphore=None):
+        self.loop = loop
+        self.prepare_semaphore = prepare_semaphore
+        self.depth = 0
+        self.depth_gauge = depth_gauge
+        self.latency_histogram = latency_histogram
+        self._semaphore = asyncio.Semaphore(max_pending, loop=loop)
+        self._previous = None
+
+    def enqueue(self, prepare):
+        """Queue a coroutine that returns a send function, and return a future of its result."""
+        task = asyncio.ensure_future(self._run(prepare, self._previous), loop=self.loop)
+        self._previous = task
+        self.depth += 1
+        if self.depth_gauge:
+            self.depth_gauge.inc()
+        return task
+
+    async def join(self):
+        """Wait until everything queued so far has been sent."""
+        if self._previous:
+            await asyncio.wait([self._previous], loop=self.loop)
+
+    async def _run(self, prepare, previous):
+        start = monotonic()
+        try:
+            try:
+                async with self._semaphore:
+                    if self.prepare_semaphore:
+                        async with self.prepare_semaphore:
+                            send = await prepare
+                    else:
+                        send = await prepare
+            finally:
+                # Later items only wait for this one, so it must not finish before the previous.
+                if previous:
+                    await asyncio.wait([previous], loop=self.loop)
+            if not send:
+                return None
+            result = await send()
+            if self.latency_histogram:
+                self.latency_histogram.observe(monotonic() - start)
+            return result
+        finally:
+            self.depth -= 1
+            if self.depth_gauge:
+                self.depth_gauge.dec()
@@ -14,22 +14,102 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from array import array
+from bisect import bisect_left
+import asyncio
 import json
+import logging
+import os
+import threading
 import time
 
+from . import codec
+
+
+class RoomMembers:
+    """The memberships of a single room.
+
+    Users and membership values are stored as interned integer handles: a sorted array of user
+    handles and a parallel bytearray of membership handles.
+    """
+    __slots__ = ("users", "memberships")
+
+    def __init__(self):
+        self.users = array("I")
+        self.memberships = bytearray()
+
+    def get(self, user):
+        index = bisect_left(self.users, user)
+        if index < len(self.users) and self.users[index] == user:
+            return self.memberships[index]
+        return None
+
+    def set(self, user, membership):
+        index = bisect_left(self.users, user)
+        if index < len(self.users) and self.users[index] == user:
+            self.memberships[index] = membership
+        else:
+            self.users.insert(index, user)
+            self.memberships.insert(index, membership)
+
+    def items(self):
+        return zip(self.users, self.memberships)
+
+    def copy(self):
+        copy = RoomMembers()
+        copy.users = array("I", self.users)
+        copy.memberships = bytearray(self.memberships)
+        return copy
+
 
 class StateStore:
-    def __init__(self, autosave_file=None):
+    """Stores the Matrix state the bridge needs: registrations, memberships and power levels.
+
+    When ``autosave_file`` is set, each change is appended to a change log next to it, and the
+    full state is written to ``autosave_file`` (and the change log cleared) ``snapshot_delay``
+    seconds after the first unsaved change or after ``max_log_size`` changes, whichever comes
+    first. Those snapshots are written from a copy of the state in the loop's executor.
+
+    Full member lists fetched from the homeserver are kept current from membership events and
+    are considered fresh for ``member_list_max_age`` seconds, or forever if it's ``None``.
+    """
+    log = logging.getLogger("mautrix_appservice.state_store")
+
+    def __init__(self, autosave_file=None, loop=None, snapshot_delay=60, max_log_size=10000,
+                 member_list_max_age=None):
         self.autosave_file = autosave_file
+        self.member_list_max_age = member_list_max_age
+        self.loop = loop
+        self.snapshot_delay = snapshot_delay
+        self.max_log_size = max_log_size
+        self._log_output = None
+        self._log_size = 0
+        self._snapshot_handle = None
+        self._snapshot_task = None
+        # Snapshots are numbered so that a background write can't replace a newer snapshot
+        # written by flush().
+        self._snapshot_lock = threading.Lock()
+        self._snapshot_number = 0
+        self._written_snapshot = 0
 
         # Persistent storage
         self.registrations = set()
         self.memberships = {}
         self.power_levels = {}
 
+        # Interned user IDs and membership values used in self.memberships
+        self._user_ids = []
+        self._user_handles = {}
+        self._membership_values = []
+        self._membership_handles = {}
+        # Users that were found to be joined when checked, as checking before every send has to
+        # be fast. Kept per room so that replacing a member list can drop the room's entries.
+        self._joined_cache = {}
+
         # Non-persistent storage
         self.presence = {}
         self.typing = {}
+        self.members_fetched = {}
 
     def save(self, file):
         if isinstance(file, str):
@@ -37,38 +117,174 @@ class StateStore:
         else:
             output = file
 
-        json.dump({
-            "registrations": list(self.registrations),
-            "memberships": self.memberships,
-            "power_levels": self.power_levels,
-        }, output)
+        output.write(self._dumps(self.registrations, self.memberships, self.power_levels))
 
         if isinstance(file, str):
             output.close()
 
+    def _dumps(self, registrations, memberships, power_levels):
+        # json.dump() would encode in pure Python, which is several times slower.
+        return codec.dumps({
+            "registrations": list(registrations),
+            "memberships": {room: {self._user_ids[user]: self._membership_values[membership]
+                                   for user, membership in members.items()}
+                            for room, members in memberships.items()},
+            "power_levels": power_levels,
+        })
+
     def load(self, file):
         if isinstance(file, str):
             try:
                 input_source = open(file, "r")
             except FileNotFoundError:
-                return
+                input_source = None
         else:
             input_source = file
 
-        data = json.load(input_source)
-        if "registrations" in data:
-            self.registrations = set(data["registrations"])
-        if "memberships" in data:
-            self.memberships = data["memberships"]
-        if "power_levels" in data:
-            self.power_levels = data["power_levels"]
+        if input_source:
+            data = json.load(input_source)
+            if "registrations" in data:
+                self.registrations = set(data["registrations"])
+            if "memberships" in data:
+                for room, members in data["memberships"].items():
+                    for user, membership in members.items():
+                        self._set_membership(room, user, membership)
+            if "power_levels" in data:
+                self.power_levels = data["power_levels"]
 
         if isinstance(file, str):
-            input_source.close()
+            if input_source:
+                input_source.close()
+            # A snapshot that was being written when the bridge stopped left its log behind.
+            self._replay_log(f"{file}.log.old")
+            self._replay_log(f"{file}.log")
+
+    def _replay_log(self, file):
+        try:
+            input_source = open(file, "r")
+        except FileNotFoundError:
+            return
 
-    def _autosave(self):
-        if self.autosave_file:
-            self.save(self.autosave_file)
+        with input_source:
+            for line in input_source:
+                try:
+                    change, *args = codec.loads(line)
+                except ValueError:
+                    # Probably a partial write from a crash, the rest of the log is still usable.
+                    continue
+                self._log_size += 1
+                if change == "registered":
+                    self._registered(*args)
+                elif change == "membership":
+                    self._set_membership(*args)
+                elif change == "members":
+                    self._set_members(*args)
+                elif change == "power_level":
+                    self._set_power_level(*args)
+                elif change == "power_levels":
+                    self._set_power_levels(*args)
+
+    def _autosave(self, *change):
+        if not self.autosave_file:
+            return
+        if not self._log_output:
+            self._log_output = open(f"{self.autosave_file}.log", "a")
+        self._log_output.write(codec.dumps(change))
+        self._log_output.write("\n")
+        self._log_output.flush()
+        self._log_size += 1
+
+        if self._log_size >= self.max_log_size:
+            self._start_snapshot()
+        elif not self._snapshot_handle:
+            loop = self.loop or asyncio.get_event_loop()
+            self._snapshot_handle = loop.call_later(self.snapshot_delay, self._start_snapshot)
+
+    def _start_snapshot(self):
+        if self._snapshot_handle:
+            self._snapshot_handle.cancel()
+            self._snapshot_handle = None
+        if self._snapshot_task or self._log_size == 0:
+            # A running snapshot checks for new changes once it's done.
+            return
+
+        # Only the containers that are changed in place are copied. The interned values are only
+        # ever appended to, so they can be read from the executor.
+        registrations = list(self.registrations)
+        memberships = {room: members.copy() for room, members in self.memberships.items()}
+        power_levels = {room: dict(levels, users=dict(levels.get("users", {})))
+                        for room, levels in self.power_levels.items()}
+
+        # Changes made from here on go to a new log. The old one is removed once the snapshot
+        # that includes its changes has been written.
+        self._rotate_log()
+        self._snapshot_number += 1
+        loop = self.loop or asyncio.get_event_loop()
+        self._snapshot_task = asyncio.ensure_future(self._write_snapshot(
+            loop, self._snapshot_number, registrations, memberships, power_levels), loop=loop)
+
+    def _rotate_log(self):
+        log_file = f"{self.autosave_file}.log"
+        if self._log_output:
+            self._log_output.close()
+            self._log_output = None
+        if not os.path.exists(log_file):
+            pass
+        elif os.path.exists(f"{log_file}.old"):
+            # The previous snapshot wasn't written, so the changes in its log have to be kept.
+            with open(log_file) as input_source, open(f"{log_file}.old", "a") as output:
+                output.write(input_source.read())
+            os.remove(log_file)
+        else:
+            os.replace(log_file, f"{log_file}.old")
+        self._log_size = 0
+
+    async def _write_snapshot(self, loop, number, *state):
+        try:
+            await loop.run_in_executor(None, self._write_locked_snapshot, number, *state)
+        except Exception:
+            self.log.exception("Failed to write state store snapshot")
+        finally:
+            self._snapshot_task = None
+        if self._log_size >= self.max_log_size:
+            self._start_snapshot()
+        elif self._log_size > 0 and not self._snapshot_handle:
+            self._snapshot_handle = loop.call_later(self.snapshot_delay, self._start_snapshot)
+
+    def _write_locked_snapshot(self, number, *state):
+        with self._snapshot_lock:
+            self._write_snapshot_file(number, *state)
+
+    def _write_snapshot_file(self, number, *state):
+        if number <= self._written_snapshot:
+            return
+        temp_file = f"{self.autosave_file}.tmp"
+        with open(temp_file, "w") as output:
+            output.write(self._dumps(*state))
+        os.replace(temp_file, self.autosave_file)
+        try:
+            os.remove(f"{self.autosave_file}.log.old")
+        except FileNotFoundError:
+            pass
+        self._written_snapshot = number
+
+    def flush(self):
+        """Write a snapshot of the current state right away."""
+        if self._snapshot_handle:
+            self._snapshot_handle.cancel()
+            self._snapshot_handle = None
+        if not self.autosave_file:
+            return
+        if self._log_size == 0 and not self._snapshot_task:
+            return
+
+        # Waits for a snapshot that's being written in the executor, which mustn't remove the
+        # old log once it has the changes made after that snapshot.
+        with self._snapshot_lock:
+            self._rotate_log()
+            self._snapshot_number += 1
+            self._write_snapshot_file(self._snapshot_number, self.registrations,
+                                      self.memberships, self.power_levels)
 
     def set_presence(self, user, presence):
         self.presence[user] = presence
@@ -96,21 +312,99 @@ class StateStore:
     def is_registered(self, user):
         return user in self.registrations
 
-    def registered(self, user):
+    def _registered(self, user):
         self.registrations.add(user)
-        self._autosave()
+
+    def registered(self, user):
+        self._registered(user)
+        self._autosave("registered", user)
+
+    @staticmethod
+    def _intern(value, values, handles):
+        try:
+            return handles[value]
+        except KeyError:
+            handle = len(values)
+            values.append(value)
+            handles[value] = handle
+            return handle
+
+    def iter_memberships(self):
+        for room, members in self.memberships.items():
+            for user, membership in members.items():
+                yield room, self._user_ids[user], self._membership_values[membership]
+
+    def _get_membership(self, room, user):
+        try:
+            membership = self.memberships[room].get(self._user_handles[user])
+        except KeyError:
+            return None
+        return self._membership_values[membership] if membership is not None else None
 
     def get_membership(self, room, user):
-        return self.memberships.get(room, {}).get(user, "left")
+        return self._get_membership(room, user) or "left"
 
     def is_joined(self, room, user):
-        return self.get_membership(room, user) == "join"
+        try:
+            if user in self._joined_cache[room]:
+                return True
+        except KeyError:
+            pass
+        if self.get_membership(room, user) != "join":
+            return False
+        try:
+            self._joined_cache[room].add(user)
+        except KeyError:
+            self._joined_cache[room] = {user}
+        return True
+
+    def _set_membership(self, room, user, membership):
+        if membership != "join" and room in self._joined_cache:
+            self._joined_cache[room].discard(user)
+        try:
+            members = self.memberships[room]
+        except KeyError:
+            members = self.memberships[room] = RoomMembers()
+        members.set(self._intern(user, self._user_ids, self._user_handles),
+                    self._intern(membership, self._membership_values, self._membership_handles))
 
     def set_membership(self, room, user, membership):
-        if room not in self.memberships:
-            self.memberships[room] = {}
-        self.memberships[room][user] = membership
-        self._autosave()
+        self._set_membership(room, user, membership)
+        self._autosave("membership", room, user, membership)
+
+    def has_members(self, room):
+        try:
+            fetched = self.members_fetched[room]
+        except KeyError:
+            return False
+        return (self.member_list_max_age is None
+                or fetched + self.member_list_max_age > time.monotonic())
+
+    def get_members(self, room, memberships=("join",)):
+        try:
+            members = self.memberships[room]
+        except KeyError:
+            return []
+        handles = {self._membership_handles[membership] for membership in memberships
+                   if membership in self._membership_handles}
+        return [self._user_ids[user] for user, membership in members.items()
+                if membership in handles]
+
+    def _set_members(self, room, members):
+        entries = sorted((self._intern(user, self._user_ids, self._user_handles),
+                          self._intern(membership, self._membership_values,
+                                       self._membership_handles))
+                         for user, membership in members.items())
+        room_members = RoomMembers()
+        room_members.users = array("I", (user for user, _ in entries))
+        room_members.memberships = bytearray(membership for _, membership in entries)
+        self._joined_cache.pop(room, None)
+        self.memberships[room] = room_members
+
+    def set_members(self, room, members):
+        self._set_members(room, members)
+        self.members_fetched[room] = time.monotonic()
+        self._autosave("members", room, members)
 
     def joined(self, room, user):
         return self.set_membership(room, user, "join")
@@ -127,15 +421,28 @@ class StateStore:
     def get_power_levels(self, room):
         return self.power_levels[room]
 
+    def _get_room_power_levels(self, room):
+        return self.power_levels.get(room, {})
+
+    def get_user_power_level(self, room, user):
+        room_levels = self._get_room_power_levels(room)
+        return room_levels.get("users", {}).get(user, room_levels.get("users_default", 0))
+
+    def get_event_power_level(self, room, event, is_state_event=False, default=None):
+        room_levels = self._get_room_power_levels(room)
+        default = default or (room_levels.get("state_default", 50) if is_state_event
+                              else room_levels.get("events_default", 0))
+        return room_levels.get("events", {}).get(event, default)
+
     def has_power_level(self, room, user, event, is_state_event=False, default=None):
-        room_levels = self.power_levels.get(room, {})
-        default_required = default or (room_levels.get("state_default", 50) if is_state_event
-                                       else room_levels.get("events_default", 0))
-        required = room_levels.get("events", {}).get(event, default_required)
+        room_levels = self._get_room_power_levels(room)
+        default = default or (room_levels.get("state_default", 50) if is_state_event
+                              else room_levels.get("events_default", 0))
+        required = room_levels.get("events", {}).get(event, default)
         has = room_levels.get("users", {}).get(user, room_levels.get("users_default", 0))
         return has >= required
 
-    def set_power_level(self, room, user, level):
+    def _set_power_level(self, room, user, level):
         if room not in self.power_levels:
             self.power_levels[room] = {
                 "users": {},
@@ -144,12 +451,18 @@ class StateStore:
         elif "users" not in self.power_levels[room]:
             self.power_levels[room]["users"] = {}
         self.power_levels[room]["users"][user] = level
-        self._autosave()
 
-    def set_power_levels(self, room, content):
+    def set_power_level(self, room, user, level):
+        self._set_power_level(room, user, level)
+        self._autosave("power_level", room, user, level)
+
+    def _set_power_levels(self, room, content):
         if "events" not in content:
             content["events"] = {}
         if "users" not in content:
             content["users"] = {}
         self.power_levels[room] = content
-        self._autosave()
+
+    def set_power_levels(self, room, content):
+        self._set_power_levels(room, content)
+        self._autosave("power_levels", room, content)
@@ -0,0 +1,111 @@
+# -*- coding: future_fstrings -*-
+# matrix-appservice-python - A Matrix Application Service framework written in Python.
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from collections import OrderedDict, deque
+import os
+
+
+class TransactionStore:
+    """A bounded set of recently handled transaction IDs.
+
+    The oldest IDs are evicted once more than ``max_size`` IDs have been seen. New IDs are
+    appended to ``autosave_file`` one per line, and the file is compacted when it grows to twice
+    the size of the set, so homeserver retries are still recognized after a restart.
+    """
+
+    def __init__(self, max_size=10000, autosave_file=None):
+        self.max_size = max_size
+        self.autosave_file = autosave_file
+
+        self._transactions = OrderedDict()
+        self._autosave_output = None
+        self._autosave_lines = 0
+
+    def __contains__(self, transaction_id):
+        return transaction_id in self._transactions
+
+    def __len__(self):
+        return len(self._transactions)
+
+    def add(self, transaction_id):
+        if transaction_id in self._transactions:
+            return
+        self._transactions[transaction_id] = None
+        if len(self._transactions) > self.max_size:
+            self._transactions.popitem(last=False)
+        self._autosave(transaction_id)
+
+    def save(self, file):
+        if isinstance(file, str):
+            output = open(file, "w")
+        else:
+            output = file
+
+        for transaction_id in self._transactions:
+            if "\n" not in transaction_id:
+                output.write(f"{transaction_id}\n")
+
+        if isinstance(file, str):
+            output.close()
+
+    def load(self, file):
+        if isinstance(file, str):
+            try:
+                input_source = open(file, "r")
+            except FileNotFoundError:
+                return
+        else:
+            input_source = file
+
+        lines = deque(maxlen=self.max_size)
+        line_count = 0
+        for line in input_source:
+            line_count += 1
+            line = line.rstrip("\n")
+            if line:
+                lines.append(line)
+        self._transactions = OrderedDict((line, None) for line in lines)
+        # Count what's actually in the file, so that duplicate and evicted lines are compacted
+        # away too.
+        self._autosave_lines = line_count
+
+        if isinstance(file, str):
+            input_source.close()
+
+    def close(self):
+        if self._autosave_output:
+            self._autosave_output.close()
+            self._autosave_output = None
+
+    def _compact(self):
+        self.close()
+        temp_file = f"{self.autosave_file}.tmp"
+        self.save(temp_file)
+        os.replace(temp_file, self.autosave_file)
+        self._autosave_lines = len(self._transactions)
+
+    def _autosave(self, transaction_id):
+        if not self.autosave_file or "\n" in transaction_id:
+            return
+        if self._autosave_lines >= self.max_size * 2:
+            # The new ID is already in the set, so the compacted file includes it.
+            self._compact()
+            return
+        if not self._autosave_output:
+            self._autosave_output = open(self.autosave_file, "a")
+        self._autosave_output.write(f"{transaction_id}\n")
+        self._autosave_output.flush()
+        self._autosave_lines += 1
@@ -36,7 +36,9 @@ from .bot import init as init_bot
 from .portal import init as init_portal
 from .puppet import init as init_puppet
 from .public import PublicBridgeWebsite
+from .sqlstatestore import SQLStateStore
 from .context import Context
+from .util import CommitBatcher, enable_savepoints
 
 log = logging.getLogger("mau")
 time_formatter = logging.Formatter("[%(asctime)s] [%(levelname)s@%(name)s] %(message)s")
@@ -73,6 +75,7 @@ if config["appservice.debug"]:
     log.debug("Debug messages enabled.")
 
 db_engine = sql.create_engine(config.get("appservice.database", "sqlite:///mautrix-telegram.db"))
+enable_savepoints(db_engine)
 db_factory = orm.sessionmaker(bind=db_engine)
 db_session = orm.scoping.scoped_session(db_factory)
 Base.metadata.bind = db_engine
@@ -83,11 +86,50 @@ telethon_session_container = AlchemySessionContainer(engine=db_engine, session=d
 
 loop = asyncio.get_event_loop()
 
+commit_batcher = CommitBatcher(db_session, loop, logging.getLogger("mau.db"),
+                               delay=config.get("appservice.database_commit.delay", 0.01),
+                               max_pending=config.get("appservice.database_commit.max_pending",
+                                                      100))
+
+member_list_max_age = config.get("appservice.member_list_max_age", None)
+if config.get("appservice.state_store", "database") == "database":
+    state_store = SQLStateStore(db_session, commit_batcher,
+                                member_list_max_age=member_list_max_age)
+else:
+    state_store = None
+
 appserv = AppService(config["homeserver.address"], config["homeserver.domain"],
                      config["appservice.as_token"], config["appservice.hs_token"],
-                     config["appservice.bot_username"], log="mau.as", loop=loop)
-
-context = Context(appserv, db_session, config, loop, None, None, telethon_session_container)
+                     config["appservice.bot_username"], log="mau.as", loop=loop,
+                     max_concurrent_events=config.get("appservice.event_queue.max_concurrency",
+                                                      32),
+                     max_room_queue_size=config.get("appservice.event_queue.max_per_room", 1000),
+                     max_queued_events=config.get("appservice.event_queue.max_total", 10000),
+                     event_retry_after_ms=config.get("appservice.event_queue.retry_after_ms",
+                                                     1000),
+                     journal_file=config.get("appservice.transaction_journal", None),
+                     state_store=state_store, member_list_max_age=member_list_max_age,
+                     request_rate=config.get("homeserver.rate_limit.per_user.rate", None),
+                     request_burst=config.get("homeserver.rate_limit.per_user.burst", 20),
+                     global_request_rate=config.get("homeserver.rate_limit.total.rate", None),
+                     global_request_burst=config.get("homeserver.rate_limit.total.burst", 200),
+                     connection_limit=config.get("homeserver.connection_pool.limit", 100),
+                     connection_limit_per_host=config.get(
+                         "homeserver.connection_pool.limit_per_host", 0),
+                     keepalive_timeout=config.get("homeserver.connection_pool.keepalive_timeout",
+                                                  15),
+                     dns_cache_ttl=config.get("homeserver.connection_pool.dns_cache_ttl", 10),
+                     unix_socket=config.get("homeserver.unix_socket", None),
+                     send_retry_count=config.get("homeserver.send_retry.attempts", 5),
+                     send_retry_delay=config.get("homeserver.send_retry.initial_delay", 1),
+                     send_retry_max_delay=config.get("homeserver.send_retry.max_delay", 60),
+                     max_retrying_sends_per_room=config.get("homeserver.send_retry.max_per_room",
+                                                            1),
+                     metrics_path=(config.get("appservice.metrics.path", "/metrics")
+                                   if config.get("appservice.metrics.enabled", False) else None))
+
+context = Context(appserv, db_session, config, loop, None, None, telethon_session_container,
+                  commit_batcher)
 
 if config["appservice.public.enabled"]:
     public = PublicBridgeWebsite(loop)
@@ -95,6 +137,8 @@ if config["appservice.public.enabled"]:
 
 with appserv.run(config["appservice.hostname"], config["appservice.port"]) as start:
     init_db(db_session)
+    if isinstance(state_store, SQLStateStore):
+        state_store.import_json("mx-state.json")
     init_abstract_user(context)
     context.bot = init_bot(context)
     context.mx = MatrixHandler(context)
@@ -111,4 +155,5 @@ with appserv.run(config["appservice.hostname"], config["appservice.port"]) as st
     except KeyboardInterrupt:
         for user in User.by_tgid.values():
             user.stop()
+        commit_batcher.flush()
         sys.exit(0)
@@ -14,11 +14,13 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from collections import OrderedDict
+import logging
 import platform
 import os
 
 from telethon_aio.tl.types import *
-from mautrix_appservice import MatrixRequestError
+from mautrix_appservice import MatrixRequestError, OrderedDispatcher
 
 from .tgclient import MautrixTelegramClient
 from .db import Message as DBMessage
@@ -35,6 +37,8 @@ class AbstractUser:
     log = None
     db = None
     az = None
+    update_dispatcher = None
+    max_recent_messages = 1000
 
     def __init__(self):
         self.connected = False
@@ -42,6 +46,8 @@ class AbstractUser:
         self.client = None
         self.tgid = None
         self.mxid = None
+        # Queue keys of recent non-channel messages, as their deletions don't say the chat.
+        self._recent_message_keys = OrderedDict()
 
     async def _init_client(self):
         self.log.debug(f"Initializing client for {self.name}")
@@ -64,12 +70,80 @@ class AbstractUser:
         raise NotImplementedError()
 
     async def _update_catch(self, update):
+        # Telethon runs handlers concurrently, so updates are queued per chat (before anything
+        # is awaited) to handle them in the order they arrived.
+        if isinstance(update, UpdateDeleteMessages) and len(update.messages) <= MAX_DELETIONS:
+            updates = self._split_deletion(update)
+        else:
+            key = self._get_update_queue_key(update)
+            if key is not None:
+                self._remember_message(update, key)
+            updates = [(key, update)]
+
+        direct = []
+        for key, update in updates:
+            if key is None:
+                direct.append(update)
+            else:
+                self.update_dispatcher.submit(key, self._handle_update, update)
+        for update in direct:
+            await self._handle_update(update)
+
+    async def _handle_update(self, update):
         try:
             if not await self.update(update):
                 await self._update(update)
         except Exception:
             self.log.exception("Failed to handle Telegram update")
 
+    def _remember_message(self, update, key):
+        if isinstance(update, (UpdateShortChatMessage, UpdateShortMessage)):
+            message_id = update.id
+        elif isinstance(update, UpdateNewMessage):
+            message_id = update.message.id
+        else:
+            return
+        self._recent_message_keys[message_id] = key
+        if len(self._recent_message_keys) > self.max_recent_messages:
+            self._recent_message_keys.popitem(last=False)
+
+    def _split_deletion(self, update):
+        # The deletions are queued after the messages, so that they're handled once the messages
+        # are sent. Deletions of older messages are handled right away.
+        message_ids = OrderedDict()
+        for message_id in update.messages:
+            key = self._recent_message_keys.get(message_id)
+            message_ids.setdefault(key, []).append(message_id)
+        if len(message_ids) == 1:
+            return [(next(iter(message_ids)), update)]
+        return [(key, UpdateDeleteMessages(messages=ids, pts=update.pts,
+                                           pts_count=update.pts_count))
+                for key, ids in message_ids.items()]
+
+    def _get_update_queue_key(self, update):
+        if isinstance(update, UpdateShortChatMessage):
+            return update.chat_id, update.chat_id
+        elif isinstance(update, (UpdateShortMessage, UpdateUserTyping)):
+            return update.user_id, self.tgid
+        elif isinstance(update, (UpdateNewMessage, UpdateNewChannelMessage,
+                                 UpdateEditMessage, UpdateEditChannelMessage)):
+            message = update.message
+            peer = getattr(message, "to_id", None)
+            if isinstance(peer, PeerUser):
+                return peer.user_id if message.out else message.from_id, self.tgid
+            elif isinstance(peer, PeerChat):
+                return peer.chat_id, peer.chat_id
+            elif isinstance(peer, PeerChannel):
+                return peer.channel_id, peer.channel_id
+        elif isinstance(update, (UpdateDeleteChannelMessages, UpdateChannelPinnedMessage)):
+            return update.channel_id, update.channel_id
+        elif isinstance(update, (UpdateChatUserTyping, UpdateChatAdmins,
+                                 UpdateChatParticipantAdmin)):
+            return update.chat_id, update.chat_id
+        elif isinstance(update, UpdateChatParticipants):
+            return update.participants.chat_id, update.participants.chat_id
+        return None
+
     async def _get_dialogs(self, limit=None):
         dialogs = await self.client.get_dialogs(limit=limit)
         return [dialog.entity for dialog in dialogs if (
@@ -136,6 +210,7 @@ class AbstractUser:
     async def update_pinned_messages(self, update):
         portal = po.Portal.get_by_tgid(update.channel_id)
         if portal and portal.mxid:
+            await portal.send_queue.join()
             await portal.update_telegram_pin(self, update.id)
 
     async def update_participants(self, update):
@@ -235,6 +310,13 @@ class AbstractUser:
         if len(update.messages) > MAX_DELETIONS:
             return
 
+        # Recent messages may still be queued for sending, so they aren't in the database yet.
+        keys = {self._recent_message_keys.get(message) for message in update.messages}
+        for key in keys - {None}:
+            portal = po.Portal.get_by_tgid(*key)
+            if portal:
+                await portal.send_queue.join()
+
         for message in update.messages:
             message = DBMessage.query.get((message, self.tgid))
             if not message:
@@ -254,6 +336,7 @@ class AbstractUser:
         portal = po.Portal.get_by_tgid(update.channel_id)
         if not portal:
             return
+        await portal.send_queue.join()
 
         for message in update.messages:
             message = DBMessage.query.get((message, portal.tgid))
@@ -274,17 +357,26 @@ class AbstractUser:
                 return
             self.log.debug("Handling action %s to %s by %d", update.action, portal.tgid_log,
                            sender.id)
+            await portal.send_queue.join()
             return await portal.handle_telegram_action(self, sender, update)
 
+        # Messages and edits go through the portal's send queue, which keeps them in order, so
+        # there's no need to wait for them to be sent before handling the next update.
         user = sender.tgid if sender else "admin"
         if isinstance(original_update, (UpdateEditMessage, UpdateEditChannelMessage)):
             if config["bridge.edits_as_replies"]:
                 self.log.debug("Handling edit %s to %s by %s", update, portal.tgid_log, user)
-                return await portal.handle_telegram_edit(self, sender, update)
+                portal.handle_telegram_edit(self, sender, update) \
+                    .add_done_callback(self._log_send_error)
             return
 
         self.log.debug("Handling message %s to %s by %s", update, portal.tgid_log, user)
-        return await portal.handle_telegram_message(self, sender, update)
+        portal.handle_telegram_message(self, sender, update) \
+            .add_done_callback(self._log_send_error)
+
+    def _log_send_error(self, task):
+        if not task.cancelled() and task.exception():
+            self.log.error("Failed to bridge Telegram message", exc_info=task.exception())
 
     # endregion
 
@@ -294,3 +386,13 @@ def init(context):
     AbstractUser.az, AbstractUser.db, config, AbstractUser.loop, _ = context
     AbstractUser.session_container = context.telethon_session_container
     MAX_DELETIONS = config.get("bridge.max_telegram_delete", 10)
+
+    dispatcher = OrderedDispatcher(AbstractUser.loop, logging.getLogger("mau.user.updates"),
+                                   max_concurrency=config.get("bridge.update_concurrency", 32))
+    AbstractUser.update_dispatcher = dispatcher
+    AbstractUser.az.metrics.gauge("bridge_telegram_update_queue_depth",
+                                  "Telegram updates that are queued or being handled",
+                                  func=lambda: dispatcher.total)
+    AbstractUser.az.metrics.gauge("bridge_telegram_update_queues",
+                                  "Telegram chats with queued updates",
+                                  func=lambda: len(dispatcher.queues))
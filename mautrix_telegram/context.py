@@ -17,9 +17,11 @@
 
 
 class Context:
-    def __init__(self, az, db, config, loop, bot, mx, telethon_session_container):
+    def __init__(self, az, db, config, loop, bot, mx, telethon_session_container,
+                 commit_batcher=None):
         self.az = az
         self.db = db
+        self.commit_batcher = commit_batcher
         self.config = config
         self.loop = loop
         self.bot = bot
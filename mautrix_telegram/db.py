@@ -15,7 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from sqlalchemy import (Column, UniqueConstraint, ForeignKey, ForeignKeyConstraint, Integer,
-                        BigInteger, String, Boolean)
+                        BigInteger, String, Boolean, Text)
 from sqlalchemy.orm import relationship
 
 from .base import Base
@@ -52,6 +52,19 @@ class Message(Base):
     __table_args__ = (UniqueConstraint("mxid", "mx_room", "tg_space", name="_mx_id_room"),)
 
 
+class MessageDedup(Base):
+    query = None
+    __tablename__ = "message_dedup"
+
+    tgid = Column(Integer, primary_key=True)
+    tg_receiver = Column(Integer, primary_key=True)
+    digest = Column(BigInteger, primary_key=True)
+    action = Column(Boolean, primary_key=True)
+    mxid = Column(String, nullable=True)
+    tg_space = Column(Integer, nullable=True)
+    timestamp = Column(BigInteger, index=True)
+
+
 class UserPortal(Base):
     query = None
     __tablename__ = "user_portal"
@@ -114,11 +127,39 @@ class TelegramFile(Base):
     timestamp = Column(BigInteger)
 
 
+class RoomState(Base):
+    query = None
+    __tablename__ = "mx_room_state"
+
+    room_id = Column(String, primary_key=True)
+    power_levels = Column(Text, nullable=True)
+
+
+class RoomMembership(Base):
+    query = None
+    __tablename__ = "mx_room_membership"
+
+    room_id = Column(String, primary_key=True)
+    user_id = Column(String, primary_key=True)
+    membership = Column(String, nullable=False)
+
+
+class UserRegistration(Base):
+    query = None
+    __tablename__ = "mx_user_registration"
+
+    user_id = Column(String, primary_key=True)
+
+
 def init(db_session):
     Portal.query = db_session.query_property()
     Message.query = db_session.query_property()
+    MessageDedup.query = db_session.query_property()
     UserPortal.query = db_session.query_property()
     User.query = db_session.query_property()
     Puppet.query = db_session.query_property()
     BotChat.query = db_session.query_property()
     TelegramFile.query = db_session.query_property()
+    RoomState.query = db_session.query_property()
+    RoomMembership.query = db_session.query_property()
+    UserRegistration.query = db_session.query_property()
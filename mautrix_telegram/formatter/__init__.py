@@ -1,2 +1,3 @@
 from .from_matrix import matrix_reply_to_telegram, matrix_to_telegram, matrix_text_to_telegram
-from .from_telegram import telegram_reply_to_matrix, telegram_to_matrix
+from .from_telegram import (telegram_reply_fallback_to_matrix, telegram_reply_to_matrix,
+                            telegram_to_matrix)
@@ -68,21 +68,29 @@ async def _add_forward_header(source, text, html, fwd_from_id):
     return text, html
 
 
-async def _add_reply_header(source, text, html, evt, relates_to, main_intent, is_edit):
+# Separate from telegram_to_matrix, as the message being replied to must already have been
+# bridged to be found, while the rest can be formatted ahead of time.
+async def telegram_reply_fallback_to_matrix(evt, source, text, html, main_intent,
+                                            is_edit=False):
+    relates_to = {}
+    if not evt.reply_to_msg_id:
+        return text, html, relates_to
     space = (evt.to_id.channel_id
              if isinstance(evt, Message) and isinstance(evt.to_id, PeerChannel)
              else source.tgid)
 
     msg = DBMessage.query.get((evt.reply_to_msg_id, space))
     if not msg:
-        return text, html
+        return text, html, relates_to
 
     relates_to["m.in_reply_to"] = {
         "event_id": msg.mxid,
         "room_id": msg.mx_room,
     }
+    if not html:
+        html = escape(text).replace("\n", "<br/>")
     if is_edit:
-        html = f"<u>Edit:</u> {html or escape(text)}"
+        html = f"<u>Edit:</u> {html}"
         text = f"Edit: {text}"
 
     try:
@@ -94,7 +102,8 @@ async def _add_reply_header(source, text, html, evt, relates_to, main_intent, is
         r_text_body = trim_reply_fallback_text(content["body"])
         r_html_body = trim_reply_fallback_html(content["formatted_body"]
                                                if "formatted_body" in content
-                                               else escape(content["body"]))
+                                               else escape(content["body"]).replace("\n",
+                                                                                    "<br/>"))
 
         puppet = pu.Puppet.get_by_mxid(r_sender, create=False)
         r_displayname = puppet.displayname if puppet else r_sender
@@ -108,7 +117,7 @@ async def _add_reply_header(source, text, html, evt, relates_to, main_intent, is
     r_keyword = "In reply to" if not is_edit else "Edit to"
     r_msg_link = f"<a href='https://matrix.to/#/{msg.mx_room}/{msg.mxid}'>{r_keyword}</a>"
     html = (f"<blockquote data-mx-reply>{r_msg_link} {r_sender_link} {r_html_body}</blockquote>"
-            + (html or escape(text)))
+            + html)
 
     lines = r_text_body.strip().split("\n")
     text_with_quote = f"> <{r_displayname}> {lines.pop(0)}"
@@ -117,21 +126,16 @@ async def _add_reply_header(source, text, html, evt, relates_to, main_intent, is
             text_with_quote += f"\n> {line}"
     text_with_quote += "\n\n"
     text_with_quote += text
-    return text_with_quote, html
+    return text_with_quote, html, relates_to
 
 
-async def telegram_to_matrix(evt, source, main_intent=None, is_edit=False):
+async def telegram_to_matrix(evt, source):
     text = add_surrogates(evt.message)
     html = _telegram_entities_to_matrix_catch(text, evt.entities) if evt.entities else None
-    relates_to = {}
 
     if evt.fwd_from:
         text, html = await _add_forward_header(source, text, html, evt.fwd_from.from_id)
 
-    if evt.reply_to_msg_id:
-        text, html = await _add_reply_header(source, text, html, evt, relates_to, main_intent,
-                                             is_edit)
-
     if isinstance(evt, Message) and evt.post and evt.post_author:
         if not html:
             html = escape(text)
@@ -144,7 +148,7 @@ async def telegram_to_matrix(evt, source, main_intent=None, is_edit=False):
     if html:
         html = html.replace("\n", "<br/>")
 
-    return remove_surrogates(text), remove_surrogates(html), relates_to
+    return remove_surrogates(text), remove_surrogates(html)
 
 
 def _telegram_entities_to_matrix_catch(text, entities):
@@ -31,7 +31,10 @@ class MatrixHandler:
         self.az, self.db, self.config, _, self.tgbot = context
         self.commands = CommandHandler(context)
 
-        self.az.matrix_event_handler(self.handle_event)
+        self.az.matrix_event_handler(self.handle_event, event_types=(
+            "m.room.member", "m.room.message", "m.room.redaction", "m.room.power_levels",
+            "m.room.name", "m.room.avatar", "m.room.topic",
+        ), event_filter=self.filter_matrix_event)
 
     async def init_as_bot(self):
         await self.az.intent.set_display_name(
@@ -227,8 +230,6 @@ class MatrixHandler:
                 or Puppet.get_id_from_mxid(event["sender"]) is not None)
 
     async def handle_event(self, evt):
-        if self.filter_matrix_event(evt):
-            return
         self.log.debug("Received event: %s", evt)
         type = evt["type"]
         content = evt.get("content", {})
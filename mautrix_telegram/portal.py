@@ -14,24 +14,26 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
-from collections import deque
 from datetime import datetime
+from functools import partial
+from tempfile import SpooledTemporaryFile
 import asyncio
-import random
+import time
 import mimetypes
-import hashlib
 import logging
 import re
 
+from sqlalchemy.dialects import postgresql
 import magic
 
 from telethon_aio.tl.functions.messages import *
 from telethon_aio.tl.functions.channels import *
 from telethon_aio.errors.rpc_error_list import *
 from telethon_aio.tl.types import *
-from mautrix_appservice import MatrixRequestError, IntentError
+from mautrix_appservice import MatrixRequestError, IntentError, RoomSendQueue
+from mautrix_appservice.intent_api import SNIFF_SIZE
 
-from .db import Portal as DBPortal, Message as DBMessage
+from .db import Portal as DBPortal, Message as DBMessage, MessageDedup as DBMessageDedup
 from . import puppet as p, user as u, formatter, util
 from .formatter.util import trim_reply_fallback_html, trim_reply_fallback_text
 
@@ -50,6 +52,13 @@ class Portal:
     alias_template = None
     mx_alias_regex = None
     hs_domain = None
+    send_pipeline_depth = 4
+    send_queue_depth = None
+    send_latency = None
+    prepare_semaphore = None
+    dedup_windows = {"user": 20, "chat": 200, "channel": 200}
+    dedup_max_age = 24 * 60 * 60
+    commit_batcher = None
     by_mxid = {}
     by_tgid = {}
 
@@ -67,10 +76,13 @@ class Portal:
 
         self._main_intent = None
         self._room_create_lock = asyncio.Lock()
+        self._send_queue = None
 
-        self._dedup = deque()
-        self._dedup_mxid = {}
-        self._dedup_action = deque()
+        dedup_window = self.dedup_windows.get(peer_type, 20)
+        self._dedup = util.DedupCache(dedup_window)
+        self._dedup_action = util.DedupCache(dedup_window)
+        self._dedup_loaded = False
+        self._dedup_saves = 0
 
         if tgid:
             self.by_tgid[self.tgid_full] = self
@@ -102,6 +114,14 @@ class Portal:
     def has_bot(self):
         return self.bot and self.bot.is_in_chat(self.tgid)
 
+    @property
+    def send_queue(self):
+        if not self._send_queue:
+            self._send_queue = RoomSendQueue(self.loop, self.send_pipeline_depth,
+                                             self.send_queue_depth, self.send_latency,
+                                             self.prepare_semaphore)
+        return self._send_queue
+
     @property
     def main_intent(self):
         if not self._main_intent:
@@ -120,7 +140,7 @@ class Portal:
 
         # The timestamp is only accurate to the second, so we can't rely solely on that either.
         if isinstance(event, MessageService):
-            hash_content = [event.date.timestamp(), event.from_id, event.action]
+            hash_content = [event.date.timestamp(), event.from_id, bytes(event.action)]
         else:
             hash_content = [event.date.timestamp(), event.message]
             if event.fwd_from:
@@ -135,33 +155,100 @@ class Portal:
                     }[type(event.media)](event.media)
                 except KeyError:
                     pass
-        return hashlib.md5("-"
-                           .join(str(a) for a in hash_content)
-                           .encode("utf-8")
-                           ).hexdigest()
+        return util.digest(*hash_content)
+
+    @property
+    def _persist_dedup(self):
+        # Channel messages have unique IDs, so the message table is enough to deduplicate them.
+        return self.dedup_max_age > 0 and self.peer_type != "channel"
+
+    def _load_dedup(self):
+        self._dedup_loaded = True
+        if not self._persist_dedup:
+            return
+        rows = DBMessageDedup.query.filter(
+            DBMessageDedup.tgid == self.tgid,
+            DBMessageDedup.tg_receiver == self.tg_receiver,
+            DBMessageDedup.timestamp >= int(time.time()) - self.dedup_max_age,
+        ).order_by(DBMessageDedup.timestamp).all()
+        for row in rows:
+            if row.action:
+                self._dedup_action.set(row.digest)
+            else:
+                self._dedup.set(row.digest, (row.mxid, row.tg_space))
+
+    def _save_dedup(self, hash, action=False, mxid=None, tg_space=None):
+        if not self._persist_dedup:
+            return
+        self.commit_batcher.add(
+            f"deduplication entry {hash} of {self.tgid_log}", self._insert_dedup,
+            dict(tgid=self.tgid, tg_receiver=self.tg_receiver, digest=hash, action=action,
+                 mxid=mxid, tg_space=tg_space, timestamp=int(time.time())))
+        self._dedup_saves += 1
+        if self._dedup_saves >= self._dedup.max_size:
+            self._dedup_saves = 0
+            self.commit_batcher.add_flush_hook(
+                f"pruning of deduplication entries of {self.tgid_log}", self._prune_dedup)
+
+    def _insert_dedup(self, values):
+        # Like the in-memory cache, the first entry of a digest is kept.
+        table = DBMessageDedup.__table__
+        dialect = self.db.get_bind().dialect.name
+        if dialect == "postgresql":
+            query = postgresql.insert(table).on_conflict_do_nothing()
+        elif dialect == "sqlite":
+            query = table.insert().prefix_with("OR IGNORE")
+        elif dialect == "mysql":
+            query = table.insert().prefix_with("IGNORE")
+        else:
+            key = (values["tgid"], values["tg_receiver"], values["digest"], values["action"])
+            if self.db.query(DBMessageDedup).get(key):
+                return
+            query = table.insert()
+        self.db.execute(query.values(**values))
+
+    def _prune_dedup(self):
+        expired = int(time.time()) - self.dedup_max_age
+        for action, window in ((False, self._dedup.max_size),
+                               (True, self._dedup_action.max_size)):
+            query = DBMessageDedup.query.filter(DBMessageDedup.tgid == self.tgid,
+                                                DBMessageDedup.tg_receiver == self.tg_receiver,
+                                                DBMessageDedup.action == action)
+            oldest_kept = (query.order_by(DBMessageDedup.timestamp.desc())
+                           .offset(window - 1).first())
+            min_timestamp = max(expired, oldest_kept.timestamp) if oldest_kept else expired
+            query.filter(DBMessageDedup.timestamp < min_timestamp) \
+                .delete(synchronize_session=False)
 
     def is_duplicate_action(self, event):
+        if not self._dedup_loaded:
+            self._load_dedup()
         hash = self._hash_event(event) if self.peer_type != "channel" else event.id
-        if hash in self._dedup_action:
+        if self._dedup_action.check(hash) is not None:
             return True
-
-        self._dedup_action.append(hash)
-
-        if len(self._dedup_action) > 20:
-            self._dedup_action.popleft()
+        self._save_dedup(hash, action=True)
         return False
 
-    def is_duplicate(self, event, mxid=None, force_hash=False):
-        hash = self._hash_event(event) if self.peer_type != "channel" or force_hash else event.id
-        if hash in self._dedup:
-            return self._dedup_mxid[hash]
+    def is_duplicate(self, event, mxid=None, force_hash=False, save=False):
+        """Check if the Telegram message has already been bridged.
 
-        self._dedup_mxid[hash] = mxid
-        self._dedup.append(hash)
+        If it hasn't, it's marked as bridged with the given (event ID, tg_space) tuple. While the
+        message is still being sent to Matrix, the event ID can be a future of it, in which case
+        :meth:`save_bridged` should be called once it's sent. Otherwise the mark is saved in the
+        database only if ``save`` is true.
+        """
+        if not self._dedup_loaded:
+            self._load_dedup()
+        hash = self._hash_event(event) if self.peer_type != "channel" or force_hash else event.id
+        duplicate = self._dedup.check(hash, mxid)
+        if not duplicate and save:
+            self._save_dedup(hash, mxid=mxid[0], tg_space=mxid[1])
+        return duplicate
 
-        if len(self._dedup) > 20:
-            del self._dedup_mxid[self._dedup.popleft()]
-        return None
+    def save_bridged(self, event, mxid, force_hash=False):
+        hash = self._hash_event(event) if self.peer_type != "channel" or force_hash else event.id
+        self._dedup.set(hash, mxid)
+        self._save_dedup(hash, mxid=mxid[0], tg_space=mxid[1])
 
     def get_input_entity(self, user):
         return user.client.get_input_entity(self.peer)
@@ -527,7 +614,7 @@ class Portal:
             response = await self.bot.client.send_message(
                 self.peer, f"__{user.displayname} left the room.__", markdown=True)
             space = self.tgid if self.peer_type == "channel" else self.bot.tgid
-            self.is_duplicate(response, (event_id, space))
+            self.is_duplicate(response, (event_id, space), save=True)
             return
 
         if self.peer_type == "user":
@@ -558,7 +645,7 @@ class Portal:
             response = await self.bot.client.send_message(
                 self.peer, f"__{user.displayname} joined the room.__", markdown=True)
             space = self.tgid if self.peer_type == "channel" else self.bot.tgid
-            self.is_duplicate(response, (event_id, space))
+            self.is_duplicate(response, (event_id, space), save=True)
             return
 
         if self.peer_type == "channel":
@@ -601,8 +688,6 @@ class Portal:
             return await client.send_message(self.peer, message, reply_to=reply_to)
 
     async def _handle_matrix_file(self, client, message, reply_to):
-        file = await self.main_intent.download_file(message["url"])
-
         info = message["info"]
         mime = info["mimetype"]
 
@@ -612,9 +697,12 @@ class Portal:
         if "w" in info and "h" in info:
             attributes.append(DocumentAttributeImageSize(w=info["w"], h=info["h"]))
 
-        return await client.send_file(self.peer, file, mime, caption=caption,
-                                      attributes=attributes, file_name=file_name,
-                                      reply_to=reply_to)
+        with SpooledTemporaryFile(max_size=util.MAX_IN_MEMORY_SIZE) as file:
+            await self.main_intent.download_file_to(message["url"], file)
+            file.seek(0)
+            return await client.send_file(self.peer, file, mime, caption=caption,
+                                          attributes=attributes, file_name=file_name,
+                                          reply_to=reply_to)
 
     async def handle_matrix_message(self, sender, message, event_id):
         client = sender.client if sender.logged_in else self.bot.client
@@ -632,13 +720,8 @@ class Portal:
         else:
             self.log.debug("Unhandled Matrix event: %s", message)
             return
-        self.is_duplicate(response, (event_id, space))
-        self.db.add(DBMessage(
-            tgid=response.id,
-            tg_space=space,
-            mx_room=self.mxid,
-            mxid=event_id))
-        self.db.commit()
+        self.is_duplicate(response, (event_id, space), save=True)
+        self._add_message(response.id, space, event_id)
 
     async def handle_matrix_deletion(self, deleter, event_id):
         space = self.tgid if self.peer_type == "channel" else deleter.tgid
@@ -707,10 +790,13 @@ class Portal:
             # Invalid peer type
             return
 
-        file = await self.main_intent.download_file(url)
-        mime = magic.from_buffer(file, mime=True)
-        ext = mimetypes.guess_extension(mime)
-        uploaded = await sender.client.upload_file(file, file_name=f"avatar{ext}")
+        with SpooledTemporaryFile(max_size=util.MAX_IN_MEMORY_SIZE) as file:
+            await self.main_intent.download_file_to(url, file)
+            file.seek(0)
+            mime = magic.from_buffer(file.read(SNIFF_SIZE), mime=True)
+            file.seek(0)
+            ext = mimetypes.guess_extension(mime)
+            uploaded = await sender.client.upload_file(file, file_name=f"avatar{ext}")
         photo = InputChatUploadedPhoto(file=uploaded)
 
         if self.peer_type == "chat":
@@ -832,7 +918,7 @@ class Portal:
         if self.mxid:
             await user.intent.set_typing(self.mxid, is_typing=True)
 
-    async def handle_telegram_photo(self, source, intent, evt, relates_to=None):
+    async def handle_telegram_photo(self, source, intent, evt):
         largest_size = self._get_largest_photo_size(evt.media.photo)
         file = await util.transfer_file_to_matrix(self.db, source.client, intent,
                                                   largest_size.location)
@@ -848,10 +934,9 @@ class Portal:
         }
         name = evt.message
         await intent.set_typing(self.mxid, is_typing=False)
-        return await intent.send_image(self.mxid, file.mxc, info=info, text=name,
-                                       relates_to=relates_to)
+        return partial(intent.send_image, self.mxid, file.mxc, info=info, text=name)
 
-    async def handle_telegram_document(self, source, intent, evt: Message, relates_to=None):
+    async def handle_telegram_document(self, source, intent, evt: Message):
         document = evt.media.document
         file = await util.transfer_file_to_matrix(self.db, source.client, intent, document)
         if not file:
@@ -896,10 +981,10 @@ class Portal:
         elif mime_type.startswith("image/"):
             type = "m.image"
         await intent.set_typing(self.mxid, is_typing=False)
-        return await intent.send_file(self.mxid, file.mxc, info=info, text=name, file_type=type,
-                                      relates_to=relates_to)
+        return partial(intent.send_file, self.mxid, file.mxc, info=info, text=name,
+                       file_type=type)
 
-    def handle_telegram_location(self, source, intent, location, relates_to=None):
+    async def handle_telegram_location(self, source, intent, location):
         long = location.long
         lat = location.lat
         long_char = "E" if long > 0 else "W"
@@ -916,22 +1001,81 @@ class Portal:
         # so we'll add a plaintext link.
         body = f"Location: {body}\n{url}"
 
-        return intent.send_message(self.mxid, {
-            "msgtype": "m.location",
-            "geo_uri": f"geo:{lat},{long}",
-            "body": body,
-            "format": "org.matrix.custom.html",
-            "formatted_body": formatted_body,
-            "m.relates_to": relates_to or None,
-        })
+        await intent.set_typing(self.mxid, is_typing=False)
+
+        def send(relates_to=None):
+            return intent.send_message(self.mxid, {
+                "msgtype": "m.location",
+                "geo_uri": f"geo:{lat},{long}",
+                "body": body,
+                "format": "org.matrix.custom.html",
+                "formatted_body": formatted_body,
+                "m.relates_to": relates_to or None,
+            })
+
+        return send
 
     async def handle_telegram_text(self, source, intent, evt):
         self.log.debug(f"Sending {evt.message} to {self.mxid} by {intent.mxid}")
-        text, html, relates_to = await formatter.telegram_to_matrix(evt, source, self.main_intent)
+        text, html = await formatter.telegram_to_matrix(evt, source)
         await intent.set_typing(self.mxid, is_typing=False)
-        return await intent.send_text(self.mxid, text, html=html, relates_to=relates_to)
 
-    async def handle_telegram_edit(self, source, sender, evt):
+        async def send():
+            # The reply is added when sending, as the message being replied to may still be
+            # queued.
+            reply_text, reply_html, relates_to = await formatter.telegram_reply_fallback_to_matrix(
+                evt, source, text, html, self.main_intent)
+            return await intent.send_text(self.mxid, reply_text, html=reply_html,
+                                          relates_to=relates_to)
+
+        return send
+
+    @staticmethod
+    async def _send_media_reply(send_media, evt, source):
+        # The reply target is looked up when sending, as it may still be queued.
+        return await send_media(relates_to=formatter.telegram_reply_to_matrix(evt, source))
+
+    @staticmethod
+    def _when_bridged(mxid, callback):
+        # Messages that are still being sent are deduplicated with a future of the event ID.
+        if not isinstance(mxid, asyncio.Future):
+            callback(mxid)
+            return
+
+        def done(pending):
+            if not pending.cancelled():
+                callback(pending.result())
+
+        mxid.add_done_callback(done)
+
+    def _add_message(self, tgid, tg_space, mxid):
+        self.commit_batcher.add(f"message {tgid}@{tg_space} -> {mxid}", self.db.add,
+                                DBMessage(tgid=tgid, mx_room=self.mxid, mxid=mxid,
+                                          tg_space=tg_space))
+
+    def _update_message(self, tgid, tg_space, mxid):
+        def update():
+            msg = DBMessage.query.get((tgid, tg_space))
+            if msg:
+                msg.mxid = mxid
+                msg.mx_room = self.mxid
+
+        self.commit_batcher.add(f"message {tgid}@{tg_space} -> {mxid}", update)
+
+    def _enqueue_pending(self, prepare, *args):
+        # The queue is entered before anything is awaited, so that events are sent to Matrix in
+        # the order they came from Telegram.
+        pending = asyncio.Future(loop=self.loop)
+        task = self.send_queue.enqueue(prepare(*args, pending))
+        # Nothing is waiting for the future, so it's only cancelled to drop duplicates of messages
+        # that weren't sent.
+        task.add_done_callback(lambda _: pending.cancel())
+        return task
+
+    def handle_telegram_edit(self, source, sender, evt):
+        return self._enqueue_pending(self._prepare_telegram_edit, source, sender, evt)
+
+    async def _prepare_telegram_edit(self, source, sender, evt, pending):
         if not self.mxid:
             return
         elif not config["bridge.edits_as_replies"]:
@@ -939,85 +1083,86 @@ class Portal:
             return
 
         tg_space = self.tgid if self.peer_type == "channel" else source.tgid
-        temporary_identifier = f"${random.randint(1000000000000,9999999999999)}TGBRIDGEDITEMP"
-        duplicate_found = self.is_duplicate(evt, (temporary_identifier, tg_space), force_hash=True)
+        duplicate_found = self.is_duplicate(evt, (pending, tg_space), force_hash=True)
         if duplicate_found:
             mxid, other_tg_space = duplicate_found
             if tg_space != other_tg_space:
-                msg = DBMessage.query.get((evt.id, tg_space))
-                msg.mxid = mxid
-                msg.mx_room = self.mxid
-                self.db.commit()
+                self._when_bridged(mxid, partial(self._update_message, evt.id, tg_space))
             return
 
         evt.reply_to_msg_id = evt.id
-        text, html, relates_to = await formatter.telegram_to_matrix(evt, source, self.main_intent,
-                                                                    is_edit=True)
+        text, html = await formatter.telegram_to_matrix(evt, source)
         intent = sender.intent if sender else self.main_intent
         await intent.set_typing(self.mxid, is_typing=False)
-        response = await intent.send_text(self.mxid, text, html=html, relates_to=relates_to)
 
-        mxid = response["event_id"]
+        async def send():
+            # The reply is added when sending, as the edited message may still be queued.
+            reply_text, reply_html, relates_to = await formatter.telegram_reply_fallback_to_matrix(
+                evt, source, text, html, self.main_intent, is_edit=True)
+            response = await intent.send_text(self.mxid, reply_text, html=reply_html,
+                                              relates_to=relates_to)
 
-        msg = DBMessage.query.get((evt.id, tg_space))
-        if not msg:
-            # Oh crap
-            return
-        msg.mxid = mxid
-        msg.mx_room = self.mxid
-        DBMessage.query \
-            .filter(DBMessage.mx_room == self.mxid,
-                    DBMessage.mxid == temporary_identifier) \
-            .update({"mxid": mxid})
-        self.db.commit()
+            mxid = response["event_id"]
+
+            if not DBMessage.query.get((evt.id, tg_space)):
+                # Oh crap
+                return
+            self._update_message(evt.id, tg_space, mxid)
+            self.save_bridged(evt, (mxid, tg_space), force_hash=True)
+            pending.set_result(mxid)
+
+        return send
+
+    def handle_telegram_message(self, source, sender, evt):
+        return self._enqueue_pending(self._prepare_telegram_message, source, sender, evt)
 
-    async def handle_telegram_message(self, source, sender, evt):
+    async def _prepare_telegram_message(self, source, sender, evt, pending):
         if not self.mxid:
             await self.create_matrix_room(source, invites=[source.mxid], update_if_exists=False)
 
         tg_space = self.tgid if self.peer_type == "channel" else source.tgid
 
-        temporary_identifier = f"${random.randint(1000000000000,9999999999999)}TGBRIDGETEMP"
-        duplicate_found = self.is_duplicate(evt, (temporary_identifier, tg_space))
+        duplicate_found = self.is_duplicate(evt, (pending, tg_space))
         if duplicate_found:
             mxid, other_tg_space = duplicate_found
             if tg_space != other_tg_space:
-                self.db.add(
-                    DBMessage(tgid=evt.id, mx_room=self.mxid, mxid=mxid, tg_space=tg_space))
-                self.db.commit()
+                self._when_bridged(mxid, partial(self._add_message, evt.id, tg_space))
             return
         allowed_media = (MessageMediaPhoto, MessageMediaDocument, MessageMediaGeo)
         media = evt.media if hasattr(evt, "media") and isinstance(evt.media,
                                                                   allowed_media) else None
         intent = sender.intent if sender else self.main_intent
+        await intent.ensure_joined(self.mxid)
         if not media and evt.message:
-            response = await self.handle_telegram_text(source, intent, evt)
+            send_event = await self.handle_telegram_text(source, intent, evt)
         elif media:
-            relates_to = formatter.telegram_reply_to_matrix(evt, source)
             if isinstance(media, MessageMediaPhoto):
-                response = await self.handle_telegram_photo(source, intent, evt, relates_to)
+                send_media = await self.handle_telegram_photo(source, intent, evt)
             elif isinstance(media, MessageMediaDocument):
-                response = await self.handle_telegram_document(source, intent, evt, relates_to)
+                send_media = await self.handle_telegram_document(source, intent, evt)
             elif isinstance(media, MessageMediaGeo):
-                response = await self.handle_telegram_location(source, intent, media.geo,
-                                                               relates_to)
+                send_media = await self.handle_telegram_location(source, intent, media.geo)
             else:
                 self.log.debug("Unhandled Telegram media: %s", media)
                 return
+            send_event = (partial(self._send_media_reply, send_media, evt, source)
+                          if send_media else None)
         else:
             self.log.debug("Unhandled Telegram message: %s", evt)
             return
 
-        if not response:
+        if not send_event:
             return
-        self.log.debug("Handled Telegram message: %s", evt)
-        mxid = response["event_id"]
-        DBMessage.query \
-            .filter(DBMessage.mx_room == self.mxid,
-                    DBMessage.mxid == temporary_identifier) \
-            .update({"mxid": mxid})
-        self.db.add(DBMessage(tgid=evt.id, mx_room=self.mxid, mxid=mxid, tg_space=tg_space))
-        self.db.commit()
+
+        async def send():
+            response = await send_event()
+            self.log.debug("Handled Telegram message: %s", evt)
+            mxid = response["event_id"]
+            self._add_message(evt.id, tg_space, mxid)
+            self.save_bridged(evt, (mxid, tg_space))
+            pending.set_result(mxid)
+
+        return send
 
     async def _create_room_on_action(self, source, action):
         create_and_exit = (MessageActionChatCreate, MessageActionChannelCreate)
@@ -1279,5 +1424,23 @@ def init(context):
     Portal.bridge_notices = config["bridge.bridge_notices"]
     Portal.alias_template = config.get("bridge.alias_template", "telegram_{groupname}")
     Portal.hs_domain = config["homeserver"]["domain"]
+    Portal.send_pipeline_depth = config.get("bridge.send_pipeline_depth", 4)
+    # Messages are only queued by the update handlers, so the expensive part (e.g. media
+    # transfers) needs its own limit across all portals.
+    Portal.prepare_semaphore = asyncio.Semaphore(config.get("bridge.update_concurrency", 32),
+                                                 loop=Portal.loop)
+    Portal.dedup_windows.update(config.get("bridge.deduplication_window", None) or {})
+    Portal.commit_batcher = context.commit_batcher
+    Portal.dedup_max_age = config.get("bridge.deduplication_max_age", 24 * 60 * 60)
+    if Portal.dedup_max_age > 0:
+        DBMessageDedup.query \
+            .filter(DBMessageDedup.timestamp < int(time.time()) - Portal.dedup_max_age) \
+            .delete(synchronize_session=False)
+        Portal.db.commit()
+    Portal.send_queue_depth = Portal.az.metrics.gauge(
+        "bridge_send_queue_depth", "Telegram messages queued for sending to Matrix")
+    Portal.send_latency = Portal.az.metrics.histogram(
+        "bridge_send_latency_seconds",
+        "Time from queueing a Telegram message to it being sent to Matrix")
     localpart = Portal.alias_template.format(groupname="(.+)")
     Portal.mx_alias_regex = re.compile(f"#{localpart}:{Portal.hs_domain}")
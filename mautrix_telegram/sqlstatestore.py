@@ -0,0 +1,178 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from itertools import islice
+import logging
+import json
+import os
+
+from mautrix_appservice import StateStore
+
+from .db import RoomState, RoomMembership, UserRegistration
+
+IMPORT_CHUNK_SIZE = 500
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+class SQLStateStore(StateStore):
+    """A StateStore that keeps its data in the bridge database for a single bridge process."""
+    log = logging.getLogger("mau.statestore")
+
+    def __init__(self, db, commit_batcher, member_list_max_age=None):
+        super().__init__(member_list_max_age=member_list_max_age)
+        self.db = db
+        self.commit_batcher = commit_batcher
+        self._loaded_memberships = set()
+        self._loaded_power_levels = set()
+
+    def import_json(self, path):
+        """Move the contents of a JSON state file into the database and rename the file."""
+        if not os.path.exists(path):
+            return
+        self.log.info(f"Importing Matrix state from {path} into the database")
+        try:
+            registrations, memberships, power_levels = self._import_json(path)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            self.log.exception(f"Failed to import Matrix state from {path}, keeping the file")
+            return
+        self.log.info(f"Imported {registrations} user registrations, {memberships} room "
+                      f"memberships and the power levels of {power_levels} rooms")
+
+        try:
+            if os.path.exists(f"{path}.log"):
+                os.replace(f"{path}.log", f"{path}.log.bak")
+            os.replace(path, f"{path}.bak")
+        except OSError:
+            self.log.exception(f"Failed to rename {path} after importing it")
+        else:
+            self.log.info(f"Renamed {path} to {path}.bak")
+
+    def _import_json(self, path):
+        store = StateStore()
+        store.load(path)
+        for user in store.registrations:
+            self.db.merge(UserRegistration(user_id=user))
+        table = RoomMembership.__table__
+        for rooms in _chunks(store.memberships, IMPORT_CHUNK_SIZE):
+            # Left over if the file couldn't be renamed after an earlier import.
+            self.db.execute(table.delete().where(table.c.room_id.in_(rooms)))
+        membership_count = 0
+        for memberships in _chunks(store.iter_memberships(), IMPORT_CHUNK_SIZE * 20):
+            self.db.execute(table.insert(), [{
+                "room_id": room,
+                "user_id": user,
+                "membership": membership,
+            } for room, user, membership in memberships])
+            membership_count += len(memberships)
+        for room, levels in store.power_levels.items():
+            self.db.merge(RoomState(room_id=room, power_levels=json.dumps(levels)))
+        return len(store.registrations), membership_count, len(store.power_levels)
+
+    def flush(self):
+        self.commit_batcher.flush()
+
+    def _autosave(self, change, *args):
+        self.commit_batcher.add(f"{change} change of {args[0]}", self._save, change, *args)
+
+    def _save(self, change, *args):
+        if change == "registered":
+            self.db.merge(UserRegistration(user_id=args[0]))
+        elif change == "membership":
+            room, user, membership = args
+            self.db.merge(RoomMembership(room_id=room, user_id=user, membership=membership))
+        elif change == "members":
+            room, members = args
+            table = RoomMembership.__table__
+            self.db.execute(table.delete().where(table.c.room_id == room))
+            if members:
+                self.db.execute(table.insert(), [{
+                    "room_id": room,
+                    "user_id": user,
+                    "membership": membership,
+                } for user, membership in members.items()])
+        elif change in ("power_level", "power_levels"):
+            room = args[0]
+            levels = json.dumps(self.power_levels[room])
+            self.db.merge(RoomState(room_id=room, power_levels=levels))
+
+    def is_registered(self, user):
+        if user in self.registrations:
+            return True
+        elif UserRegistration.query.get(user):
+            self.registrations.add(user)
+            return True
+        return False
+
+    def _load_memberships(self, room):
+        if room in self._loaded_memberships:
+            return
+        members = {row.user_id: row.membership
+                   for row in RoomMembership.query.filter(RoomMembership.room_id == room)}
+        if room in self.memberships:
+            # Anything already in the cache was set after the rows were written.
+            members.update((self._user_ids[user], self._membership_values[membership])
+                           for user, membership in self.memberships[room].items())
+        self._set_members(room, members)
+        self._loaded_memberships.add(room)
+
+    def get_membership(self, room, user):
+        self._load_memberships(room)
+        return super().get_membership(room, user)
+
+    def get_members(self, room, memberships=("join",)):
+        self._load_memberships(room)
+        return super().get_members(room, memberships)
+
+    def set_members(self, room, members):
+        self._loaded_memberships.add(room)
+        super().set_members(room, members)
+
+    def _load_power_levels(self, room):
+        if room in self._loaded_power_levels:
+            return
+        state = RoomState.query.get(room)
+        if state and state.power_levels and room not in self.power_levels:
+            self.power_levels[room] = json.loads(state.power_levels)
+        self._loaded_power_levels.add(room)
+
+    def has_power_levels(self, room):
+        self._load_power_levels(room)
+        return super().has_power_levels(room)
+
+    def get_power_levels(self, room):
+        self._load_power_levels(room)
+        return super().get_power_levels(room)
+
+    def _get_room_power_levels(self, room):
+        self._load_power_levels(room)
+        return super()._get_room_power_levels(room)
+
+    def set_power_level(self, room, user, level):
+        self._load_power_levels(room)
+        super().set_power_level(room, user, level)
+
+    def set_power_levels(self, room, content):
+        self._loaded_power_levels.add(room)
+        super().set_power_levels(room, content)
@@ -73,16 +73,18 @@ class MautrixTelegramClient(TelegramClient):
                                    reply_to_msg_id=reply_to)
         return self._get_response_message(request, await self(request))
 
-    async def download_file_bytes(self, location):
+    @staticmethod
+    def get_input_location(location):
         if isinstance(location, Document):
-            location = InputDocumentFileLocation(location.id, location.access_hash,
-                                                 location.version)
+            return InputDocumentFileLocation(location.id, location.access_hash, location.version)
         elif not isinstance(location, (InputFileLocation, InputDocumentFileLocation)):
-            location = InputFileLocation(location.volume_id, location.local_id, location.secret)
+            return InputFileLocation(location.volume_id, location.local_id, location.secret)
+        return location
 
+    async def download_file_bytes(self, location):
         file = BytesIO()
 
-        await self.download_file(location, file)
+        await self.download_file(self.get_input_location(location), file)
 
         data = file.getvalue()
         file.close()
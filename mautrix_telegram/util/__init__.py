@@ -1,2 +1,4 @@
-from .file_transfer import transfer_file_to_matrix
+from .file_transfer import transfer_file_to_matrix, MAX_IN_MEMORY_SIZE
 from .format_duration import format_duration
+from .deduplication import DedupCache, digest
+from .commit_batcher import CommitBatcher, enable_savepoints
@@ -0,0 +1,118 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import sqlalchemy as sql
+
+
+def enable_savepoints(engine):
+    """Make savepoints, which :class:`CommitBatcher` relies on, work with pysqlite."""
+    if engine.dialect.name != "sqlite" or engine.dialect.driver != "pysqlite":
+        return
+
+    @sql.event.listens_for(engine, "connect")
+    def disable_pysqlite_transactions(dbapi_connection, _):
+        dbapi_connection.isolation_level = None
+
+    @sql.event.listens_for(engine, "begin")
+    def begin(connection):
+        connection.execute("BEGIN")
+
+
+class CommitBatcher:
+    """Groups database commits together, committing ``delay`` seconds after the first change."""
+
+    def __init__(self, db, loop, log, delay=0.01, max_pending=100):
+        self.db = db
+        self.loop = loop
+        self.log = log
+        self.delay = delay
+        self.max_pending = max_pending
+
+        self._changes = []
+        self._flush_hooks = []
+        self._handle = None
+
+    @property
+    def pending(self):
+        return len(self._changes)
+
+    def add(self, description, change, *args):
+        """Call ``change(*args)`` to change the session and commit it with the next batch."""
+        self._changes.append((description, change, args))
+        try:
+            change(*args)
+            self.db.flush()
+        except Exception:
+            self.log.warning(f"Failed to save {description}, replaying the waiting changes")
+            self._replay(self._take_changes())
+            return
+        if len(self._changes) >= self.max_pending:
+            self.flush()
+        else:
+            self._schedule()
+
+    def add_flush_hook(self, description, hook):
+        """Call ``hook()`` once in the next batch, right before it's committed."""
+        if hook not in (added for _, added, _ in self._flush_hooks):
+            self._flush_hooks.append((description, hook, ()))
+        self._schedule()
+
+    def _schedule(self):
+        if self.delay <= 0:
+            self.flush()
+        elif not self._handle:
+            self._handle = self.loop.call_later(self.delay, self.flush)
+
+    def _take_changes(self):
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
+        # Flush hooks are replayed like changes if the batch fails.
+        changes = self._changes + self._flush_hooks
+        self._changes, self._flush_hooks = [], []
+        return changes
+
+    def flush(self):
+        hooks = self._flush_hooks
+        changes = self._take_changes()
+        if not changes:
+            return
+        try:
+            for _, hook, args in hooks:
+                hook(*args)
+            self.db.commit()
+        except Exception:
+            self.log.warning(f"Failed to commit a batch of {len(changes)} database changes, "
+                             "replaying them")
+            self._replay(changes)
+
+    def _replay(self, changes):
+        self.db.rollback()
+        for description, change, args in changes:
+            savepoint = self.db.begin_nested()
+            try:
+                change(*args)
+                self.db.flush()
+                savepoint.commit()
+            except Exception:
+                savepoint.rollback()
+                self.log.exception(f"Failed to save {description}, the change was lost")
+        try:
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            self.log.exception(f"Failed to commit {len(changes)} replayed database changes, "
+                               "the changes were lost")
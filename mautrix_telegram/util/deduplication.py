@@ -0,0 +1,72 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from collections import OrderedDict
+import struct
+
+try:
+    from hashlib import blake2b
+
+    def _digest(data):
+        return blake2b(data, digest_size=8).digest()
+except ImportError:
+    # Python 3.5 doesn't have BLAKE2
+    from hashlib import md5
+
+    def _digest(data):
+        return md5(data).digest()[:8]
+
+
+_unpack_int64 = struct.Struct(">q").unpack
+
+
+def digest(*parts):
+    """Hash the given parts into a signed 64-bit integer."""
+    data = b"\0".join([part if isinstance(part, bytes) else str(part).encode("utf-8")
+                       for part in parts])
+    return _unpack_int64(_digest(data))[0]
+
+
+class DedupCache:
+    """A size-bounded LRU set of recently seen keys, each with an optional value."""
+
+    def __init__(self, max_size=20):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def set(self, key, value=True):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def check(self, key, value=True):
+        """Return the value stored for the key, or mark the key as seen and return ``None``."""
+        try:
+            found = self._entries[key]
+        except KeyError:
+            self._entries[key] = value
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return None
+        self._entries.move_to_end(key)
+        return found
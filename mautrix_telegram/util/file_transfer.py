@@ -15,6 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from io import BytesIO
+from tempfile import SpooledTemporaryFile
 import time
 import logging
 
@@ -25,11 +26,15 @@ from sqlalchemy.exc import IntegrityError
 from telethon_aio.tl.types import (Document, FileLocation, InputFileLocation,
                                    InputDocumentFileLocation, PhotoCachedSize)
 from telethon_aio.errors import LocationInvalidError
+from mautrix_appservice.intent_api import SNIFF_SIZE
 
 from ..db import TelegramFile as DBTelegramFile
 
 log = logging.getLogger("mau.util")
 
+# Files larger than this are buffered on disk instead of in memory while being transferred.
+MAX_IN_MEMORY_SIZE = 4 * 1024 * 1024
+
 
 def _convert_webp(file, to="png"):
     try:
@@ -54,18 +59,22 @@ async def transfer_file_to_matrix(db, client, intent, location):
     if db_file:
         return db_file
 
-    try:
-        file = await client.download_file_bytes(location)
-    except LocationInvalidError:
-        return None
-    mime_type = magic.from_buffer(file, mime=True)
-
-    image_converted = False
-    if mime_type == "image/webp":
-        mime_type, file = _convert_webp(file, to="png")
-        image_converted = True
+    with SpooledTemporaryFile(max_size=MAX_IN_MEMORY_SIZE) as file:
+        try:
+            await client.download_file(client.get_input_location(location), file)
+        except LocationInvalidError:
+            return None
+        file.seek(0)
+        mime_type = magic.from_buffer(file.read(SNIFF_SIZE), mime=True)
+        file.seek(0)
 
-    uploaded = await intent.upload_file(file, mime_type)
+        image_converted = False
+        if mime_type == "image/webp":
+            mime_type, data = _convert_webp(file.read(), to="png")
+            image_converted = True
+            uploaded = await intent.upload_file(data, mime_type)
+        else:
+            uploaded = await intent.upload_file(file, mime_type)
 
     db_file = DBTelegramFile(id=id, mxc=uploaded["content_uri"],
                              mime_type=mime_type, was_converted=image_converted,
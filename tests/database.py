@@ -0,0 +1,48 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import asyncio
+import os
+import tempfile
+import unittest
+
+from sqlalchemy import orm
+import sqlalchemy as sql
+
+from mautrix_telegram.base import Base
+from mautrix_telegram.util import enable_savepoints
+import mautrix_telegram.db as db_models
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """A test case with an event loop and a bridge database in a temporary SQLite file."""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.directory = tempfile.TemporaryDirectory()
+        # Not an in-memory database, because sessions would share its only connection.
+        path = os.path.join(self.directory.name, "test.db")
+        self.engine = sql.create_engine(f"sqlite:///{path}")
+        enable_savepoints(self.engine)
+        Base.metadata.create_all(self.engine)
+        self.db = orm.scoping.scoped_session(orm.sessionmaker(bind=self.engine))
+        db_models.init(self.db)
+
+    def tearDown(self):
+        self.db.remove()
+        self.engine.dispose()
+        self.directory.cleanup()
+        self.loop.close()
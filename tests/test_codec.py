@@ -0,0 +1,43 @@
+# -*- coding: future_fstrings -*-
+# matrix-appservice-python - A Matrix Application Service framework written in Python.
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import unittest
+
+from mautrix_appservice import codec
+
+
+class TestCodec(unittest.TestCase):
+    def test_round_trip(self):
+        data = {"events": [{"type": "m.room.message", "content": {"body": "ünïcödé / text"},
+                            "origin_server_ts": 1520000000000, "unsigned": {"age": 1.5}}]}
+        self.assertEqual(codec.loads(codec.dumps(data)), data)
+        self.assertEqual(codec.loads(codec.dumps(data).encode("utf-8")), data)
+
+    def test_integers_outside_64_bits(self):
+        for number in (2 ** 70, -2 ** 63 - 1, 2 ** 64, 2 ** 63 - 1, -2 ** 63):
+            encoded = codec.dumps({"number": number})
+            for data in (encoded, encoded.encode("utf-8"), bytearray(encoded, "utf-8")):
+                decoded = codec.loads(data)["number"]
+                self.assertIsInstance(decoded, int)
+                self.assertEqual(decoded, number)
+
+    def test_long_digit_strings(self):
+        data = {"id": "1" * 40, "number": 12}
+        self.assertEqual(codec.loads(codec.dumps(data)), data)
+
+
+if __name__ == "__main__":
+    unittest.main()
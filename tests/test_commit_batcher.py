@@ -0,0 +1,104 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from unittest import mock
+import asyncio
+import logging
+import unittest
+
+from sqlalchemy import orm
+import sqlalchemy as sql
+
+from mautrix_telegram.db import Message
+from mautrix_telegram.util import CommitBatcher
+
+from database import DatabaseTestCase
+
+
+class TestCommitBatcher(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.log = logging.getLogger("test")
+        self.batcher = CommitBatcher(self.db, self.loop, self.log, delay=0.01)
+
+    def add_message(self, tgid):
+        self.db.add(Message(mxid=f"$event{tgid}:example.com", mx_room="!room:example.com",
+                            tgid=tgid, tg_space=1))
+
+    def committed(self):
+        session = orm.sessionmaker(bind=self.engine)()
+        try:
+            return sorted(tgid for tgid, in session.query(Message.tgid))
+        finally:
+            session.close()
+
+    def test_batches_commits(self):
+        for tgid in range(5):
+            self.batcher.add(f"message {tgid}", self.add_message, tgid)
+        self.assertEqual(self.batcher.pending, 5)
+        self.assertEqual(self.committed(), [])
+        self.loop.run_until_complete(asyncio.sleep(0.05, loop=self.loop))
+        self.assertEqual(self.batcher.pending, 0)
+        self.assertEqual(self.committed(), [0, 1, 2, 3, 4])
+
+    def test_failed_change_only_loses_itself(self):
+        self.batcher.add("message 1", self.add_message, 1)
+        self.batcher.add("message 2", self.add_message, 2)
+        with self.assertLogs(self.log, logging.ERROR):
+            self.batcher.add("duplicate message 2", self.add_message, 2)
+        # The waiting changes were replayed and committed without the bad one.
+        self.assertEqual(self.batcher.pending, 0)
+        self.assertEqual(self.committed(), [1, 2])
+
+        self.batcher.add("message 3", self.add_message, 3)
+        self.batcher.flush()
+        self.assertEqual(self.committed(), [1, 2, 3])
+
+    def test_failed_commit_replays_changes(self):
+        for tgid in range(3):
+            self.batcher.add(f"message {tgid}", self.add_message, tgid)
+        commit = self.db.commit
+        failures = [sql.exc.OperationalError("COMMIT", {}, Exception("database is locked"))]
+
+        def fail_once():
+            if failures:
+                raise failures.pop()
+            commit()
+
+        with mock.patch.object(self.db, "commit", side_effect=fail_once) as patched:
+            with self.assertLogs(self.log, logging.WARNING):
+                self.batcher.flush()
+        self.assertEqual(patched.call_count, 2)
+        self.assertEqual(self.committed(), [0, 1, 2])
+
+    def test_flush_hooks_run_once_before_commit(self):
+        calls = []
+
+        def hook():
+            calls.append(self.batcher.pending)
+            self.add_message(len(calls) + 10)
+
+        self.batcher.add("message 1", self.add_message, 1)
+        self.batcher.add_flush_hook("hook", hook)
+        self.batcher.add_flush_hook("same hook", hook)
+        self.assertEqual(calls, [])
+        self.loop.run_until_complete(asyncio.sleep(0.05, loop=self.loop))
+        self.assertEqual(calls, [0])
+        self.assertEqual(self.committed(), [1, 11])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+# -*- coding: future_fstrings -*-
+# matrix-appservice-python - A Matrix Application Service framework written in Python.
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import asyncio
+import logging
+import unittest
+
+from mautrix_appservice.dispatcher import OrderedDispatcher
+
+
+class TestDispatcherCapacity(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.dispatcher = OrderedDispatcher(self.loop, logging.getLogger("test"),
+                                            max_queue_size=3, max_total=5)
+        self.blocker = asyncio.Event(loop=self.loop)
+
+    def tearDown(self):
+        self.blocker.set()
+        self.loop.run_until_complete(self.drain())
+        self.loop.close()
+
+    async def drain(self):
+        while self.dispatcher.total:
+            await asyncio.sleep(0.001, loop=self.loop)
+
+    async def block(self):
+        await self.blocker.wait()
+
+    def submit(self, reservation):
+        self.dispatcher.release(reservation)
+        for key, count in reservation.items():
+            for _ in range(count):
+                self.dispatcher.submit(key, self.block)
+
+    def test_limits(self):
+        self.submit(self.dispatcher.reserve(["a", "a", "b"]))
+        self.assertIsNone(self.dispatcher.reserve(["a", "a"]))
+        self.assertIsNone(self.dispatcher.reserve(["c", "c", "c"]))
+        self.assertIsNotNone(self.dispatcher.reserve(["a", "c"]))
+
+    def test_oversized_batch_waits_for_empty_queues(self):
+        self.submit(self.dispatcher.reserve(["a"]))
+        self.assertIsNone(self.dispatcher.reserve(["a"] * 4))
+        self.assertIsNone(self.dispatcher.reserve(["b"] * 3 + ["c"] * 3))
+        self.blocker.set()
+        self.loop.run_until_complete(self.drain())
+        self.blocker.clear()
+
+        self.submit(self.dispatcher.reserve(["a"] * 4))
+        self.assertEqual(self.dispatcher.total, 4)
+        self.assertIsNone(self.dispatcher.reserve(["a"]))
+        self.assertIsNotNone(self.dispatcher.reserve(["b"]))
+
+    def test_reservation_counts_until_released(self):
+        reservation = self.dispatcher.reserve(["a", "a", "a"])
+        # E.g. another transaction that arrives while the first one is being journaled.
+        self.assertIsNone(self.dispatcher.reserve(["a"]))
+        self.assertIsNone(self.dispatcher.reserve(["b", "b", "b"]))
+        self.submit(reservation)
+        self.assertIsNone(self.dispatcher.reserve(["a"]))
+        self.assertEqual(self.dispatcher.total, 3)
+
+        self.dispatcher.release(self.dispatcher.reserve(["b", "b"]))
+        self.assertIsNotNone(self.dispatcher.reserve(["b", "b"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
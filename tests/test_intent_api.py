@@ -0,0 +1,292 @@
+# -*- coding: future_fstrings -*-
+# matrix-appservice-python - A Matrix Application Service framework written in Python.
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import asyncio
+import io
+import logging
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+import aiohttp
+
+from mautrix_appservice.errors import MatrixRequestError
+from mautrix_appservice.intent_api import HTTPAPI
+from mautrix_appservice.metrics import Metrics
+from mautrix_appservice.rate_limit import RateLimiter
+from mautrix_appservice.state_store import StateStore
+
+
+class StubHomeserver:
+    def __init__(self, loop):
+        self.loop = loop
+        self.requests = []
+        self.uploads = []
+        self.rate_limit_uploads = 0
+        self.media = b""
+        self.power_levels = {}
+        self.power_level_puts = []
+
+        app = web.Application()
+        app.router.add_post("/_matrix/client/r0/register", self.register)
+        app.router.add_post("/_matrix/client/r0/join/{room}", self.join)
+        app.router.add_get("/_matrix/client/r0/rooms/{room}/state/m.room.power_levels",
+                           self.get_power_levels)
+        app.router.add_put("/_matrix/client/r0/rooms/{room}/state/m.room.power_levels",
+                           self.put_power_levels)
+        app.router.add_post("/_matrix/media/r0/upload", self.upload)
+        app.router.add_get("/_matrix/media/r0/download/{server}/{media}", self.download)
+        self.server = TestServer(app, loop=loop)
+
+    async def start(self):
+        await self.server.start_server(loop=self.loop)
+        return str(self.server.make_url("")).rstrip("/")
+
+    async def close(self):
+        await self.server.close()
+
+    async def register(self, request):
+        self.requests.append(request.path)
+        # Keep the request in flight long enough for the other callers to pile up.
+        await asyncio.sleep(0.05, loop=self.loop)
+        return web.json_response({})
+
+    async def join(self, request):
+        self.requests.append(request.path)
+        await asyncio.sleep(0.05, loop=self.loop)
+        return web.json_response({"room_id": request.match_info["room"]})
+
+    async def get_power_levels(self, request):
+        self.requests.append(request.path)
+        return web.json_response(self.power_levels[request.match_info["room"]])
+
+    async def put_power_levels(self, request):
+        self.requests.append(request.path)
+        content = await request.json()
+        await asyncio.sleep(0.05, loop=self.loop)
+        self.power_levels[request.match_info["room"]] = content
+        self.power_level_puts.append(content)
+        return web.json_response({"event_id": "$levels:example.com"})
+
+    async def upload(self, request):
+        self.requests.append(request.path)
+        body = await request.read()
+        if self.rate_limit_uploads:
+            self.rate_limit_uploads -= 1
+            return web.json_response({"errcode": "M_LIMIT_EXCEEDED", "error": "Too many requests",
+                                      "retry_after_ms": 10}, status=429)
+        self.uploads.append(body)
+        return web.json_response({"content_uri": "mxc://example.com/upload"})
+
+    async def download(self, request):
+        self.requests.append(request.path)
+        return web.Response(body=self.media, content_type="application/octet-stream")
+
+
+class IntentAPITestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.homeserver = StubHomeserver(self.loop)
+        base_url = self.loop.run_until_complete(self.homeserver.start())
+        self.session = aiohttp.ClientSession(loop=self.loop)
+        self.state_store = StateStore()
+        self.api = HTTPAPI(base_url=base_url, domain="example.com",
+                           bot_mxid="@bot:example.com", token="as_token",
+                           log=logging.getLogger("test"), state_store=self.state_store,
+                           client_session=self.session)
+        self.state_store.registered("@bot:example.com")
+        self.intent = self.api.bot_intent()
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.session.close())
+        self.loop.run_until_complete(self.homeserver.close())
+        self.loop.close()
+
+
+class TestEnsureSingleFlight(IntentAPITestCase):
+    def test_concurrent_ensure_joined(self):
+        intent = self.api.intent("@puppet:example.com")
+        room_id = "!room:example.com"
+
+        async def run():
+            await asyncio.gather(*([intent.ensure_registered() for _ in range(10)]
+                                   + [intent.ensure_joined(room_id) for _ in range(10)]),
+                                 loop=self.loop)
+
+        self.loop.run_until_complete(run())
+        self.assertEqual(sorted(self.homeserver.requests), [
+            "/_matrix/client/r0/join/!room:example.com",
+            "/_matrix/client/r0/register",
+        ])
+        self.assertTrue(self.state_store.is_registered(intent.mxid))
+        self.assertTrue(self.state_store.is_joined(room_id, intent.mxid))
+        self.assertFalse(self.api.inflight_ensures)
+
+        # Later calls are answered from the state store.
+        self.loop.run_until_complete(run())
+        self.assertEqual(len(self.homeserver.requests), 2)
+
+
+class TestEnsurePowerLevel(IntentAPITestCase):
+    room_id = "!room:example.com"
+
+    def setUp(self):
+        super().setUp()
+        self.state_store.joined(self.room_id, "@bot:example.com")
+        self.homeserver.power_levels[self.room_id] = {
+            "users": {"@bot:example.com": 100, "@admin:example.com": 100},
+            "events_default": 50,
+        }
+
+    def test_bot_raises_level(self):
+        # The cached copy predates a change by a room admin that the raise must not revert.
+        self.state_store.set_power_levels(self.room_id, {
+            "users": {"@bot:example.com": 100},
+            "events_default": 50,
+        })
+        self.homeserver.power_levels[self.room_id]["users"]["@mod:example.com"] = 50
+        intent = self.api.intent("@puppet:example.com")
+
+        self.loop.run_until_complete(
+            intent._ensure_has_power_level_for(self.room_id, "m.room.message"))
+        self.assertEqual(self.homeserver.power_level_puts, [{
+            "users": {"@bot:example.com": 100, "@admin:example.com": 100,
+                      "@mod:example.com": 50, "@puppet:example.com": 50},
+            "events_default": 50,
+            "events": {},
+        }])
+        self.assertTrue(self.state_store.has_power_level(self.room_id, intent.mxid,
+                                                         "m.room.message"))
+
+    def test_bot_cannot_raise_level(self):
+        self.homeserver.power_levels[self.room_id] = {
+            "users": {"@bot:example.com": 10},
+            "events_default": 50,
+        }
+        intent = self.api.intent("@puppet:example.com")
+
+        self.loop.run_until_complete(
+            intent._ensure_has_power_level_for(self.room_id, "m.room.message"))
+        self.assertEqual(self.homeserver.power_level_puts, [])
+
+    def test_concurrent_raises_are_serialized(self):
+        intents = [self.api.intent(f"@puppet{i}:example.com") for i in range(5)]
+
+        async def run():
+            await asyncio.gather(*[intent._ensure_has_power_level_for(self.room_id,
+                                                                      "m.room.message")
+                                   for intent in intents], loop=self.loop)
+
+        self.loop.run_until_complete(run())
+        # Each raise builds on the previous one instead of overwriting it.
+        self.assertEqual(len(self.homeserver.power_level_puts), 5)
+        users = self.homeserver.power_levels[self.room_id]["users"]
+        for intent in intents:
+            self.assertEqual(users[intent.mxid], 50)
+        self.assertEqual(users["@admin:example.com"], 100)
+
+
+class TestMediaTransfer(IntentAPITestCase):
+    data = bytes(range(256)) * 1024
+
+    def test_upload_file_retries_rate_limited_file(self):
+        self.homeserver.rate_limit_uploads = 1
+        file = io.BytesIO(self.data)
+        response = self.loop.run_until_complete(self.intent.upload_file(file))
+        self.assertEqual(response["content_uri"], "mxc://example.com/upload")
+        self.assertEqual(self.homeserver.uploads, [self.data])
+        self.assertEqual(len(self.homeserver.requests), 2)
+
+    def test_rate_limit_wait_is_recorded(self):
+        metrics = Metrics()
+        self.api.rate_limiter = RateLimiter(self.loop, global_rate=1000, metrics=metrics)
+        self.homeserver.rate_limit_uploads = 2
+        self.loop.run_until_complete(self.intent.upload_file(io.BytesIO(self.data)))
+
+        throttled = metrics.metrics["appservice_request_throttle_seconds_total"]
+        self.assertAlmostEqual(throttled.get(limit="homeserver"), 0.02)
+        self.assertEqual(metrics.metrics["appservice_requests_rate_limited_total"].get(), 2)
+        # Halved twice, then recovered a bit with the successful upload.
+        self.assertEqual(self.api.rate_limiter.global_bucket.rate, 300)
+
+    def test_upload_file_streams_async_iterable(self):
+        data = self.data
+
+        class Chunks:
+            def __aiter__(self):
+                return ChunkIterator()
+
+        class ChunkIterator:
+            def __init__(self):
+                self.offset = 0
+
+            def __aiter__(self):
+                return self
+
+            async def __anext__(self):
+                chunk = data[self.offset:self.offset + 3000]
+                if not chunk:
+                    raise StopAsyncIteration
+                self.offset += len(chunk)
+                return chunk
+
+        self.loop.run_until_complete(self.intent.upload_file(Chunks(), "image/png", len(data)))
+        self.assertEqual(self.homeserver.uploads, [data])
+
+    def test_upload_file_does_not_retry_async_iterator(self):
+        self.homeserver.rate_limit_uploads = 1
+
+        class Chunks:
+            def __init__(self):
+                self.chunks = [b"a" * 10000, b"b" * 10000]
+
+            def __aiter__(self):
+                return self
+
+            async def __anext__(self):
+                if not self.chunks:
+                    raise StopAsyncIteration
+                return self.chunks.pop(0)
+
+        with self.assertRaises(MatrixRequestError) as context:
+            self.loop.run_until_complete(self.intent.upload_file(Chunks(), "text/plain"))
+        self.assertEqual(context.exception.code, 429)
+        self.assertEqual(len(self.homeserver.requests), 1)
+        self.assertEqual(self.homeserver.uploads, [])
+
+    def test_download_file_to(self):
+        self.homeserver.media = self.data
+        output = io.BytesIO()
+        content_type = self.loop.run_until_complete(
+            self.intent.download_file_to("mxc://example.com/media", output, chunk_size=4096))
+        self.assertEqual(content_type, "application/octet-stream")
+        self.assertEqual(output.getvalue(), self.data)
+
+    def test_iter_download(self):
+        self.homeserver.media = self.data
+
+        async def download():
+            chunks = []
+            async for chunk in await self.intent.iter_download("mxc://example.com/media", 4096):
+                self.assertLessEqual(len(chunk), 4096)
+                chunks.append(chunk)
+            return b"".join(chunks)
+
+        self.assertEqual(self.loop.run_until_complete(download()), self.data)
+
+
+if __name__ == "__main__":
+    unittest.main()
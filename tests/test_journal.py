@@ -0,0 +1,130 @@
+# -*- coding: future_fstrings -*-
+# matrix-appservice-python - A Matrix Application Service framework written in Python.
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from unittest import mock
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from mautrix_appservice.journal import TransactionJournal
+
+EVENTS = [{"type": "m.room.message", "room_id": "!room:example.com"}]
+
+
+class TestTransactionJournal(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "journal")
+        self.journal = self.create_journal()
+
+    def tearDown(self):
+        self.journal.close()
+        self.directory.cleanup()
+        self.loop.close()
+
+    def create_journal(self, **kwargs):
+        journal = TransactionJournal(self.path, self.loop, logging.getLogger("test"),
+                                     commit_delay=0.001, **kwargs)
+        journal.load()
+        journal.open()
+        return journal
+
+    def append(self, transaction_id):
+        self.loop.run_until_complete(self.journal.append(transaction_id, EVENTS))
+
+    def entries(self):
+        with open(self.path) as file:
+            return [json.loads(line) for line in file]
+
+    def test_load_replays_unhandled_transactions(self):
+        for transaction_id in ("1", "2", "3"):
+            self.append(transaction_id)
+        self.journal.mark_done("2")
+        self.journal.close()
+
+        journal = TransactionJournal(self.path, self.loop, logging.getLogger("test"))
+        self.assertEqual(journal.load(), [("1", EVENTS), ("3", EVENTS)])
+        self.assertEqual(list(journal.pending), ["1", "3"])
+
+    def test_done_markers(self):
+        self.append("1")
+        self.journal.mark_done("1")
+        self.assertEqual(self.entries(), [{"txn_id": "1", "events": EVENTS}, {"done": "1"}])
+        self.assertFalse(self.journal.pending)
+
+    def test_compaction_keeps_pending_entries(self):
+        self.journal.close()
+        self.journal = self.create_journal(compact_size=0)
+        for transaction_id in ("1", "2", "3"):
+            self.append(transaction_id)
+        self.journal.mark_done("2")
+        self.assertEqual(self.entries(), [{"txn_id": "1", "events": EVENTS},
+                                          {"txn_id": "3", "events": EVENTS}])
+        # The compacted journal is still appended to.
+        self.append("4")
+        self.assertEqual(self.entries()[-1], {"txn_id": "4", "events": EVENTS})
+
+    def test_failed_sync_marks_transaction_done(self):
+        with mock.patch("os.fsync", side_effect=OSError("No space left on device")):
+            with self.assertRaises(OSError):
+                self.append("1")
+        self.assertFalse(self.journal.pending)
+        self.journal.close()
+
+        journal = TransactionJournal(self.path, self.loop, logging.getLogger("test"))
+        self.assertEqual(journal.load(), [])
+
+    def test_no_compaction_during_overlapping_syncs(self):
+        self.journal.close()
+        self.journal = self.create_journal(compact_size=0)
+        fsync = os.fsync
+
+        def slow_fsync(fd):
+            # Only the syncs of appended entries, which run in the executor, are slowed down.
+            if threading.current_thread() is threading.main_thread():
+                return fsync(fd)
+            inode = os.fstat(fd).st_ino
+            time.sleep(0.05)
+            # The descriptor may have been reused for the compacted file.
+            if os.fstat(fd).st_ino != inode:
+                raise OSError("File was replaced while syncing")
+            fsync(fd)
+
+        async def run():
+            first = asyncio.ensure_future(self.journal.append("1", EVENTS), loop=self.loop)
+            await asyncio.sleep(0.02, loop=self.loop)
+            # Starts another sync group while the first one is still syncing.
+            second = asyncio.ensure_future(self.journal.append("2", EVENTS), loop=self.loop)
+            await first
+            self.journal.mark_done("1")
+            await second
+
+        with mock.patch("os.fsync", slow_fsync):
+            self.loop.run_until_complete(run())
+        self.assertEqual(list(self.journal.pending), ["2"])
+
+        self.journal.mark_done("2")
+        self.assertEqual(self.entries(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,204 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from datetime import datetime
+from unittest import mock
+import asyncio
+import logging
+import time
+import unittest
+
+from telethon_aio.tl.types import Message, PeerChat
+
+from mautrix_telegram.db import Message as DBMessage, MessageDedup
+from mautrix_telegram.portal import Portal
+from mautrix_telegram.util import CommitBatcher
+
+from database import DatabaseTestCase
+
+CHAT_ID = 1234
+
+
+def message(index, text=None, second=None):
+    # Every user sees a message with its own ID, so copies only share the date and content.
+    date = datetime(2018, 6, 1, 12, 0, index if second is None else second)
+    return Message(id=index, to_id=PeerChat(CHAT_ID), date=date,
+                   message=text or f"Message {index}", from_id=5678)
+
+
+class PortalTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.batcher = CommitBatcher(self.db, self.loop, logging.getLogger("test"), delay=0)
+        patcher = mock.patch.multiple(Portal, db=self.db, loop=self.loop,
+                                      commit_batcher=self.batcher, by_tgid={}, by_mxid={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def restart(self):
+        """Drop the session and create a new portal for the same chat."""
+        self.db.remove()
+        return Portal(CHAT_ID, "chat", mxid="!portal:example.com")
+
+
+class TestPersistentDedup(PortalTestCase):
+    def test_survives_restart(self):
+        portal = Portal(CHAT_ID, "chat", mxid="!portal:example.com")
+        self.assertIsNone(portal.is_duplicate(message(1), ("$one:example.com", 1), save=True))
+        portal.save_bridged(message(2), ("$two:example.com", 1))
+        self.assertFalse(portal.is_duplicate_action(message(3)))
+
+        portal = self.restart()
+        self.assertEqual(portal.is_duplicate(message(1), ("$other:example.com", 2)),
+                         ("$one:example.com", 1))
+        self.assertEqual(portal.is_duplicate(message(2), ("$other:example.com", 2)),
+                         ("$two:example.com", 1))
+        self.assertTrue(portal.is_duplicate_action(message(3)))
+        self.assertIsNone(portal.is_duplicate(message(4), ("$four:example.com", 2)))
+
+    def test_expired_entries_are_not_loaded(self):
+        portal = Portal(CHAT_ID, "chat", mxid="!portal:example.com")
+        expired = time.time() - Portal.dedup_max_age - 60
+        with mock.patch("time.time", return_value=expired):
+            portal.save_bridged(message(1), ("$old:example.com", 1))
+        portal.save_bridged(message(2), ("$new:example.com", 1))
+
+        portal = self.restart()
+        self.assertIsNone(portal.is_duplicate(message(1), ("$other:example.com", 2)))
+        self.assertEqual(portal.is_duplicate(message(2), ("$other:example.com", 2)),
+                         ("$new:example.com", 1))
+
+    @mock.patch.dict(Portal.dedup_windows, {"chat": 20})
+    def test_saved_entries_are_capped_to_window(self):
+        portal = Portal(CHAT_ID, "chat", mxid="!portal:example.com")
+        window = portal._dedup.max_size
+        start = time.time()
+        for index in range(window * 3):
+            # A second apart, as pruning keeps every entry from the same second as the oldest
+            # entry of the window.
+            with mock.patch("time.time", return_value=start + index):
+                portal.save_bridged(message(index % 60, f"Message {index}"),
+                                    (f"$event{index}:example.com", 1))
+
+        portal = self.restart()
+        self.assertEqual(MessageDedup.query.count(), window)
+        with mock.patch("time.time", return_value=start + window * 3):
+            newest = window * 3 - 1
+            self.assertEqual(portal.is_duplicate(message(newest % 60, f"Message {newest}"),
+                                                 ("$other:example.com", 2)),
+                             (f"$event{newest}:example.com", 1))
+            self.assertIsNone(portal.is_duplicate(message(0, "Message 0"),
+                                                  ("$other:example.com", 2)))
+
+    def test_first_saved_entry_is_kept(self):
+        portal = Portal(CHAT_ID, "chat", mxid="!portal:example.com")
+        portal.save_bridged(message(1), ("$one:example.com", 1))
+        portal.save_bridged(message(1), ("$other:example.com", 2))
+
+        portal = self.restart()
+        self.assertEqual(MessageDedup.query.count(), 1)
+        self.assertEqual(portal.is_duplicate(message(1), ("$new:example.com", 3)),
+                         ("$one:example.com", 1))
+
+    def test_channels_are_not_persisted(self):
+        portal = Portal(CHAT_ID, "channel", mxid="!portal:example.com")
+        portal.save_bridged(message(1), ("$one:example.com", CHAT_ID))
+        self.assertEqual(MessageDedup.query.count(), 0)
+
+
+class StubIntent:
+    mxid = "@bot:example.com"
+
+    def __init__(self, loop):
+        self.release = asyncio.Event(loop=loop)
+        self.sent = []
+        self.fail = False
+
+    async def set_typing(self, room_id, is_typing=True):
+        pass
+
+    async def ensure_joined(self, room_id):
+        pass
+
+    async def send_text(self, room_id, text, html=None, relates_to=None):
+        await self.release.wait()
+        if self.fail:
+            raise RuntimeError("send failed")
+        self.sent.append(text)
+        return {"event_id": f"$event{len(self.sent)}:example.com"}
+
+
+class StubSource:
+    def __init__(self, tgid):
+        self.tgid = tgid
+
+
+class TestPendingMapping(PortalTestCase):
+    def setUp(self):
+        super().setUp()
+        self.portal = Portal(CHAT_ID, "chat", mxid="!portal:example.com")
+        self.intent = StubIntent(self.loop)
+        self.portal._main_intent = self.intent
+
+    def deliver_twice(self):
+        """Deliver a message through two users, the second copy while the first is sending."""
+
+        async def run():
+            first = self.portal.handle_telegram_message(StubSource(1), None, message(1, "Hi", 0))
+            second = self.portal.handle_telegram_message(StubSource(2), None, message(2, "Hi", 0))
+            await asyncio.sleep(0.01, loop=self.loop)
+            self.assertEqual(DBMessage.query.count(), 0)
+            self.intent.release.set()
+            return await asyncio.gather(first, second, loop=self.loop, return_exceptions=True)
+
+        return self.loop.run_until_complete(run())
+
+    def saved(self):
+        return sorted((row.tgid, row.tg_space, row.mxid) for row in DBMessage.query.all())
+
+    def test_duplicate_is_saved_with_sent_event_id(self):
+        self.deliver_twice()
+        self.assertEqual(self.intent.sent, ["Hi"])
+        self.assertEqual(self.saved(), [(1, 1, "$event1:example.com"),
+                                        (2, 2, "$event1:example.com")])
+        portal = self.restart()
+        self.assertEqual(portal.is_duplicate(message(3, "Hi", 0), ("$other:example.com", 3)),
+                         ("$event1:example.com", 1))
+
+    def test_duplicate_of_failed_send_is_not_saved(self):
+        self.intent.fail = True
+        results = self.deliver_twice()
+        self.assertIsInstance(results[0], RuntimeError)
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        self.assertEqual(self.saved(), [])
+
+    def test_when_bridged(self):
+        called = []
+        Portal._when_bridged("$sent:example.com", called.append)
+        self.assertEqual(called, ["$sent:example.com"])
+
+        pending = asyncio.Future(loop=self.loop)
+        Portal._when_bridged(pending, called.append)
+        cancelled = asyncio.Future(loop=self.loop)
+        Portal._when_bridged(cancelled, called.append)
+        pending.set_result("$later:example.com")
+        cancelled.cancel()
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        self.assertEqual(called, ["$sent:example.com", "$later:example.com"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+# -*- coding: future_fstrings -*-
+# matrix-appservice-python - A Matrix Application Service framework written in Python.
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import asyncio
+import logging
+import unittest
+
+from mautrix_appservice.dispatcher import OrderedDispatcher
+from mautrix_appservice.send_queue import RoomSendQueue
+
+
+class TestSendQueueOrdering(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_interleaved_media_and_text(self):
+        loop = self.loop
+        prepare_semaphore = asyncio.Semaphore(2, loop=loop)
+        dispatcher = OrderedDispatcher(loop, logging.getLogger("test"), max_concurrency=2)
+        queues = {chat: RoomSendQueue(loop, 4, prepare_semaphore=prepare_semaphore)
+                  for chat in ("a", "b")}
+        sent = {chat: [] for chat in queues}
+        tasks = []
+        preparing = 0
+        max_preparing = 0
+
+        async def prepare(chat, index, is_media):
+            nonlocal preparing, max_preparing
+            preparing += 1
+            max_preparing = max(max_preparing, preparing)
+            # Media is slow to prepare, so later text messages finish preparing first.
+            await asyncio.sleep(0.02 if is_media else 0, loop=loop)
+            preparing -= 1
+
+            async def send():
+                await asyncio.sleep(0, loop=loop)
+                sent[chat].append(index)
+
+            return send
+
+        async def handle_message(chat, index, is_media):
+            tasks.append(queues[chat].enqueue(prepare(chat, index, is_media)))
+
+        async def handle_action(chat, index):
+            await queues[chat].join()
+            sent[chat].append(index)
+
+        async def run():
+            for index in range(60):
+                chat = "a" if index % 4 < 2 else "b"
+                if index % 10 == 9:
+                    dispatcher.submit(chat, handle_action, chat, index)
+                else:
+                    dispatcher.submit(chat, handle_message, chat, index, index % 3 == 0)
+            while dispatcher.total:
+                await asyncio.sleep(0.01, loop=loop)
+            await asyncio.gather(*tasks, loop=loop)
+
+        loop.run_until_complete(run())
+
+        for chat, indices in sent.items():
+            self.assertEqual(indices, sorted(indices))
+        self.assertEqual(sum(len(indices) for indices in sent.values()), 60)
+        self.assertLessEqual(max_preparing, 2)
+        self.assertFalse(dispatcher.queues)
+
+
+if __name__ == "__main__":
+    unittest.main()
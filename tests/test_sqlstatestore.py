@@ -0,0 +1,159 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from unittest import mock
+import logging
+import os
+import shutil
+import unittest
+
+from sqlalchemy import orm
+
+from mautrix_appservice import StateStore
+from mautrix_telegram.sqlstatestore import SQLStateStore
+from mautrix_telegram.util import CommitBatcher
+import mautrix_telegram.db as db_models
+
+from database import DatabaseTestCase
+
+
+class TestImportJSON(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.batcher = CommitBatcher(self.db, self.loop, logging.getLogger("test"))
+        self.path = os.path.join(self.directory.name, "mx-state.json")
+
+        state = StateStore()
+        state.registered("@bot:example.com")
+        for room in range(600):
+            for user in range(5):
+                state._set_membership(f"!room{room}:example.com", f"@user{user}:example.com",
+                                      "join" if user else "invite")
+        state.set_power_levels("!room0:example.com", {"users": {"@bot:example.com": 100}})
+        state.save(self.path)
+
+    def check_imported(self):
+        self.db.remove()
+        store = SQLStateStore(self.db, self.batcher)
+        self.assertTrue(store.is_registered("@bot:example.com"))
+        self.assertEqual(store.get_membership("!room599:example.com", "@user0:example.com"),
+                         "invite")
+        self.assertEqual(sorted(store.get_members("!room0:example.com")),
+                         [f"@user{user}:example.com" for user in range(1, 5)])
+        self.assertEqual(store.get_power_levels("!room0:example.com")["users"],
+                         {"@bot:example.com": 100})
+        self.assertEqual(self.db.query(db_models.RoomMembership).count(), 3000)
+
+    def test_import(self):
+        SQLStateStore(self.db, self.batcher).import_json(self.path)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertTrue(os.path.exists(f"{self.path}.bak"))
+        self.check_imported()
+
+    def test_import_again_after_failed_rename(self):
+        shutil.copy(self.path, f"{self.path}.copy")
+        SQLStateStore(self.db, self.batcher).import_json(self.path)
+        os.replace(f"{self.path}.copy", self.path)
+        SQLStateStore(self.db, self.batcher).import_json(self.path)
+        self.check_imported()
+
+    def test_failed_import_keeps_file(self):
+        store = SQLStateStore(self.db, self.batcher)
+        with mock.patch.object(store.db, "commit", side_effect=OSError("disk I/O error")):
+            with self.assertLogs(store.log, logging.ERROR):
+                store.import_json(self.path)
+        self.assertTrue(os.path.exists(self.path))
+        self.assertEqual(self.db.query(db_models.RoomMembership).count(), 0)
+
+        store.import_json(self.path)
+        self.check_imported()
+
+
+class TestSQLStateStore(DatabaseTestCase):
+    room = "!room:example.com"
+
+    def setUp(self):
+        super().setUp()
+        self.batcher = CommitBatcher(self.db, self.loop, logging.getLogger("test"), delay=10)
+        self.store = SQLStateStore(self.db, self.batcher)
+
+    def restart(self):
+        self.batcher.flush()
+        self.db.remove()
+        return SQLStateStore(self.db, self.batcher)
+
+    def committed(self, model):
+        session = orm.sessionmaker(bind=self.engine)()
+        try:
+            return session.query(model).count()
+        finally:
+            session.close()
+
+    def test_changes_are_batched(self):
+        self.store.registered("@bot:example.com")
+        self.store.joined(self.room, "@bot:example.com")
+        self.store.invited(self.room, "@user:example.com")
+        self.store.set_power_levels(self.room, {"users": {"@bot:example.com": 100}})
+        self.store.set_power_level(self.room, "@user:example.com", 50)
+        self.assertEqual(self.batcher.pending, 5)
+        self.assertEqual(self.committed(db_models.RoomMembership), 0)
+
+        store = self.restart()
+        self.assertEqual(self.batcher.pending, 0)
+        self.assertTrue(store.is_registered("@bot:example.com"))
+        self.assertFalse(store.is_registered("@user:example.com"))
+        self.assertEqual(store.get_members(self.room), ["@bot:example.com"])
+        self.assertEqual(store.get_membership(self.room, "@user:example.com"), "invite")
+        self.assertEqual(store.get_power_levels(self.room)["users"],
+                         {"@bot:example.com": 100, "@user:example.com": 50})
+
+    def test_set_members_replaces_rows(self):
+        self.store.joined(self.room, "@old:example.com")
+        self.store.set_members(self.room, {"@bot:example.com": "join",
+                                           "@user:example.com": "invite"})
+
+        store = self.restart()
+        self.assertEqual(self.committed(db_models.RoomMembership), 2)
+        self.assertEqual(store.get_membership(self.room, "@old:example.com"), "left")
+        self.assertFalse(store.is_joined(self.room, "@old:example.com"))
+        self.assertEqual(store.get_members(self.room, ("join", "invite")),
+                         ["@bot:example.com", "@user:example.com"])
+
+    def test_rooms_are_loaded_lazily(self):
+        for room in (self.room, "!other:example.com"):
+            self.store.joined(room, "@bot:example.com")
+            self.store.set_power_levels(room, {"users": {"@bot:example.com": 100}})
+
+        store = self.restart()
+        self.assertFalse(store._loaded_memberships or store._loaded_power_levels)
+        self.assertTrue(store.is_joined(self.room, "@bot:example.com"))
+        self.assertTrue(store.has_power_levels(self.room))
+        self.assertEqual(store._loaded_memberships, {self.room})
+        self.assertEqual(store._loaded_power_levels, {self.room})
+
+    def test_loading_keeps_newer_values(self):
+        self.store.joined(self.room, "@bot:example.com")
+        self.store.joined(self.room, "@user:example.com")
+
+        store = self.restart()
+        store.left(self.room, "@user:example.com")
+        # The room's rows are only read now, after the change above.
+        self.assertEqual(store.get_members(self.room), ["@bot:example.com"])
+        self.assertEqual(store.get_membership(self.room, "@user:example.com"), "left")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+# -*- coding: future_fstrings -*-
+# matrix-appservice-python - A Matrix Application Service framework written in Python.
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import asyncio
+import os
+import tempfile
+import unittest
+
+from mautrix_appservice.state_store import StateStore
+
+ROOM = "!room:example.com"
+USER = "@user:example.com"
+
+
+class TestJoinedCache(unittest.TestCase):
+    def setUp(self):
+        self.store = StateStore()
+        self.store.joined(ROOM, USER)
+        self.assertTrue(self.store.is_joined(ROOM, USER))
+
+    def test_leaving_clears_cached_check(self):
+        self.store.left(ROOM, USER)
+        self.assertFalse(self.store.is_joined(ROOM, USER))
+        self.store.joined(ROOM, USER)
+        self.assertTrue(self.store.is_joined(ROOM, USER))
+
+    def test_member_list_clears_cached_checks(self):
+        self.store.set_members(ROOM, {USER: "invite", "@other:example.com": "join"})
+        self.assertFalse(self.store.is_joined(ROOM, USER))
+        self.assertTrue(self.store.is_joined(ROOM, "@other:example.com"))
+
+
+class TestSnapshots(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "mx-state.json")
+        self.store = StateStore(autosave_file=self.path, loop=self.loop, max_log_size=3)
+
+    def tearDown(self):
+        self.directory.cleanup()
+        self.loop.close()
+
+    def reload(self):
+        store = StateStore()
+        store.load(self.path)
+        return store
+
+    def test_changes_during_snapshot_are_kept(self):
+        self.store.registered(USER)
+        self.store.joined(ROOM, USER)
+        self.store.set_power_level(ROOM, USER, 50)
+        snapshot = self.store._snapshot_task
+        self.assertIsNotNone(snapshot)
+        # Made after the state was copied, so they're only in the new log.
+        self.store.set_power_level(ROOM, USER, 100)
+        self.store.left(ROOM, USER)
+        self.loop.run_until_complete(snapshot)
+
+        with open(self.path) as file:
+            self.assertIn('"users":{"@user:example.com":50}', file.read().replace(" ", ""))
+        self.assertFalse(os.path.exists(f"{self.path}.log.old"))
+        store = self.reload()
+        self.assertEqual(store.get_power_levels(ROOM)["users"], {USER: 100})
+        self.assertFalse(store.is_joined(ROOM, USER))
+
+    def test_flush_supersedes_pending_snapshot(self):
+        self.store.registered(USER)
+        self.store.joined(ROOM, USER)
+        self.store.set_power_level(ROOM, USER, 50)
+        snapshot = self.store._snapshot_task
+        self.store.left(ROOM, USER)
+        self.store.flush()
+        self.loop.run_until_complete(snapshot)
+
+        # Everything is in the snapshot written by flush().
+        self.assertFalse(os.path.exists(f"{self.path}.log"))
+        self.assertFalse(os.path.exists(f"{self.path}.log.old"))
+        self.assertFalse(self.reload().is_joined(ROOM, USER))
+
+
+if __name__ == "__main__":
+    unittest.main()
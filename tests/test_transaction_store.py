@@ -0,0 +1,68 @@
+# -*- coding: future_fstrings -*-
+# matrix-appservice-python - A Matrix Application Service framework written in Python.
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import tempfile
+import unittest
+
+from mautrix_appservice.transaction_store import TransactionStore
+
+
+class TestTransactionStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "mx-transactions.txt")
+        self.store = TransactionStore(3, autosave_file=self.path)
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def lines(self):
+        with open(self.path) as file:
+            return file.read().split()
+
+    def test_compaction_does_not_write_new_id_twice(self):
+        for transaction_id in range(1, 10):
+            self.store.add(str(transaction_id))
+            lines = self.lines()
+            self.assertEqual(len(lines), len(set(lines)))
+            self.assertLessEqual(len(lines), 6)
+        # Compacted when 7 was added, the file had 6 lines then.
+        self.assertEqual(self.lines(), ["5", "6", "7", "8", "9"])
+
+        self.store.add("10")
+        self.store.add("11")
+        self.assertEqual(self.lines(), ["9", "10", "11"])
+
+    def test_load_after_restart(self):
+        for transaction_id in range(1, 10):
+            self.store.add(str(transaction_id))
+        self.store.close()
+
+        store = TransactionStore(3, autosave_file=self.path)
+        store.load(self.path)
+        self.assertEqual(list(store._transactions), ["7", "8", "9"])
+        self.assertNotIn("6", store)
+        # The lines of evicted IDs still count towards compaction.
+        store.add("10")
+        store.add("11")
+        self.assertEqual(self.lines(), ["9", "10", "11"])
+        store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
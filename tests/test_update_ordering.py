@@ -0,0 +1,178 @@
+# -*- coding: future_fstrings -*-
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2018 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from datetime import datetime
+from unittest import mock
+import asyncio
+import logging
+import random
+import re
+import unittest
+
+from telethon_aio.tl.types import (Message, MessageMediaPhoto, PeerChat, PhotoEmpty,
+                                   UpdateDeleteMessages, UpdateNewMessage)
+
+from mautrix_appservice import OrderedDispatcher
+# The portal module has to be imported first to resolve the circular imports.
+from mautrix_telegram.portal import Portal
+from mautrix_telegram.abstract_user import AbstractUser
+from mautrix_telegram.db import Message as DBMessage
+from mautrix_telegram.puppet import Puppet
+from mautrix_telegram import formatter
+from mautrix_telegram.util import CommitBatcher
+
+from database import DatabaseTestCase
+
+CHATS = {100: "!a:example.com", 200: "!b:example.com"}
+
+
+class StubIntent:
+    mxid = "@bot:example.com"
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.sent = []
+        self.relations = {}
+        self.redacted = []
+        self.log = []
+
+    async def set_typing(self, room_id, is_typing=True):
+        pass
+
+    async def ensure_joined(self, room_id):
+        pass
+
+    async def send_text(self, room_id, text, html=None, relates_to=None):
+        await asyncio.sleep(0, loop=self.loop)
+        index = int(text.split()[-1])
+        self.sent.append((room_id, index))
+        self.relations[index] = relates_to
+        self.log.append(("send", index))
+        return {"event_id": f"$event{len(self.sent)}:example.com"}
+
+    async def get_event(self, room_id, event_id):
+        return {"sender": self.mxid, "content": {"body": "Photo"}}
+
+    async def redact(self, room_id, event_id):
+        self.redacted.append(event_id)
+
+
+class StubUser(AbstractUser):
+    name = "test"
+    log = logging.getLogger("test")
+
+    def __init__(self):
+        super().__init__()
+        self.tgid = 1
+
+
+class TestUpdateOrdering(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        batcher = CommitBatcher(self.db, self.loop, logging.getLogger("test"))
+        dispatcher = OrderedDispatcher(self.loop, logging.getLogger("test"), max_concurrency=4)
+        self.rand = random.Random(0)
+
+        for patcher in (mock.patch.multiple(Portal, db=self.db, loop=self.loop,
+                                            commit_batcher=batcher, by_tgid={}, by_mxid={}),
+                        mock.patch.multiple(AbstractUser, db=self.db, loop=self.loop,
+                                            update_dispatcher=dispatcher),
+                        mock.patch.object(Portal, "handle_telegram_photo", self.prepare_photo),
+                        mock.patch.object(Puppet, "mxid_regex",
+                                          re.compile("@telegram_([0-9]+):example.com"))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.intent = StubIntent(self.loop)
+        for chat_id, room_id in CHATS.items():
+            Portal(chat_id, "chat", mxid=room_id)._main_intent = self.intent
+        self.user = StubUser()
+
+    async def prepare_photo(self, source, intent, evt):
+        # Downloading and uploading media is slow, so later text messages are ready first.
+        await asyncio.sleep(self.rand.uniform(0.01, 0.03), loop=self.loop)
+        room_id = CHATS[evt.to_id.chat_id]
+
+        async def send_media(relates_to=None):
+            return await intent.send_text(room_id, f"Photo {evt.id}")
+
+        return send_media
+
+    def message(self, index):
+        chat_id = 100 if index % 4 < 2 else 200
+        media = MessageMediaPhoto(photo=PhotoEmpty(id=index)) if index % 3 == 0 else None
+        return UpdateNewMessage(Message(id=index, to_id=PeerChat(chat_id),
+                                        date=datetime(2018, 6, 1, 12, 0, index % 60),
+                                        message=f"Message {index}", media=media),
+                                pts=index, pts_count=1)
+
+    def test_interleaved_media_text_and_deletions(self):
+        async def run():
+            for index in range(1, 41):
+                await self.user._update_catch(self.message(index))
+                if index == 10:
+                    # Message 9 (a photo) and 10 are in different chats and still being sent.
+                    await self.user._update_catch(UpdateDeleteMessages(messages=[9, 10, 5000],
+                                                                       pts=11, pts_count=3))
+            while AbstractUser.update_dispatcher.total:
+                await asyncio.sleep(0.01, loop=self.loop)
+            for chat_id in CHATS:
+                await Portal.get_by_tgid(chat_id).send_queue.join()
+
+        self.loop.run_until_complete(run())
+
+        for room_id in CHATS.values():
+            sent = [index for room, index in self.intent.sent if room == room_id]
+            self.assertEqual(sent, sorted(sent))
+        self.assertEqual(len(self.intent.sent), 40)
+
+        deleted = {f"$event{number + 1}:example.com": index
+                   for number, (_, index) in enumerate(self.intent.sent) if index in (9, 10)}
+        self.assertEqual(sorted(self.intent.redacted), sorted(deleted))
+        saved = sorted(tgid for tgid, in self.db.query(DBMessage.tgid))
+        self.assertEqual(saved, [index for index in range(1, 41) if index not in (9, 10)])
+
+    def test_reply_to_queued_message(self):
+        photo = Message(id=1, to_id=PeerChat(100), date=datetime(2018, 6, 1, 12),
+                        message="Photo 1", media=MessageMediaPhoto(photo=PhotoEmpty(id=1)))
+        reply = Message(id=2, to_id=PeerChat(100), date=datetime(2018, 6, 1, 12),
+                        message="Reply 2", reply_to_msg_id=1)
+        format_message = formatter.telegram_to_matrix
+
+        async def logged_format(evt, source):
+            self.intent.log.append(("format", evt.id))
+            return await format_message(evt, source)
+
+        async def run():
+            for index, evt in enumerate((photo, reply), start=1):
+                await self.user._update_catch(UpdateNewMessage(evt, pts=index, pts_count=1))
+            while AbstractUser.update_dispatcher.total:
+                await asyncio.sleep(0.01, loop=self.loop)
+            await Portal.get_by_tgid(100).send_queue.join()
+
+        with mock.patch.object(formatter, "telegram_to_matrix", logged_format):
+            self.loop.run_until_complete(run())
+
+        # The reply is formatted while the photo is being prepared, but only finds the photo it
+        # replies to once the photo has been sent.
+        self.assertEqual(self.intent.log, [("format", 2), ("send", 1), ("send", 2)])
+        self.assertEqual(self.intent.relations[2], {
+            "m.in_reply_to": {"event_id": "$event1:example.com", "room_id": CHATS[100]},
+        })
+
+
+if __name__ == "__main__":
+    unittest.main()